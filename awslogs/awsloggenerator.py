@@ -1,12 +1,103 @@
 import sys
+import time
+import threading
 import pystache
+from functools import partial
+from itertools import chain
 from collections import deque
 
+from .pipeline import BackgroundIterator, merge_by_timestamp, merge_by_arrival, MAX_BUFFERED_ITEMS
+from .tail import HighWaterMarks, PollInterval, LagTracker, STREAM_REFRESH_INTERVAL
+
 
 MAX_EVENTS_PER_CALL = 10000
 
+FILTER_LOG_EVENTS_STREAMS_LIMIT = 100
+
+# Past this many batches of streams a single group-wide cursor, filtered on
+# the client side, costs fewer requests than one cursor per batch.
+MAX_STREAM_BATCHES = 20
+
+# Batches of streams fetched at once by a PipelinedLogGenerator.
+DEFAULT_PIPELINE_BATCHES = 4
+
 END_OF_STREAM = object()
 
+
+class EventIdWindow(object):
+    """Bounded set of the most recently seen event ids.
+
+    Membership is a hash lookup instead of a scan; once ``maxlen`` ids are
+    held the oldest one is evicted, in insertion order.
+    """
+
+    def __init__(self, maxlen=MAX_EVENTS_PER_CALL):
+        self.maxlen = maxlen
+        self._ids = set()
+        self._order = deque()
+
+    def __contains__(self, event_id):
+        return event_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, event_id):
+        """Records ``event_id``. Returns ``False`` if it was already seen."""
+        if event_id in self._ids:
+            return False
+        if len(self._order) >= self.maxlen:
+            self._ids.discard(self._order.popleft())
+        self._order.append(event_id)
+        self._ids.add(event_id)
+        return True
+
+
+def partition_time_range(start, end, count, stream_ranges=None):
+    """Splits ``[start, end)`` into up to ``count`` contiguous windows.
+
+    Boundaries are placed so that every window covers a similar amount of
+    stream activity, estimated from the ``(first, last)`` event timestamps in
+    ``stream_ranges``. Without them the windows have equal length.
+    """
+    if count <= 1 or end - start < count:
+        return [(start, end)]
+
+    deltas = {}
+    for first, last in stream_ranges or []:
+        first, last = max(first, start), min(max(last, first + 1), end)
+        if first < last:
+            deltas[first] = deltas.get(first, 0) + 1
+            deltas[last] = deltas.get(last, 0) - 1
+
+    segments = []
+    total = 0
+    active = 0
+    points = sorted(deltas)
+    for segment_start, segment_end in zip(points, points[1:]):
+        active += deltas[segment_start]
+        if active:
+            segments.append((segment_start, segment_end, active))
+            total += active * (segment_end - segment_start)
+
+    if not total:
+        step = (end - start) / float(count)
+        bounds = [start + int(step * i) for i in range(count)]
+    else:
+        bounds = [start]
+        step = total / float(count)
+        target = step
+        covered = 0
+        for segment_start, segment_end, active in segments:
+            weight = active * (segment_end - segment_start)
+            while len(bounds) < count and covered + weight >= target:
+                bounds.append(segment_start + int((target - covered) / active))
+                target += step
+            covered += weight
+    bounds.append(end)
+
+    return [(lo, hi) for lo, hi in zip(bounds, bounds[1:]) if hi > lo]
+
 # TODO look into renaming this class / file to conform to standard naming conventions
 
 
@@ -23,50 +114,378 @@ class AWSLogGenerator(object):
                  log_streams=None,
                  filter_pattern=None,
                  start_time='1w',
-                 end_time=None):
+                 end_time=None,
+                 concurrency=1,
+                 time_partitions=1,
+                 stream_ranges=None,
+                 event_cache=None,
+                 scheduler=None,
+                 rate_limiter=None,
+                 reorder_window=None,
+                 list_streams=None):
         self.watch = watch
         self.log_group_name = log_group_name
         self.log_streams = log_streams
         self.start_time = start_time
         self.filter_pattern = filter_pattern
-        self.end_time = end_time # do something with this argument
+        self.end_time = end_time
+        self.concurrency = max(concurrency or 1, 1)
+        self.time_partitions = max(time_partitions or 1, 1)
+        self.stream_ranges = stream_ranges
+        self.event_cache = event_cache
+        self.scheduler = scheduler
+        self.rate_limiter = rate_limiter
+        self.reorder_window = reorder_window
+        self.list_streams = list_streams
+        self._in_flight = threading.BoundedSemaphore(self.concurrency * self.time_partitions)
+        self.lag = LagTracker()
 
         # TODO do some validation here
 
 
 
-    def __generate_logs(self, client): # move client argument to member variable
+    def __filter_kwargs(self, log_streams, start_time=None, end_time=None):
+        kwargs = {'logGroupName': self.log_group_name,
+                  'startTime': self.start_time if start_time is None else start_time}
 
-        interleaving_sanity = deque(maxlen=self.MAX_EVENTS_PER_CALL)
+        if log_streams:
+            kwargs['logStreamNames'] = log_streams
 
-        kwargs = {'logGroupName': self.log_group_name,
-                  'logStreamNames': self.log_streams,
-                  'startTime': self.start_time}
+        if end_time is not None:
+            kwargs['endTime'] = end_time
 
         if self.filter_pattern:
             kwargs['filterPattern'] = self.filter_pattern
+        return kwargs
+
+    def _shards(self, log_streams=None):
+        """Splits ``log_streams`` into shards ``filter_log_events`` accepts.
+
+        There are at least ``concurrency`` shards and none holds more than
+        ``FILTER_LOG_EVENTS_STREAMS_LIMIT`` streams. When that would take
+        more than ``MAX_STREAM_BATCHES`` shards a single ``None`` shard is
+        returned instead, meaning the whole group filtered client side.
+        """
+        log_streams = self.log_streams if log_streams is None else log_streams
+        if not log_streams:
+            return [log_streams]
+        batches = -(-len(log_streams) // FILTER_LOG_EVENTS_STREAMS_LIMIT)
+        if batches > MAX_STREAM_BATCHES:
+            return [None]
+        count = min(max(self.concurrency, batches), len(log_streams))
+        return [log_streams[i::count] for i in range(count)]
+
+    def _time_windows(self):
+        """Returns the ``(start, end)`` windows to fetch, ``end`` inclusive.
+
+        The last window is left open when no ``end_time`` was given.
+        """
+        if self.time_partitions == 1 or self.start_time is None:
+            return [(self.start_time, self.end_time)]
+        end = self.end_time + 1 if self.end_time is not None else int(time.time() * 1000)
+        windows = [(lo, hi - 1) for lo, hi in partition_time_range(
+            self.start_time, end, self.time_partitions, self.stream_ranges)]
+        if self.end_time is None:
+            windows[-1] = (windows[-1][0], None)
+        return windows
 
+    def __filter_log_events(self, client, log_streams, start_time=None, end_time=None, wanted=None):
+        """Returns every event of ``log_streams``, one page at a time.
+
+        ``end_time`` is sent as ``endTime`` and also enforced here: pagination
+        stops once a whole page is past it. A ``None`` shard reads the whole
+        group and keeps only the events of the ``wanted`` streams.
+        """
+        kwargs = self.__filter_kwargs(log_streams, start_time, end_time)
+        wanted = set(wanted) if log_streams is None and wanted else None
+
+        def more(response):
+            if 'nextToken' not in response:
+                return False
+            events = response.get('events', [])
+            return not (end_time is not None and events and
+                        all(event['timestamp'] > end_time for event in events))
+
+        request = client.filter_log_events
+        if self.rate_limiter is not None:
+            request = partial(self.rate_limiter.call, request)
+        if self.scheduler is not None:
+            pages = self.scheduler.paginate(request, kwargs, more)
+        else:
+            pages = self.__paginate(request, kwargs, more)
+        return self.__page_events(pages, end_time, wanted)
+
+    def __paginate(self, request, kwargs, more):
         while True:
-            response = client.filter_log_events(**kwargs)
+            with self._in_flight:
+                response = request(**kwargs)
+            yield response
+            if not more(response):
+                return
+            kwargs['nextToken'] = response['nextToken']
 
+    def __page_events(self, pages, end_time, wanted):
+        interleaving_sanity = EventIdWindow(maxlen=self.MAX_EVENTS_PER_CALL)
+        for response in pages:
             for event in response.get('events', []):
-                if event['eventId'] not in interleaving_sanity:
-                    interleaving_sanity.append(event['eventId'])
+                if end_time is not None and event['timestamp'] > end_time:
+                    continue
+                if wanted is not None and event['logStreamName'] not in wanted:
+                    continue
+                if interleaving_sanity.add(event['eventId']):
                     yield event
 
-            if 'nextToken' in response:
-                kwargs['nextToken'] = response['nextToken']
+    def __fetch_window(self, client, log_streams, start_time, end_time):
+        shards = self._shards(log_streams)
+        if len(shards) == 1:
+            return self.__filter_log_events(client, shards[0], start_time, end_time, log_streams)
+        if self.scheduler is not None:
+            return merge_by_timestamp(
+                [self.__filter_log_events(client, shard, start_time, end_time, log_streams)
+                 for shard in shards]
+            )
+        buffer_size = max(MAX_BUFFERED_ITEMS // len(shards), 1)
+        return merge_by_timestamp(
+            [BackgroundIterator(self.__filter_log_events(client, shard, start_time, end_time, log_streams),
+                                maxsize=buffer_size)
+             for shard in shards]
+        )
+
+    def __fetch_buckets(self, client, start_time, end_time):
+        """Serves the window from ``event_cache``, fetching only the streams
+        missing from its settled buckets.
+
+        Adjacent ranges missing the same streams are fetched with a single
+        cursor; its events are split into buckets as they are stored.
+        """
+        runs = []
+        for lo, hi, bucket in self.event_cache.buckets(start_time, end_time):
+            cached = []
+            if bucket is not None:
+                cached = self.event_cache.cached_streams(self.log_group_name, self.log_streams,
+                                                         self.filter_pattern, bucket)
+            cached_set = set(cached)
+            missing = [stream for stream in self.log_streams if stream not in cached_set]
+            if runs and runs[-1][0] == missing:
+                runs[-1][1].append((lo, hi, bucket, cached))
             else:
-                yield END_OF_STREAM
+                runs.append((missing, [(lo, hi, bucket, cached)]))
+        return chain.from_iterable(self.__fetch_run(client, missing, ranges) for missing, ranges in runs)
 
+    def __fetch_run(self, client, missing, ranges):
+        sources = [chain.from_iterable(
+            self.event_cache.read(self.log_group_name, cached, self.filter_pattern, bucket)
+            for _, _, bucket, cached in ranges if cached
+        )]
+        if missing:
+            events = self.__fetch_window(client, missing, ranges[0][0], ranges[-1][1])
+            sources.append(self.__store_buckets(missing, ranges, events))
+        return merge_by_timestamp(sources)
 
-    def get_and_print_logs(self, client, log_printer):
-        for event in self.__generate_logs(client):
-            if event is END_OF_STREAM:
-                if self.watch:
-                    time.sleep(1)
-                    continue
-                else:
+    def __store_buckets(self, log_streams, ranges, events):
+        """Splits ``events``, ordered by timestamp, into ``ranges`` and writes
+        those of settled buckets through to ``event_cache``."""
+        events = iter(events)
+        lookahead = []
+
+        def until(end_time):
+            while True:
+                if not lookahead:
+                    for event in events:
+                        lookahead.append(event)
+                        break
+                    else:
+                        return
+                if end_time is not None and lookahead[0]['timestamp'] > end_time:
                     return
+                yield lookahead.pop()
+
+        for _, hi, bucket, _ in ranges:
+            part = until(hi)
+            if bucket is not None:
+                part = self.event_cache.store(self.log_group_name, log_streams, self.filter_pattern,
+                                              bucket, part)
+            for event in part:
+                yield event
+
+    def __generate_window(self, client, start_time, end_time):
+        if self.event_cache is None or not self.log_streams or start_time is None:
+            return self.__fetch_window(client, self.log_streams, start_time, end_time)
+        return self.__fetch_buckets(client, start_time, end_time)
+
+    def generate_logs(self, client):
+        """Yields the events of every stream, ordered by timestamp.
+
+        Each shard of streams is paginated on its own thread and the shards
+        are merged by ``timestamp``; at most ``concurrency`` requests per
+        time window are in flight at once. With ``time_partitions`` the time range
+        is also split into windows which are fetched concurrently, buffered,
+        and emitted one after the other. ``client`` only needs to provide
+        ``filter_log_events``, so a local fake can stand in for boto3.
+
+        With a ``scheduler`` no threads are started here: every shard and
+        window is a cursor whose pages are requested on the scheduler's pool.
+        Events out of order within ``reorder_window`` are re-sorted.
+        """
+        windows = self._time_windows()
+        if len(windows) == 1:
+            events = self.__generate_window(client, *windows[0])
+        elif self.scheduler is not None:
+            events = chain.from_iterable(
+                [self.__generate_window(client, start, end) for start, end in windows]
+            )
+        else:
+            events = chain.from_iterable(
+                [BackgroundIterator(self.__generate_window(client, start, end))
+                 for start, end in windows]
+            )
+        if self.reorder_window is not None:
+            events = self.reorder_window.new_buffer().reorder(events)
+        return events
+
+    def tail_logs(self, client, sleep=time.sleep):
+        """Yields new events forever, polling from per-stream high-water marks.
+
+        Every poll re-queries from the oldest recent mark and skips events at
+        or behind their stream's mark; streams that fell behind, or have no
+        events yet, are polled on their own from their marks up to there. The delay between polls
+        shrinks while events keep arriving and backs off while the streams
+        are idle.
+
+        With a ``reorder_window`` new events are held back until they are
+        older than the window, by event time or by the clock between polls.
+        With ``list_streams``, a callable returning the current stream names,
+        streams created since are added every ``STREAM_REFRESH_INTERVAL``
+        seconds of polling.
+        """
+        marks = HighWaterMarks(self.start_time, self.log_streams)
+        interval = PollInterval()
+        slept = 0
+        buffer = self.reorder_window.new_buffer() if self.reorder_window is not None else None
+        while True:
+            count = 0
+            start_time = marks.start_time()
+            events = self.__generate_window(client, start_time, None)
+            lagging = marks.lagging()
+            if lagging is not None:
+                streams, lagging_start = lagging
+                events = chain(self.__fetch_window(client, streams, lagging_start, start_time - 1), events)
+            for event in events:
+                if marks.add(event):
+                    count += 1
+                    for released in buffer.push(event) if buffer is not None else [event]:
+                        yield released
+                        self.lag.record(released)
+            if buffer is not None:
+                for released in buffer.tick(int(time.time() * 1000)):
+                    yield released
+                    self.lag.record(released)
+            delay = interval.next(count)
+            sleep(delay)
+            slept += delay
+            if self.list_streams is not None and self.log_streams is not None and \
+                    slept >= STREAM_REFRESH_INTERVAL:
+                slept = 0
+                known = set(self.log_streams)
+                new_streams = [stream for stream in self.list_streams() if stream not in known]
+                if new_streams:
+                    self.log_streams = list(self.log_streams) + new_streams
+                    marks.add_streams(new_streams)
+
+    def get_and_print_logs(self, client, log_printer):
+        if self.watch and self.end_time is None:
+            events = self.tail_logs(client)
+        else:
+            events = self.generate_logs(client)
+        try:
+            for event in events:
+                log_printer.print_log(event)
+        finally:
+            log_printer.close()
+
+
+def _tag_group(log_group_name, events):
+    for event in events:
+        event['logGroupName'] = log_group_name
+        yield event
 
-            log_printer.print_log(event)
+
+class MultiGroupLogGenerator(object):
+    """Fans in the events of one ``AWSLogGenerator`` per log group.
+
+    Every event is tagged with its ``logGroupName``. Fetched events are
+    merged by timestamp; tailed events are interleaved as they arrive, since
+    an idle group would otherwise hold back the others.
+    """
+
+    def __init__(self, generators, watch=False, end_time=None, scheduler=None):
+        self.generators = generators
+        self.watch = watch
+        self.end_time = end_time
+        self.scheduler = scheduler
+        self.lag = LagTracker()
+
+    def generate_logs(self, client):
+        """Yields the events of every group, ordered by timestamp. Each group
+        is fetched concurrently, on its own thread unless there is a
+        ``scheduler``."""
+        sources = [_tag_group(generator.log_group_name, generator.generate_logs(client))
+                   for generator in self.generators]
+        if self.scheduler is None:
+            sources = [BackgroundIterator(source, maxsize=max(MAX_BUFFERED_ITEMS // len(sources), 1))
+                       for source in sources]
+        return merge_by_timestamp(sources)
+
+    def tail_logs(self, client):
+        """Yields new events of every group forever, as they arrive."""
+        for event in merge_by_arrival([_tag_group(generator.log_group_name, generator.tail_logs(client))
+                                       for generator in self.generators]):
+            yield event
+            self.lag.record(event)
+
+    def get_and_print_logs(self, client, log_printer):
+        if self.watch and self.end_time is None:
+            events = self.tail_logs(client)
+        else:
+            events = self.generate_logs(client)
+        try:
+            for event in events:
+                log_printer.print_log(event)
+        finally:
+            log_printer.close()
+
+
+class PipelinedLogGenerator(object):
+    """Fetches the events of batches of streams while stream discovery is
+    still running.
+
+    ``generators`` is an iterable of ``AWSLogGenerator``, typically one per
+    batch of streams, consumed on a background thread as the batches are
+    discovered. At most ``max_active`` of them are fetched at once. Events
+    are ordered by timestamp within a batch and interleaved across batches
+    as they arrive; a ``reorder_window`` re-sorts them approximately. With
+    ``tag_groups`` every event is tagged with its ``logGroupName``.
+    """
+
+    def __init__(self, generators, max_active, tag_groups=False, reorder_window=None):
+        self.generators = generators
+        self.max_active = max_active
+        self.tag_groups = tag_groups
+        self.reorder_window = reorder_window
+        self.lag = LagTracker()
+
+    def generate_logs(self, client):
+        sources = (_tag_group(generator.log_group_name, generator.generate_logs(client))
+                   if self.tag_groups else generator.generate_logs(client)
+                   for generator in self.generators)
+        events = merge_by_arrival(sources, max_active=self.max_active)
+        if self.reorder_window is not None:
+            events = self.reorder_window.new_buffer().reorder(events)
+        return events
+
+    def get_and_print_logs(self, client, log_printer):
+        try:
+            for event in self.generate_logs(client):
+                log_printer.print_log(event)
+        finally:
+            log_printer.close()
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 import locale
 import codecs
@@ -10,9 +11,62 @@ from termcolor import colored
 
 from . import exceptions
 from .core import AWSLogs
+from .outputfile import COMPRESSIONS
+from .awsloggenerator import DEFAULT_PIPELINE_BATCHES
+from .stats import DEFAULT_PERCENTILES
+from .ratelimit import DEFAULT_RATE, THROTTLING_ERROR_CODES
+from .writers import DEFAULT_FIELDS, OUTPUT_FORMATS, parse_fields
 from ._version import __version__
 
 
+def reorder_window(text):
+    """Parses ``--reorder-window``: a duration such as ``500ms``, ``5s`` or
+    ``1m``, or a plain number of events. Returns ``(window_ms, window_events)``."""
+    match = re.match(r'^(\d+)(ms|s|m)?$', text.strip())
+    if not match:
+        raise argparse.ArgumentTypeError(
+            "expected a duration like 500ms, 5s or 1m, or a number of events")
+    amount, unit = int(match.group(1)), match.group(2)
+    if unit is None:
+        return None, amount
+    return amount * {'ms': 1, 's': 1000, 'm': 60000}[unit], None
+
+
+def size(text):
+    """Parses a size such as ``500KB``, ``100MB`` or ``1GB`` into bytes."""
+    match = re.match(r'^(\d+)\s*([KMG]?)B?$', text.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError("expected a size like 500KB, 100MB or 1GB")
+    return int(match.group(1)) * 1024 ** '_KMG'.index(match.group(2) or '_')
+
+
+def interval(text):
+    """Parses a duration such as ``30m``, ``1h`` or ``1d`` into milliseconds."""
+    match = re.match(r'^(\d+)(s|m|h|d)$', text.strip())
+    if not match or not int(match.group(1)):
+        raise argparse.ArgumentTypeError("expected a duration like 30m, 1h or 1d")
+    return int(match.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)] * 1000
+
+
+def percentiles(text):
+    """Parses ``--percentiles``, e.g. ``50,99,99.9``."""
+    try:
+        values = tuple(float(p) for p in text.split(','))
+    except ValueError:
+        values = ()
+    if not values or not all(0 < p <= 100 for p in values):
+        raise argparse.ArgumentTypeError("expected percentiles between 0 and 100, e.g. 50,90,99")
+    return values
+
+
+def fields(text):
+    """Parses ``--fields``."""
+    try:
+        return parse_fields(text)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc))
+
+
 def main(argv=None):
 
     if sys.version_info < (3, 0):
@@ -20,7 +74,7 @@ def main(argv=None):
 
     argv = (argv or sys.argv)[1:]
 
-    parser = argparse.ArgumentParser(usage=("%(prog)s [ get | groups | streams | query ]"))
+    parser = argparse.ArgumentParser(usage=("%(prog)s [ get | stats | index | groups | streams | query | insights ]"))
     parser.add_argument("--version", action="version",
                         version="%(prog)s " + __version__)
 
@@ -58,6 +112,58 @@ def main(argv=None):
                                 dest="query",
                                 help="JMESPath query to use in filtering the response data")
 
+        parser.add_argument("--where",
+                            action="store",
+                            dest="where",
+                            help=("JMESPath expression; only JSON events for "
+                                  "which it is true are shown. Equality "
+                                  "conditions are also sent to CloudWatch "
+                                  "as a filter pattern"))
+
+        parser.add_argument("--output-format",
+                            choices=OUTPUT_FORMATS,
+                            dest="output_format",
+                            default='text',
+                            help=("Output format: text, JSON lines, CSV or Parquet (needs pyarrow) "
+                                  "(default %(default)s)"))
+
+        parser.add_argument("--fields",
+                            type=fields,
+                            dest="fields",
+                            help=("Comma separated event fields for jsonl, csv and parquet output "
+                                  "(default {0})".format(','.join(DEFAULT_FIELDS))))
+
+        parser.add_argument("-o",
+                            "--output-file",
+                            dest="output_file",
+                            help=("Write the output to this file instead of stdout. A .gz or .zst "
+                                  "extension selects the compression"))
+
+        parser.add_argument("--compression",
+                            choices=COMPRESSIONS,
+                            dest="compression",
+                            help=("Compression of --output-file, done in a background thread; "
+                                  "zstd needs zstandard"))
+
+        parser.add_argument("--rotate-size",
+                            type=size,
+                            dest="rotate_size",
+                            help=("Start a new --output-file after about this much "
+                                  "uncompressed output, e.g. 100MB"))
+
+        parser.add_argument("--rotate-interval",
+                            type=interval,
+                            dest="rotate_interval",
+                            help=("Start a new --output-file for every interval of event "
+                                  "time, e.g. 1h"))
+
+        parser.add_argument("--workers",
+                            type=int,
+                            dest="workers",
+                            default=1,
+                            help=("Number of processes decoding and formatting "
+                                  "events; ignored with --watch (default %(default)s)"))
+
     def add_watch_argument(parser):
         parser.add_argument("-w",
                             "--watch",
@@ -66,6 +172,81 @@ def main(argv=None):
                             help="Query for new log lines constantly")
 
 
+    def add_fetch_arguments(parser):
+        parser.add_argument("--pipeline",
+                            type=int,
+                            nargs='?',
+                            const=DEFAULT_PIPELINE_BATCHES,
+                            dest='pipeline',
+                            metavar='BATCHES',
+                            help=("Fetch the events of every page of streams as soon as it is "
+                                  "listed, with up to BATCHES pages fetched at once (default {0}). "
+                                  "Events are only ordered within a page; ignored with "
+                                  "--watch".format(DEFAULT_PIPELINE_BATCHES)))
+
+        parser.add_argument("--concurrency",
+                            type=int,
+                            dest='concurrency',
+                            default=1,
+                            help="Number of stream shards to fetch in parallel (default %(default)s)")
+
+        parser.add_argument("--time-partitions",
+                            type=int,
+                            dest='time_partitions',
+                            default=1,
+                            help=("Number of time windows to fetch in parallel. Windows are sized "
+                                  "by stream activity (default %(default)s)"))
+
+        parser.add_argument("--max-in-flight",
+                            type=int,
+                            dest='max_in_flight',
+                            help=("Request the pages of every cursor on a shared pool "
+                                  "of this many threads instead of a thread per cursor"))
+
+        parser.add_argument("--reorder-window",
+                            type=reorder_window,
+                            dest='reorder_window',
+                            help=("Re-sort events arriving out of order within this window: "
+                                  "a duration such as 500ms, 5s or 1m, or a number of events"))
+
+    def add_cache_arguments(parser):
+        parser.add_argument("--cache",
+                            action='store_true',
+                            dest='cache',
+                            help=("Cache fetched events and group/stream listings on disk. "
+                                  "Also enabled by setting AWSLOGS_CACHE"))
+
+        parser.add_argument("--no-cache",
+                            action='store_false',
+                            dest='cache',
+                            help="Do not read or write the cache")
+
+        parser.add_argument("--cache-dir",
+                            dest='cache_dir',
+                            default=os.environ.get('AWSLOGS_CACHE_DIR', None),
+                            help="Cache directory (default ~/.cache/awslogs)")
+
+        parser.add_argument("--cache-max-size",
+                            type=int,
+                            dest='cache_max_size',
+                            default=512,
+                            help="Maximum cache size in MB (default %(default)s)")
+
+        parser.add_argument("--cache-ttl",
+                            type=int,
+                            dest='cache_ttl',
+                            default=300,
+                            help="Seconds before cached group and stream listings are refreshed (default %(default)s)")
+
+        parser.set_defaults(cache=bool(os.environ.get('AWSLOGS_CACHE')))
+
+    def add_index_argument(parser):
+        parser.add_argument("--index",
+                            action='store_true',
+                            dest='index',
+                            help=("Search the events stored by 'awslogs index' when they cover "
+                                  "the group, prefix and time range, instead of CloudWatch"))
+
     def add_common_arguments(parser):
         parser.add_argument("--aws-access-key-id",
                             dest="aws_access_key_id",
@@ -97,6 +278,19 @@ def main(argv=None):
                             default=os.environ.get('AWS_REGION', None),
                             help="aws region")
 
+        parser.add_argument("--endpoint-url",
+                            dest="endpoint_url",
+                            type=str,
+                            default=os.environ.get('AWSLOGS_ENDPOINT_URL', None),
+                            help="CloudWatch Logs endpoint, e.g. a local stub for testing")
+
+        parser.add_argument("--rate-limit",
+                            dest="rate_limit",
+                            type=float,
+                            default=DEFAULT_RATE,
+                            help=("Initial API requests per second, shared by all requests. "
+                                  "Adapts to throttling (default %(default)s)"))
+
     def add_date_range_arguments(parser, default_start='5m'):
         parser.add_argument("-s", "--start",
                             type=str,
@@ -119,7 +313,9 @@ def main(argv=None):
 
     get_parser.add_argument("log_group_name",
                             type=str,
-                            help="log group name")
+                            help=("log group name. Several groups can be given separated "
+                                  "by commas; a name ending in * selects every group "
+                                  "with that prefix"))
 
     get_parser.add_argument("log_stream_prefix",
                             type=str,
@@ -133,15 +329,86 @@ def main(argv=None):
                                   "provided, all the events are matched."))
 
     add_watch_argument(get_parser)
+    add_fetch_arguments(get_parser)
+    add_cache_arguments(get_parser)
+    add_index_argument(get_parser)
     add_output_arguments(get_parser)
     add_date_range_arguments(get_parser)
 
 
 
+    # stats
+    stats_parser = subparsers.add_parser('stats', description='Aggregate logs')
+    stats_parser.set_defaults(func="list_stats")
+    add_common_arguments(stats_parser)
+
+    stats_parser.add_argument("log_group_name",
+                              type=str,
+                              help=("log group name; several can be separated by commas, and a "
+                                    "name ending in * stands for every group with that prefix"))
+
+    stats_parser.add_argument("log_stream_prefix",
+                              type=str,
+                              help="log stream prefix")
+
+    stats_parser.add_argument("-f",
+                              "--filter-pattern",
+                              dest='filter_pattern',
+                              help="A valid CloudWatch Logs filter pattern")
+
+    stats_parser.add_argument("--where",
+                              dest="where",
+                              help="JMESPath expression; only JSON events for which it is true are counted")
+
+    stats_parser.add_argument("--by",
+                              dest="stats_by",
+                              help="JMESPath expression grouping JSON events, e.g. status")
+
+    stats_parser.add_argument("--value",
+                              dest="stats_value",
+                              help=("JMESPath expression of a number to summarise with percentiles, "
+                                    "e.g. latency"))
+
+    stats_parser.add_argument("--bucket",
+                              type=interval,
+                              dest="stats_bucket",
+                              help="Also count the events per time bucket, e.g. 1m")
+
+    stats_parser.add_argument("--percentiles",
+                              type=percentiles,
+                              dest="percentiles",
+                              default=DEFAULT_PERCENTILES,
+                              help="Comma separated percentiles of --value (default {0})".format(
+                                  ','.join(str(p) for p in DEFAULT_PERCENTILES)))
+
+    add_fetch_arguments(stats_parser)
+    add_cache_arguments(stats_parser)
+    add_index_argument(stats_parser)
+    add_date_range_arguments(stats_parser)
+
+    # index
+    index_parser = subparsers.add_parser('index', description='Download logs into a local index')
+    index_parser.set_defaults(func="index_logs")
+    add_common_arguments(index_parser)
+
+    index_parser.add_argument("log_group_name",
+                              type=str,
+                              help=("log group name; several can be separated by commas, and a "
+                                    "name ending in * stands for every group with that prefix"))
+
+    index_parser.add_argument("log_stream_prefix",
+                              type=str,
+                              help="log stream prefix")
+
+    add_fetch_arguments(index_parser)
+    add_cache_arguments(index_parser)
+    add_date_range_arguments(index_parser, default_start='1h')
+
     # groups
     groups_parser = subparsers.add_parser('groups', description='List groups')
     groups_parser.set_defaults(func="list_groups")
     add_common_arguments(groups_parser)
+    add_cache_arguments(groups_parser)
 
     groups_parser.add_argument("-p",
                                "--log-group-prefix",
@@ -153,6 +420,7 @@ def main(argv=None):
     streams_parser = subparsers.add_parser('streams', description='List streams')
     streams_parser.set_defaults(func="list_streams")
     add_common_arguments(streams_parser)
+    add_cache_arguments(streams_parser)
     add_date_range_arguments(streams_parser, default_start='1h')
 
     streams_parser.add_argument("log_group_name",
@@ -175,8 +443,33 @@ def main(argv=None):
     add_common_arguments(query_parser)
     add_output_arguments(query_parser)
     add_watch_argument(query_parser)
+    add_fetch_arguments(query_parser)
+    add_cache_arguments(query_parser)
+    add_index_argument(query_parser)
     add_date_range_arguments(query_parser, default_start='1h')
 
+    # insights
+    insights_parser = subparsers.add_parser('insights', description='Run a Logs Insights query')
+    insights_parser.set_defaults(func="insights")
+    add_common_arguments(insights_parser)
+    add_cache_arguments(insights_parser)
+    add_output_arguments(insights_parser)
+    add_date_range_arguments(insights_parser, default_start='1h')
+
+    insights_parser.add_argument("log_group_name",
+                                 type=str,
+                                 help=("log group name; several can be separated by commas, and a "
+                                       "name ending in * stands for every group with that prefix"))
+
+    insights_parser.add_argument("insights_query",
+                                 type=str,
+                                 help="Logs Insights query, e.g. 'stats count(*) by status'")
+
+    insights_parser.add_argument("--limit",
+                                 type=int,
+                                 dest="insights_limit",
+                                 help="Maximum number of result rows (CloudWatch default 1000, at most 10000)")
+
     # Parse input
     options, args = parser.parse_known_args(argv)
 
@@ -198,6 +491,11 @@ def main(argv=None):
             hint = exc.response['Error'].get('Message', 'AccessDeniedException')
             sys.stderr.write(colored("{0}\n".format(hint), "yellow"))
             return 4
+        if code in THROTTLING_ERROR_CODES:
+            hint = ("Requests are still being throttled after retrying. "
+                    "Try a lower --rate-limit or --concurrency.")
+            sys.stderr.write(colored("{0}\n".format(hint), "yellow"))
+            return 5
         raise
     except exceptions.BaseAWSLogsException as exc:
         sys.stderr.write(colored("{0}\n".format(exc.hint()), "red"))
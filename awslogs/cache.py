@@ -0,0 +1,403 @@
+import os
+import time
+import errno
+import sqlite3
+import threading
+
+from .pipeline import batches, merge_by_timestamp
+
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'awslogs'
+)
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+# Events are cached per (group, stream, filter pattern, bucket).
+BUCKET_SIZE = 10 * 60 * 1000
+
+# Buckets which ended less than this long ago (ms) may still receive late
+# events, so they are always fetched remotely.
+SETTLE_TIME = 30 * 60 * 1000
+
+READ_BATCH_SIZE = 5000
+
+# Rough per-event overhead in bytes on top of the message itself.
+EVENT_OVERHEAD = 100
+
+# Segment ids bound per statement; SQLite allows 999 variables before 3.32.
+MAX_SQL_VARIABLES = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    log_group TEXT NOT NULL,
+    log_stream TEXT NOT NULL,
+    filter_pattern TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL DEFAULT 0,
+    accessed REAL NOT NULL,
+    UNIQUE (log_group, log_stream, filter_pattern, bucket)
+);
+CREATE TABLE IF NOT EXISTS events (
+    segment INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    ingestion_time INTEGER,
+    event_id TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_by_segment ON events (segment, timestamp);
+"""
+
+
+def _ensure_dir(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class EventCache(object):
+    """On-disk SQLite cache of fetched events.
+
+    Events are stored in segments, one per group, stream, filter pattern
+    and ``BUCKET_SIZE`` bucket. Only settled buckets are cached, and least
+    recently used segments are evicted once the cache grows past
+    ``max_size`` bytes.
+    """
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE, clock=time.time):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.max_size = max_size
+        self.clock = clock
+        _ensure_dir(self.cache_dir)
+        self.db = sqlite3.connect(os.path.join(self.cache_dir, 'events.sqlite'),
+                                  check_same_thread=False,
+                                  isolation_level=None)
+        self.lock = threading.RLock()
+        with self.lock:
+            self.db.executescript(SCHEMA)
+
+    def buckets(self, start_time, end_time):
+        """Splits ``[start_time, end_time]`` into ``(start, end, bucket)`` ranges.
+
+        ``bucket`` is set for whole, settled buckets which can be cached and
+        ``None`` for the partial or recent ranges around them. ``end_time``
+        may be ``None`` for an open range.
+        """
+        settled = int(self.clock() * 1000) - SETTLE_TIME
+        last = end_time if end_time is not None else settled
+        first_bucket = -(-start_time // BUCKET_SIZE) * BUCKET_SIZE
+
+        ranges = []
+        bucket = first_bucket
+        while bucket + BUCKET_SIZE - 1 <= last and bucket + BUCKET_SIZE <= settled:
+            ranges.append((bucket, bucket + BUCKET_SIZE - 1, bucket))
+            bucket += BUCKET_SIZE
+
+        if not ranges:
+            return [(start_time, end_time, None)]
+        if start_time < first_bucket:
+            ranges.insert(0, (start_time, first_bucket - 1, None))
+        if end_time is None or bucket <= end_time:
+            ranges.append((bucket, end_time, None))
+        return ranges
+
+    def cached_streams(self, log_group_name, log_streams, filter_pattern, bucket):
+        """Returns the subset of ``log_streams`` with a complete segment for ``bucket``."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT log_stream FROM segments WHERE log_group = ? AND filter_pattern = ? "
+                "AND bucket = ? AND complete = 1",
+                (log_group_name, filter_pattern or '', bucket)
+            ).fetchall()
+        cached = set(row[0] for row in rows)
+        return [stream for stream in log_streams if stream in cached]
+
+    def read(self, log_group_name, log_streams, filter_pattern, bucket):
+        """Yields the cached events of ``log_streams`` in ``bucket`` ordered by timestamp."""
+        with self.lock:
+            segments = self.__segment_ids(log_group_name, log_streams, filter_pattern, bucket)
+            accessed = self.clock()
+            for ids in batches(segments, MAX_SQL_VARIABLES):
+                self.db.execute(
+                    "UPDATE segments SET accessed = ? WHERE id IN ({0})".format(','.join('?' * len(ids))),
+                    [accessed] + ids
+                )
+        return merge_by_timestamp([self.__read_segments(segments, ids)
+                                   for ids in batches(segments, MAX_SQL_VARIABLES)])
+
+    def __read_segments(self, segments, ids):
+        placeholders = ','.join('?' * len(ids))
+        last = (-1, -1)
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    "SELECT rowid, segment, timestamp, ingestion_time, event_id, message "
+                    "FROM events WHERE segment IN ({0}) AND (timestamp > ? OR "
+                    "(timestamp = ? AND rowid > ?)) ORDER BY timestamp, rowid LIMIT ?".format(placeholders),
+                    ids + [last[0], last[0], last[1], READ_BATCH_SIZE]
+                ).fetchall()
+            for rowid, segment, timestamp, ingestion_time, event_id, message in rows:
+                yield {'eventId': event_id,
+                       'timestamp': timestamp,
+                       'ingestionTime': ingestion_time,
+                       'message': message,
+                       'logStreamName': segments[segment]}
+            if len(rows) < READ_BATCH_SIZE:
+                return
+            last = (rows[-1][2], rows[-1][0])
+
+    def store(self, log_group_name, log_streams, filter_pattern, bucket, events):
+        """Writes ``events`` for ``log_streams`` in ``bucket`` through to the cache.
+
+        Yields every event unchanged. The segments are marked complete, and
+        so become readable, only once ``events`` is exhausted.
+        """
+        with self.lock:
+            self.db.execute("BEGIN")
+            for stream in log_streams:
+                self.db.execute(
+                    "INSERT OR IGNORE INTO segments (log_group, log_stream, filter_pattern, bucket, accessed) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (log_group_name, stream, filter_pattern or '', bucket, self.clock())
+                )
+            segments = self.__segment_ids(log_group_name, log_streams, filter_pattern, bucket)
+            for ids in batches(segments, MAX_SQL_VARIABLES):
+                placeholders = ','.join('?' * len(ids))
+                self.db.execute("DELETE FROM events WHERE segment IN ({0})".format(placeholders), ids)
+                self.db.execute("UPDATE segments SET complete = 0, size = 0 WHERE id IN ({0})".format(
+                    placeholders), ids)
+            self.db.execute("COMMIT")
+
+        by_stream = dict((stream, segment) for segment, stream in segments.items())
+        sizes = dict((segment, 0) for segment in segments)
+        pending = []
+        for event in events:
+            segment = by_stream.get(event['logStreamName'])
+            if segment is not None:
+                sizes[segment] += len(event['message']) + EVENT_OVERHEAD
+                pending.append((segment, event['timestamp'], event.get('ingestionTime'),
+                                event['eventId'], event['message']))
+                if len(pending) >= READ_BATCH_SIZE:
+                    self.__insert_batch(pending)
+                    pending = []
+            yield event
+
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.__insert(pending)
+            for segment, size in sizes.items():
+                self.db.execute("UPDATE segments SET complete = 1, size = ? WHERE id = ?", (size, segment))
+            self.db.execute("COMMIT")
+            self.evict()
+
+    def evict(self):
+        """Drops least recently used segments until the cache fits ``max_size``."""
+        with self.lock:
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM segments").fetchone()[0]
+            if total <= self.max_size:
+                return
+            self.db.execute("BEGIN")
+            rows = self.db.execute("SELECT id, size FROM segments ORDER BY accessed, id").fetchall()
+            for segment, size in rows:
+                if total <= self.max_size:
+                    break
+                self.db.execute("DELETE FROM events WHERE segment = ?", (segment,))
+                self.db.execute("DELETE FROM segments WHERE id = ?", (segment,))
+                total -= size
+            self.db.execute("COMMIT")
+
+    def __insert_batch(self, rows):
+        """Inserts ``rows`` in one transaction; in autocommit mode every row
+        would otherwise be committed, and synced, on its own."""
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.__insert(rows)
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def __insert(self, rows):
+        with self.lock:
+            self.db.executemany(
+                "INSERT INTO events (segment, timestamp, ingestion_time, event_id, message) "
+                "VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    def __segment_ids(self, log_group_name, log_streams, filter_pattern, bucket):
+        """Returns ``{segment id: stream}`` for the existing segments of ``log_streams``."""
+        wanted = set(log_streams)
+        rows = self.db.execute(
+            "SELECT id, log_stream FROM segments WHERE log_group = ? AND filter_pattern = ? AND bucket = ?",
+            (log_group_name, filter_pattern or '', bucket)
+        ).fetchall()
+        return dict((segment, stream) for segment, stream in rows if stream in wanted)
+
+
+DEFAULT_METADATA_TTL = 300
+
+# lastEventTimestamp is updated lazily by CloudWatch, up to an hour late.
+LAST_EVENT_TIMESTAMP_LAG = 60 * 60 * 1000
+
+# Incremental refreshes miss deleted and new empty streams, so listings are
+# fully refreshed once they are this old (seconds).
+FULL_REFRESH_AGE = 24 * 60 * 60
+
+METADATA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    kind TEXT NOT NULL,
+    log_group TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    refreshed REAL NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (kind, log_group, prefix)
+);
+CREATE TABLE IF NOT EXISTS streams (
+    log_group TEXT NOT NULL,
+    log_stream TEXT NOT NULL,
+    first_event INTEGER,
+    last_event INTEGER,
+    PRIMARY KEY (log_group, log_stream)
+);
+CREATE TABLE IF NOT EXISTS groups (
+    prefix TEXT NOT NULL,
+    log_group TEXT NOT NULL,
+    PRIMARY KEY (prefix, log_group)
+);
+"""
+
+
+class MetadataCache(object):
+    """On-disk SQLite cache of ``describe_log_streams`` and
+    ``describe_log_groups`` listings.
+
+    Listings younger than ``ttl`` seconds are served from disk. Older stream
+    listings of a whole group are refreshed incrementally, reading streams
+    by descending ``LastEventTime`` only until the previous refresh.
+    """
+
+    def __init__(self, cache_dir=None, ttl=DEFAULT_METADATA_TTL, clock=time.time):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.ttl = ttl
+        self.clock = clock
+        _ensure_dir(self.cache_dir)
+        self.db = sqlite3.connect(os.path.join(self.cache_dir, 'metadata.sqlite'),
+                                  check_same_thread=False,
+                                  isolation_level=None)
+        self.lock = threading.RLock()
+        with self.lock:
+            self.db.executescript(METADATA_SCHEMA)
+
+    def streams(self, log_group_name, log_stream_prefix, describe):
+        """Returns the descriptions of the streams in ``log_group_name``
+        starting with ``log_stream_prefix``.
+
+        ``describe`` is called with ``describe_log_streams`` arguments and
+        yields stream descriptions; it is only used when the listing is stale.
+        """
+        prefix = log_stream_prefix or ''
+        now = self.clock()
+        with self.lock:
+            listing = self.__freshest_listing(log_group_name, prefix)
+            if listing is None or now - listing[1] > self.ttl:
+                exact = listing is not None and listing[0] == prefix
+                if exact and not prefix and now - listing[2] < FULL_REFRESH_AGE:
+                    self.__refresh_streams_incrementally(log_group_name, listing[1], describe)
+                else:
+                    self.__refresh_streams(log_group_name, prefix, describe)
+            rows = self.db.execute(
+                "SELECT log_stream, first_event, last_event FROM streams "
+                "WHERE log_group = ? AND substr(log_stream, 1, ?) = ? ORDER BY log_stream",
+                (log_group_name, len(prefix), prefix)
+            ).fetchall()
+
+        for log_stream, first_event, last_event in rows:
+            stream = {'logStreamName': log_stream}
+            if first_event is not None:
+                stream['firstEventTimestamp'] = first_event
+                stream['lastEventTimestamp'] = last_event
+            yield stream
+
+    def groups(self, log_group_prefix, describe):
+        """Returns the names of the groups starting with ``log_group_prefix``.
+
+        ``describe`` is called with ``describe_log_groups`` arguments and
+        yields group names; it is only used when the listing is stale.
+        """
+        prefix = log_group_prefix or ''
+        now = self.clock()
+        with self.lock:
+            listing = self.db.execute(
+                "SELECT refreshed FROM listings WHERE kind = 'groups' AND log_group = '' AND prefix = ?",
+                (prefix,)
+            ).fetchone()
+            if listing is None or now - listing[0] > self.ttl:
+                kwargs = {'logGroupNamePrefix': prefix} if prefix else {}
+                names = list(describe(**kwargs))
+                self.db.execute("BEGIN")
+                self.db.execute("DELETE FROM groups WHERE prefix = ?", (prefix,))
+                self.db.executemany("INSERT OR IGNORE INTO groups (prefix, log_group) VALUES (?, ?)",
+                                    [(prefix, name) for name in names])
+                self.__save_listing('groups', '', prefix, now, now)
+                self.db.execute("COMMIT")
+            rows = self.db.execute("SELECT log_group FROM groups WHERE prefix = ? ORDER BY log_group",
+                                   (prefix,)).fetchall()
+        return [row[0] for row in rows]
+
+    def __freshest_listing(self, log_group_name, prefix):
+        """Returns ``(prefix, refreshed, created)`` of the most recent stream
+        listing which covers ``prefix``."""
+        rows = self.db.execute(
+            "SELECT prefix, refreshed, created FROM listings WHERE kind = 'streams' AND log_group = ?",
+            (log_group_name,)
+        ).fetchall()
+        covering = [row for row in rows if prefix.startswith(row[0])]
+        if not covering:
+            return None
+        return max(covering, key=lambda row: (row[1], len(row[0])))
+
+    def __refresh_streams(self, log_group_name, prefix, describe):
+        kwargs = {'logGroupName': log_group_name}
+        if prefix:
+            kwargs['logStreamNamePrefix'] = prefix
+        now = self.clock()
+        streams = list(describe(**kwargs))
+        self.db.execute("BEGIN")
+        self.db.execute("DELETE FROM streams WHERE log_group = ? AND substr(log_stream, 1, ?) = ?",
+                        (log_group_name, len(prefix), prefix))
+        self.__upsert_streams(log_group_name, streams)
+        self.__save_listing('streams', log_group_name, prefix, now, now)
+        self.db.execute("COMMIT")
+
+    def __refresh_streams_incrementally(self, log_group_name, refreshed, describe):
+        now = self.clock()
+        since = int(refreshed * 1000) - LAST_EVENT_TIMESTAMP_LAG
+        streams = []
+        for stream in describe(logGroupName=log_group_name, orderBy='LastEventTime', descending=True):
+            if stream.get('lastEventTimestamp', 0) < since:
+                break
+            streams.append(stream)
+        self.db.execute("BEGIN")
+        self.__upsert_streams(log_group_name, streams)
+        self.db.execute("UPDATE listings SET refreshed = ? WHERE kind = 'streams' AND log_group = ? AND prefix = ''",
+                        (now, log_group_name))
+        self.db.execute("COMMIT")
+
+    def __upsert_streams(self, log_group_name, streams):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO streams (log_group, log_stream, first_event, last_event) VALUES (?, ?, ?, ?)",
+            [(log_group_name, s['logStreamName'], s.get('firstEventTimestamp'), s.get('lastEventTimestamp'))
+             for s in streams]
+        )
+
+    def __save_listing(self, kind, log_group_name, prefix, refreshed, created):
+        self.db.execute(
+            "INSERT OR REPLACE INTO listings (kind, log_group, prefix, refreshed, created) VALUES (?, ?, ?, ?, ?)",
+            (kind, log_group_name, prefix, refreshed, created)
+        )
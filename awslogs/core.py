@@ -3,14 +3,27 @@ import sys
 import os
 import time
 import errno
+import threading
 import yaml
 import pystache
 from datetime import datetime, timedelta
+from functools import partial
+from itertools import chain
 from collections import deque
 from termcolor import colored
-from .awsloggenerator import AWSLogGenerator
-from .logprinter import LogPrinter
+from .awsloggenerator import AWSLogGenerator, MultiGroupLogGenerator, PipelinedLogGenerator
+from .logprinter import LogPrinter, milis2iso
+from .workers import ParallelLogPrinter
+from .outputfile import OutputFiles
 from .querytemplate import QueryTemplate
+from .query import pushdown_filter_pattern
+from .insights import InsightsQuery, stream_filter
+from .stats import Aggregator, StatsPrinter, DEFAULT_PERCENTILES
+from .index import EventIndex, IndexedLogGenerator, compile_filter
+from .cache import EventCache, MetadataCache, DEFAULT_METADATA_TTL
+from .scheduler import CursorScheduler
+from .pipeline import ReorderWindow, batches
+from .ratelimit import RateLimiter, DEFAULT_RATE
 
 
 import boto3
@@ -22,16 +35,19 @@ from dateutil.tz import tzutc
 
 from . import exceptions
 
+# Streams per page of describe_log_streams, and so per pipelined batch.
+PIPELINE_BATCH_SIZE = 50
+
+
 class AWSLogs(object):
 
-    FILTER_LOG_EVENTS_STREAMS_LIMIT = 100
     MAX_EVENTS_PER_CALL = 10000
 
     # TODO separate out the required options for each subcommand
     def __init__(self, **kwargs):
         valid_output_options = ('color_enabled', 'output_stream_enabled', 'output_group_enabled',
                           'output_timestamp_enabled', 'output_ingestion_time_enabled',
-                          'query')
+                          'query', 'where', 'watch', 'output_format', 'fields')
 
         self.output_options = {k:v for k, v in kwargs.iteritems() if k in valid_output_options}
         self.aws_region = kwargs.get('aws_region')
@@ -42,13 +58,42 @@ class AWSLogs(object):
         self.log_stream_prefix = kwargs.get('log_stream_prefix')
         self.filter_pattern = kwargs.get('filter_pattern')
         self.watch = kwargs.get('watch')
-        if self.watch:
-            sys.stderr.write(colored("Watch flag is currently broken! "
-                             "You'll see new logs displayed to the console, "
-                             "but they will be stale.\n", "yellow"))
         self.start = self.parse_datetime(kwargs.get('start'))
         self.end = self.parse_datetime(kwargs.get('end'))
         self.query = kwargs.get('query')
+        self.where = kwargs.get('where')
+        self.concurrency = kwargs.get('concurrency')
+        self.time_partitions = kwargs.get('time_partitions')
+        self.workers = kwargs.get('workers')
+        self.pipeline = kwargs.get('pipeline')
+        self.insights_query = kwargs.get('insights_query')
+        self.insights_limit = kwargs.get('insights_limit')
+        self.stats_options = dict((k, kwargs.get(k)) for k in
+                                  ('stats_by', 'stats_value', 'stats_bucket', 'percentiles'))
+        self.stats = None
+        # Threads other than this one report progress to stderr.
+        self.main_thread = threading.current_thread()
+        self.rate_limiter = RateLimiter(kwargs.get('rate_limit') or DEFAULT_RATE)
+        self.reorder_window = None
+        if kwargs.get('reorder_window'):
+            self.reorder_window = ReorderWindow(*kwargs.get('reorder_window'))
+        if kwargs.get('output_file'):
+            self.output_options['output_files'] = OutputFiles(
+                kwargs.get('output_file'), kwargs.get('compression'),
+                kwargs.get('rotate_size'), kwargs.get('rotate_interval'))
+        self.scheduler = None
+        if kwargs.get('max_in_flight'):
+            self.scheduler = CursorScheduler(kwargs.get('max_in_flight'))
+        self.event_cache = None
+        self.metadata_cache = None
+        if kwargs.get('cache'):
+            self.event_cache = EventCache(kwargs.get('cache_dir'),
+                                          (kwargs.get('cache_max_size') or 512) * 1024 * 1024)
+            self.metadata_cache = MetadataCache(kwargs.get('cache_dir'),
+                                                kwargs.get('cache_ttl') or DEFAULT_METADATA_TTL)
+        self.event_index = None
+        if kwargs.get('index') or kwargs.get('func') == 'index_logs':
+            self.event_index = EventIndex(kwargs.get('cache_dir'))
         self.query_template_file = kwargs.get('query_template_file')
         self.query_template_args = kwargs.get('args')
 
@@ -58,36 +103,197 @@ class AWSLogs(object):
             aws_access_key_id=self.aws_access_key_id,
             aws_secret_access_key=self.aws_secret_access_key,
             aws_session_token=self.aws_session_token,
-            region_name=self.aws_region
+            region_name=self.aws_region,
+            endpoint_url=kwargs.get('endpoint_url')
         )
 
     def list_logs(self):
-        streams = list(self.get_streams(self.log_group_name, self.log_stream_prefix))
-        if len(streams) > self.FILTER_LOG_EVENTS_STREAMS_LIMIT:
-            raise exceptions.TooManyStreamsFilteredError(
-                 self.log_stream_name,
-                 len(streams),
-                 self.FILTER_LOG_EVENTS_STREAMS_LIMIT
-            )
-        elif len(streams) == 0:
+        log_group_names = self.log_group_names()
+        indexed_generators = [self.indexed_generator(log_group_name, self.log_stream_prefix, self.start,
+                                                     self.filter_pattern)
+                              for log_group_name in log_group_names]
+        # Groups served by the index are merged with the others unpipelined.
+        if self.pipeline and not self.watch and not any(indexed_generators):
+            return self.print_pipelined(log_group_names, self.log_stream_prefix,
+                                        self.start, self.pushdown(self.filter_pattern))
+        generators = []
+        max_stream_length = 0
+        for log_group_name, indexed in zip(log_group_names, indexed_generators):
+            if indexed is not None:
+                generators.append(indexed)
+                max_stream_length = max(max_stream_length, self.event_index.max_stream_length(
+                    log_group_name, self.log_stream_prefix, indexed.start_time, indexed.end_time))
+                continue
+            descriptions = list(self.describe_streams(log_group_name, self.log_stream_prefix))
+            streams = [s['logStreamName'] for s in descriptions]
+            if not streams:
+                continue
+            generators.append(self.log_generator(log_group_name, streams, descriptions,
+                                                 self.start, self.pushdown(self.filter_pattern),
+                                                 log_stream_prefix=self.log_stream_prefix))
+            max_stream_length = max([max_stream_length] + [len(s) for s in streams])
+        if not generators:
             raise exceptions.NoStreamsFilteredError(self.log_stream_prefix)
 
+        if len(generators) == 1:
+            aws_log_generator = generators[0]
+            log_printer = self.log_printer(aws_log_generator.log_group_name, max_stream_length)
+        else:
+            aws_log_generator = MultiGroupLogGenerator(generators, watch=self.watch,
+                                                       end_time=self.end, scheduler=self.scheduler)
+            log_printer = self.log_printer(None, max_stream_length,
+                                           max_group_length=max(len(g.log_group_name) for g in generators))
+        self.get_and_print_logs(aws_log_generator, log_printer)
+
+    def list_stats(self):
+        """Fetches the events like ``list_logs`` but prints aggregates of them."""
+        self.stats = Aggregator(by=self.stats_options['stats_by'],
+                                value=self.stats_options['stats_value'],
+                                bucket_ms=self.stats_options['stats_bucket'],
+                                where=self.where)
+        self.list_logs()
+
+    def indexed_generator(self, log_group_name, log_stream_prefix, start_time, filter_pattern):
+        """Returns a generator searching the local index, if ``--index`` was
+        given and the index covers the window and can evaluate ``filter_pattern``."""
+        if self.event_index is None or self.watch:
+            return None
+        local_filter = compile_filter(filter_pattern)
+        if local_filter is None:
+            return None
+        end = self.event_index.window(log_group_name, log_stream_prefix, start_time, self.end)
+        if end is None:
+            return None
+        end_time = self.end if self.end is not None else end
+        self.status('Searching the local index of group {0} up to {1}'.format(
+            log_group_name, milis2iso(end_time)))
+        return IndexedLogGenerator(self.event_index, log_group_name, log_stream_prefix,
+                                   start_time, end_time, local_filter)
+
+    def index_logs(self):
+        """Downloads every event of the window into the local index."""
+        for log_group_name in self.log_group_names():
+            descriptions = list(self.describe_streams(log_group_name, self.log_stream_prefix))
+            streams = [s['logStreamName'] for s in descriptions]
+            generator = self.log_generator(log_group_name, streams, descriptions, self.start, None)
+            count = self.event_index.add(log_group_name, self.log_stream_prefix, self.start, self.end,
+                                         generator.generate_logs(self.client) if streams else [])
+            self.status('Indexed {0} events of group {1}'.format(count, log_group_name))
+        self.report()
+
+    def log_group_names(self):
+        """Returns the groups named by the comma separated ``log_group_name``;
+        names ending in ``*`` are expanded to the groups with that prefix."""
+        names = []
+        for name in self.log_group_name.split(','):
+            name = name.strip()
+            if name.endswith('*'):
+                matching = list(self.get_groups(name[:-1]))
+            else:
+                matching = [name] if name else []
+            names.extend(n for n in matching if n not in names)
+        if not names:
+            raise exceptions.AWSLogsException(
+                "No log groups match '{0}'.".format(self.log_group_name))
+        return names
 
+    def print_pipelined(self, log_group_names, log_stream_prefix, start_time, filter_pattern):
+        """Prints the events of every batch of streams as soon as the batch
+        is discovered, fetching up to ``pipeline`` batches at once.
+
+        Only the first batch is described before printing starts; later
+        batches are described while the earlier ones are being fetched.
+        """
+        generators = (self.log_generator(log_group_name, [s['logStreamName'] for s in batch], batch,
+                                         start_time, filter_pattern, reorder=False)
+                      for log_group_name in log_group_names
+                      for batch in batches(self.describe_streams(log_group_name, log_stream_prefix),
+                                           PIPELINE_BATCH_SIZE))
+        try:
+            first = next(generators)
+        except StopIteration:
+            raise exceptions.NoStreamsFilteredError(log_stream_prefix)
+        aws_log_generator = PipelinedLogGenerator(chain([first], generators), self.pipeline,
+                                                  tag_groups=len(log_group_names) > 1,
+                                                  reorder_window=self.reorder_window)
+        # Streams of later batches may have longer names and are not padded.
+        max_stream_length = max(len(s) for s in first.log_streams)
+        if len(log_group_names) == 1:
+            log_printer = self.log_printer(log_group_names[0], max_stream_length)
+        else:
+            log_printer = self.log_printer(None, max_stream_length,
+                                           max_group_length=max(len(n) for n in log_group_names))
+        self.get_and_print_logs(aws_log_generator, log_printer)
+
+    def log_generator(self, log_group_name, streams, descriptions, start_time, filter_pattern,
+                      reorder=True, log_stream_prefix=None):
+        """Returns the generator fetching ``streams``; when tailing, the streams
+        with ``log_stream_prefix`` are listed again to pick up new ones."""
+        list_streams = None
+        if self.watch and log_stream_prefix is not None:
+            list_streams = partial(self.stream_names, log_group_name, log_stream_prefix)
         # Note: filter_log_events paginator is broken
         # ! Error during pagination: The same next token was received twice
-        do_wait = object()
-        aws_log_generator = AWSLogGenerator(log_group_name=self.log_group_name,
-                                            log_streams=streams,
-                                            start_time=self.start,
-                                            filter_pattern=self.filter_pattern) # TODO add end time
+        return AWSLogGenerator(watch=self.watch,
+                               log_group_name=log_group_name,
+                               log_streams=streams,
+                               start_time=start_time,
+                               end_time=self.end,
+                               filter_pattern=filter_pattern,
+                               concurrency=self.concurrency,
+                               time_partitions=self.time_partitions,
+                               stream_ranges=self.stream_ranges(descriptions),
+                               event_cache=self.event_cache,
+                               scheduler=self.scheduler,
+                               rate_limiter=self.rate_limiter,
+                               reorder_window=self.reorder_window if reorder else None,
+                               list_streams=list_streams)
 
-        max_stream_length = max([len(s) for s in streams]) if streams else 10
-        log_printer = LogPrinter(self.log_group_name, max_stream_length, **self.output_options)
+    def log_printer(self, log_group_name, max_stream_length, **kwargs):
+        """Returns the printer for events from ``log_group_name``; tailed
+        output is formatted in-process to keep the latency low. ``kwargs``
+        override the output options."""
+        kwargs = dict(self.output_options, **kwargs)
+        if self.stats is not None:
+            return StatsPrinter(self.stats, self.stats_options['percentiles'] or DEFAULT_PERCENTILES)
+        if self.workers and self.workers > 1 and not self.watch:
+            return ParallelLogPrinter(log_group_name, max_stream_length, self.workers, **kwargs)
+        return LogPrinter(log_group_name, max_stream_length, **kwargs)
+
+    def get_and_print_logs(self, aws_log_generator, log_printer):
         try:
             aws_log_generator.get_and_print_logs(self.client, log_printer)
         except KeyboardInterrupt:
-            print('Closing...\n')
+            if self.watch:
+                sys.stderr.write("{0}\n".format(aws_log_generator.lag.summary()))
+            self.report()
+            self.status('Closing...\n')
             os._exit(0)
+        self.report()
+
+    def report(self):
+        """Writes the throttling and reordering counters to stderr."""
+        if self.rate_limiter.throttles:
+            sys.stderr.write("{0}\n".format(self.rate_limiter.summary()))
+        if self.reorder_window is not None:
+            sys.stderr.write("{0}\n".format(self.reorder_window.summary()))
+
+    def pushdown(self, filter_pattern):
+        """Returns ``filter_pattern`` narrowed by the ``--where`` conditions
+        CloudWatch can evaluate itself."""
+        if not self.where:
+            return filter_pattern
+        return pushdown_filter_pattern(self.where, filter_pattern)
+
+    def status(self, message):
+        """Prints a progress message; to stderr when the output is data, or
+        when sent from a background thread while events are being printed,
+        e.g. as ``--pipeline`` discovers the streams of later groups."""
+        if (self.output_options.get('output_format', 'text') == 'text' and
+                threading.current_thread() is self.main_thread):
+            print(message)
+        else:
+            sys.stderr.write("{0}\n".format(message))
 
     def list_groups(self):
         """Lists available CloudWatch logs groups"""
@@ -99,54 +305,173 @@ class AWSLogs(object):
         for stream in self.get_streams(self.log_group_name):
             print(stream)
 
-    def get_groups(self):
+    def get_groups(self, log_group_prefix=None):
         """Returns available CloudWatch logs groups"""
+        if log_group_prefix is None:
+            log_group_prefix = self.log_group_prefix
+        if self.metadata_cache is not None:
+            for group in self.metadata_cache.groups(log_group_prefix, self._describe_log_groups):
+                yield group
+            return
+
         kwargs = {}
-        if self.log_group_prefix is not None:
-            kwargs = {'logGroupNamePrefix': self.log_group_prefix}
-        paginator = self.client.get_paginator('describe_log_groups')
-        for page in paginator.paginate(**kwargs):
+        if log_group_prefix:
+            kwargs = {'logGroupNamePrefix': log_group_prefix}
+        for group in self._describe_log_groups(**kwargs):
+            yield group
+
+    def _describe_log_groups(self, **kwargs):
+        for page in self._paginate('describe_log_groups', kwargs):
             for group in page.get('logGroups', []):
                 yield group['logGroupName']
 
     def get_streams(self, log_group_name, log_stream_prefix = None):
         """Returns available CloudWatch logs streams in ``log_group_name``."""
-        print 'Searching for log streams belonging to group {} with prefix {}'.format(log_group_name, log_stream_prefix)
-        kwargs = {'logGroupName': log_group_name}
-        if log_stream_prefix is not None:
-            kwargs['logStreamNamePrefix'] = log_stream_prefix
+        for stream in self.describe_streams(log_group_name, log_stream_prefix):
+            yield stream['logStreamName']
+
+    def stream_names(self, log_group_name, log_stream_prefix):
+        """Returns the names of the matching streams, without a progress message."""
+        return [s['logStreamName'] for s in self.describe_streams(log_group_name, log_stream_prefix, quiet=True)]
+
+    def describe_streams(self, log_group_name, log_stream_prefix = None, quiet=False):
+        """Returns descriptions of the streams in ``log_group_name`` with
+        events in the requested time window.
+
+        Without a prefix the streams are listed by last event time, newest
+        first, and the listing stops at the first stream older than the window.
+        """
+        if not quiet:
+            self.status('Searching for log streams belonging to group {} with prefix {}'.format(
+                log_group_name, log_stream_prefix))
         window_start = self.start or 0
         window_end = self.end or sys.float_info.max
+        ordered = False
+
+        if self.metadata_cache is not None:
+            streams = self.metadata_cache.streams(log_group_name, log_stream_prefix,
+                                                  self._describe_log_streams)
+        else:
+            kwargs = {'logGroupName': log_group_name}
+            if log_stream_prefix:
+                kwargs['logStreamNamePrefix'] = log_stream_prefix
+            else:
+                # Most recently active streams first, so the listing can stop
+                # at the first stream whose events all precede the window.
+                kwargs['orderBy'] = 'LastEventTime'
+                kwargs['descending'] = True
+                ordered = True
+            streams = self._describe_log_streams(**kwargs)
 
-        paginator = self.client.get_paginator('describe_log_streams')
-        for page in paginator.paginate(**kwargs):
+        for stream in streams:
+            if 'firstEventTimestamp' not in stream:
+                # This is a specified log stream rather than
+                # a filter on the whole log group, so there's
+                # no firstEventTimestamp.
+                yield stream
+            elif ordered and stream['lastEventTimestamp'] < window_start:
+                return
+            elif max(stream['firstEventTimestamp'], window_start) <= \
+                    min(stream['lastEventTimestamp'], window_end):
+                yield stream
+
+    def _describe_log_streams(self, **kwargs):
+        for page in self._paginate('describe_log_streams', kwargs):
             for stream in page.get('logStreams', []):
-                if 'firstEventTimestamp' not in stream:
-                    # This is a specified log stream rather than
-                    # a filter on the whole log group, so there's
-                    # no firstEventTimestamp.
-                    yield stream['logStreamName']
-                elif max(stream['firstEventTimestamp'], window_start) <= \
-                        min(stream['lastEventTimestamp'], window_end):
-                    yield stream['logStreamName']
+                yield stream
+
+    def _paginate(self, operation_name, kwargs):
+        """Returns the pages of ``operation_name``, rate limited and
+        prefetched on the scheduler when there is one."""
+        if self.scheduler is not None:
+            request = partial(self.rate_limiter.call, getattr(self.client, operation_name))
+            return self.scheduler.paginate(request, kwargs)
+        return self.rate_limiter.paginate(self.client.get_paginator(operation_name), kwargs)
+
+    def stream_ranges(self, descriptions):
+        """Returns the ``(first, last)`` event timestamps of each described stream."""
+        return [(s['firstEventTimestamp'], s['lastEventTimestamp'])
+                for s in descriptions if 'firstEventTimestamp' in s]
 
     def query_logs_by_template(self):
 
         query_template = QueryTemplate(self.query_template_file, self.query_template_args)
-        streams = list(self.get_streams(query_template.log_group_name, query_template.log_stream_prefix))
+        indexed = None
+        if not query_template.insights_query:
+            indexed = self.indexed_generator(query_template.log_group_name, query_template.log_stream_prefix,
+                                             self.parse_datetime('1d'), query_template.filter_pattern)
+        if indexed is not None:
+            max_stream_length = self.event_index.max_stream_length(
+                indexed.log_group_name, indexed.log_stream_prefix, indexed.start_time, indexed.end_time)
+            log_printer = self.log_printer(query_template.log_group_name, max_stream_length)
+            return self.get_and_print_logs(indexed, log_printer)
+        if query_template.insights_query:
+            query_string = query_template.insights_query
+            if query_template.log_stream_prefix:
+                query_string = stream_filter(query_template.log_stream_prefix) + ' | ' + query_string
+            return self.print_insights(query_template.log_group_name.split(','), query_string,
+                                       self.parse_datetime('1d'))
+        if self.pipeline and not self.watch:
+            return self.print_pipelined([query_template.log_group_name],
+                                        query_template.log_stream_prefix, self.parse_datetime('1d'),
+                                        self.pushdown(query_template.filter_pattern))
+        descriptions = list(self.describe_streams(query_template.log_group_name,
+                                                  query_template.log_stream_prefix))
+        streams = [s['logStreamName'] for s in descriptions]
         if not streams:
             raise exceptions.NoStreamsFilteredError(query_template.log_stream_prefix)
 
-        aws_log_generator = AWSLogGenerator(log_group_name=query_template.log_group_name,
-                                            log_streams=streams,
-                                            start_time=self.parse_datetime('1d'),
-                                            filter_pattern=query_template.filter_pattern)
+        aws_log_generator = self.log_generator(query_template.log_group_name, streams, descriptions,
+                                               self.parse_datetime('1d'),
+                                               self.pushdown(query_template.filter_pattern),
+                                               log_stream_prefix=query_template.log_stream_prefix)
 
         max_stream_length = max([len(s) for s in streams]) if streams else 10
-        log_printer = LogPrinter(query_template.log_group_name, max_stream_length, **self.output_options)
-        aws_log_generator.get_and_print_logs(self.client, log_printer)
+        log_printer = self.log_printer(query_template.log_group_name, max_stream_length)
+        self.get_and_print_logs(aws_log_generator, log_printer)
+
+
 
+    def insights(self):
+        """Runs the Logs Insights query ``insights_query`` and prints its results."""
+        self.print_insights(self.log_group_names(), self.insights_query, self.start)
 
+    def print_insights(self, log_group_names, query_string, start_time):
+        """Runs ``query_string`` server side and prints the result rows.
+
+        The group, stream, timestamp and ingestion time prefixes are only
+        printed when every row has them, since aggregated rows do not.
+        """
+        query = InsightsQuery(self.client, log_group_names, query_string, start_time, self.end,
+                              limit=self.insights_limit, call=self.rate_limiter.call)
+        self.status('Running Logs Insights query over {0}'.format(', '.join(log_group_names)))
+        default_group = log_group_names[0] if len(log_group_names) == 1 else None
+        try:
+            events = list(query.events(default_group))
+        except KeyboardInterrupt:
+            # The query has been stopped.
+            self.status('Closing...\n')
+            os._exit(0)
+
+        options = {}
+        if not all(e['logStreamName'] for e in events):
+            options['output_stream_enabled'] = False
+        if not all('logGroupName' in e for e in events):
+            options['output_group_enabled'] = False
+        if not all(e['timestamp'] is not None for e in events):
+            options['output_timestamp_enabled'] = False
+        if not all(e['ingestionTime'] is not None for e in events):
+            options['output_ingestion_time_enabled'] = False
+        max_stream_length = max([len(e['logStreamName']) for e in events] or [0])
+        if default_group is None:
+            options['max_group_length'] = max([len(e.get('logGroupName', '')) for e in events] or [0])
+        log_printer = self.log_printer(default_group, max_stream_length, **options)
+        try:
+            for event in events:
+                log_printer.print_log(event)
+        finally:
+            log_printer.close()
+        sys.stderr.write("{0}\n".format(query.summary()))
 
     def parse_datetime(self, datetime_text):
         """Parse ``datetime_text`` into a ``datetime``."""
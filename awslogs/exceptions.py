@@ -21,17 +21,6 @@ class UnknownDateError(BaseAWSLogsException):
         return "awslogs doesn't understand '{0}' as a date.".format(self.args[0])
 
 
-class TooManyStreamsFilteredError(BaseAWSLogsException):
-
-    code = 6
-
-    def hint(self):
-        return ("The number of streams that match your pattern '{0}' is '{1}'. "
-                "AWS API limits the number of streams you can filter by to {2}."
-                "It might be helpful to you to not filter streams by any "
-                "pattern and filter the output of awslogs.").format(*self.args)
-
-
 class NoStreamsFilteredError(BaseAWSLogsException):
 
     code = 7
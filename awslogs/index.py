@@ -0,0 +1,308 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+
+from botocore.compat import json, six
+
+from .cache import DEFAULT_CACHE_DIR, READ_BATCH_SIZE, _ensure_dir
+from .tail import LagTracker
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS windows (
+    log_group TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    open_end INTEGER NOT NULL,
+    indexed REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    log_group TEXT NOT NULL,
+    log_stream TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    ingestion_time INTEGER,
+    event_id TEXT NOT NULL,
+    message TEXT NOT NULL,
+    UNIQUE (log_group, event_id)
+);
+CREATE INDEX IF NOT EXISTS events_by_time ON events (log_group, timestamp);
+"""
+
+# Substring index of the messages. The trigram tokenizer needs SQLite 3.34;
+# without it searches scan the time range instead.
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(
+    message, content='events', content_rowid='id', tokenize='trigram case_sensitive 1'
+);
+CREATE TRIGGER IF NOT EXISTS events_fts AFTER INSERT ON events BEGIN
+    INSERT INTO messages (rowid, message) VALUES (new.id, new.message);
+END;
+"""
+
+# The trigram index cannot look up shorter strings.
+MIN_INDEXED_LENGTH = 3
+
+_TERM = re.compile(r'([-?]?)(?:"((?:[^"\\]|\\.)*)"|([^\s"]+))')
+
+_JSON_CONDITION = re.compile(
+    r'^\$((?:\.[A-Za-z_][A-Za-z0-9_]*)+)\s*'
+    r'(?:=\s*(?:"((?:[^"\\*]|\\.)*)"|(-?\d+(?:\.\d+)?))|IS\s+(TRUE|FALSE|NULL))$'
+)
+
+
+class LocalFilter(object):
+    """A filter pattern evaluated on the local index.
+
+    ``match`` is an FTS query selecting a superset of the matching events,
+    or ``None`` to scan the time range; ``matches(message)`` is the exact
+    test applied to every candidate.
+    """
+
+    def __init__(self, match, matches):
+        self.match = match
+        self.matches = matches
+
+
+def compile_filter(filter_pattern):
+    """Returns a ``LocalFilter`` for ``filter_pattern``, or ``None`` if it
+    can only be evaluated by CloudWatch.
+
+    Supported are term patterns (``ERROR "Task timed out" -retry``, or
+    ``?ERROR ?WARN``), matched as case sensitive substrings, and JSON
+    patterns joining ``$.a.b = "text"``, ``$.a = 5`` and ``$.a IS TRUE``
+    conditions with ``&&``.
+    """
+    pattern = (filter_pattern or '').strip()
+    if not pattern:
+        return LocalFilter(None, lambda message: True)
+    if pattern.startswith('{') and pattern.endswith('}'):
+        return _compile_json_filter(pattern[1:-1].strip())
+    if pattern.startswith('['):
+        return None
+    return _compile_term_filter(pattern)
+
+
+def _compile_term_filter(pattern):
+    includes, excludes, optional = [], [], []
+    position = 0
+    for match in _TERM.finditer(pattern):
+        if pattern[position:match.start()].strip():
+            return None
+        position = match.end()
+        sign, quoted, bare = match.groups()
+        term = re.sub(r'\\(.)', r'\1', quoted) if quoted is not None else bare
+        if bare is not None and '*' in bare:
+            return None
+        {'': includes, '-': excludes, '?': optional}[sign].append(term)
+    if pattern[position:].strip() or (optional and (includes or excludes)):
+        return None
+    if optional:
+        indexed = all(len(word) >= MIN_INDEXED_LENGTH for word in optional)
+        match = ' OR '.join(_phrase(word) for word in optional) if indexed else None
+        return LocalFilter(match, lambda message: any(word in message for word in optional))
+    indexed = [word for word in includes if len(word) >= MIN_INDEXED_LENGTH]
+    return LocalFilter(' AND '.join(_phrase(word) for word in indexed) or None,
+                       lambda message: (all(word in message for word in includes) and
+                                        not any(word in message for word in excludes)))
+
+
+def _compile_json_filter(pattern):
+    conditions = []
+    for condition in pattern.split('&&'):
+        condition = condition.strip()
+        while condition.startswith('(') and condition.endswith(')'):
+            condition = condition[1:-1].strip()
+        match = _JSON_CONDITION.match(condition)
+        if match is None:
+            return None
+        path, text, number, keyword = match.groups()
+        keys = path[1:].split('.')
+        if text is not None:
+            conditions.append((keys, 'text', re.sub(r'\\(.)', r'\1', text)))
+        elif number is not None:
+            conditions.append((keys, 'number', float(number)))
+        else:
+            conditions.append((keys, 'is', {'TRUE': True, 'FALSE': False, 'NULL': None}[keyword]))
+
+    def matches(message):
+        if message[:1] != '{':
+            return False
+        try:
+            document = json.loads(message)
+        except ValueError:
+            return False
+        return all(_holds(document, path, kind, expected) for path, kind, expected in conditions)
+
+    # Strings are only looked up when their JSON encoding is certainly verbatim.
+    indexed = [expected for _, kind, expected in conditions
+               if kind == 'text' and len(expected) >= MIN_INDEXED_LENGTH and
+               re.match(r'^[A-Za-z0-9 _.:-]+$', expected)]
+    return LocalFilter(' AND '.join(_phrase(text) for text in indexed) or None, matches)
+
+
+def _holds(document, keys, kind, expected):
+    value = document
+    for key in keys:
+        if not isinstance(value, dict) or key not in value:
+            return False
+        value = value[key]
+    if kind == 'is':
+        return value is expected
+    if kind == 'number':
+        return (isinstance(value, six.integer_types + (float,)) and
+                not isinstance(value, bool) and value == expected)
+    return value == expected
+
+
+def _phrase(term):
+    return '"{0}"'.format(term.replace('"', '""'))
+
+
+class EventIndex(object):
+    """On-disk SQLite index of every event of downloaded time windows.
+
+    ``awslogs index`` stores the events of a group, stream prefix and time
+    range; later searches within such a window run on the index, pruned by
+    timestamp and looked up by substring in an FTS5 trigram index.
+    """
+
+    def __init__(self, cache_dir=None, clock=time.time):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.clock = clock
+        _ensure_dir(self.cache_dir)
+        self.db = sqlite3.connect(os.path.join(self.cache_dir, 'index.sqlite'),
+                                  check_same_thread=False,
+                                  isolation_level=None)
+        self.lock = threading.RLock()
+        with self.lock:
+            self.db.executescript(SCHEMA)
+            try:
+                self.db.executescript(FTS_SCHEMA)
+                self.full_text = True
+            except sqlite3.OperationalError:
+                self.full_text = False
+
+    def add(self, log_group_name, log_stream_prefix, start_time, end_time, events):
+        """Stores ``events`` and records that the window is indexed.
+
+        An open ``end_time`` indexes up to now. Returns the number of events read.
+        """
+        indexed = self.clock()
+        count = 0
+        pending = []
+        for event in events:
+            count += 1
+            pending.append((log_group_name, event['logStreamName'], event['timestamp'],
+                            event.get('ingestionTime'), event['eventId'], event['message']))
+            if len(pending) >= READ_BATCH_SIZE:
+                self.__insert_batch(pending)
+                pending = []
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.__insert(pending)
+            self.db.execute(
+                "INSERT INTO windows (log_group, prefix, start, end, open_end, indexed) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (log_group_name, log_stream_prefix or '', start_time or 0,
+                 end_time if end_time is not None else int(indexed * 1000),
+                 int(end_time is None), indexed))
+            self.db.execute("COMMIT")
+        return count
+
+    def window(self, log_group_name, log_stream_prefix, start_time, end_time):
+        """Returns the end of an indexed window covering the requested one,
+        or ``None``. An open ``end_time`` is covered by windows indexed up to
+        the time they were built."""
+        prefix = log_stream_prefix or ''
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT prefix, end, open_end FROM windows WHERE log_group = ? AND start <= ? "
+                "ORDER BY end DESC", (log_group_name, start_time or 0)).fetchall()
+        for indexed_prefix, end, open_end in rows:
+            if not prefix.startswith(indexed_prefix):
+                continue
+            if (end_time is None and open_end) or (end_time is not None and end_time <= end):
+                return end
+        return None
+
+    def max_stream_length(self, log_group_name, log_stream_prefix, start_time, end_time):
+        with self.lock:
+            return self.db.execute(
+                "SELECT COALESCE(MAX(LENGTH(log_stream)), 0) FROM events WHERE log_group = ? "
+                "AND timestamp BETWEEN ? AND ? AND substr(log_stream, 1, ?) = ?",
+                (log_group_name, start_time or 0, end_time, len(log_stream_prefix or ''),
+                 log_stream_prefix or '')).fetchone()[0]
+
+    def search(self, log_group_name, log_stream_prefix, start_time, end_time, local_filter):
+        """Yields the indexed events matching ``local_filter``, by timestamp."""
+        prefix = log_stream_prefix or ''
+        sql = ("SELECT id, log_stream, timestamp, ingestion_time, event_id, message FROM events "
+               "WHERE log_group = ? AND timestamp <= ? AND substr(log_stream, 1, ?) = ? "
+               "AND (timestamp > ? OR (timestamp = ? AND id > ?))")
+        arguments = [log_group_name, end_time, len(prefix), prefix]
+        if local_filter.match is not None and self.full_text:
+            sql += " AND id IN (SELECT rowid FROM messages WHERE messages MATCH ?)"
+            arguments.append(local_filter.match)
+        sql += " ORDER BY timestamp, id LIMIT ?"
+        last = (start_time or 0, -1)
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    sql, arguments[:4] + [last[0], last[0], last[1]] + arguments[4:] + [READ_BATCH_SIZE]
+                ).fetchall()
+            for rowid, log_stream, timestamp, ingestion_time, event_id, message in rows:
+                if local_filter.matches(message):
+                    yield {'eventId': event_id,
+                           'timestamp': timestamp,
+                           'ingestionTime': ingestion_time,
+                           'message': message,
+                           'logStreamName': log_stream}
+            if len(rows) < READ_BATCH_SIZE:
+                return
+            last = (rows[-1][2], rows[-1][0])
+
+    def __insert_batch(self, rows):
+        """Inserts ``rows`` and their full text entries in one transaction."""
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.__insert(rows)
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def __insert(self, rows):
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO events (log_group, log_stream, timestamp, ingestion_time, "
+                "event_id, message) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+
+class IndexedLogGenerator(object):
+    """Stands in for an ``AWSLogGenerator`` whose window is in an ``EventIndex``."""
+
+    def __init__(self, event_index, log_group_name, log_stream_prefix, start_time, end_time,
+                 local_filter):
+        self.event_index = event_index
+        self.log_group_name = log_group_name
+        self.log_stream_prefix = log_stream_prefix
+        self.start_time = start_time
+        self.end_time = end_time
+        self.local_filter = local_filter
+        self.lag = LagTracker()
+
+    def generate_logs(self, client=None):
+        return self.event_index.search(self.log_group_name, self.log_stream_prefix,
+                                       self.start_time, self.end_time, self.local_filter)
+
+    def get_and_print_logs(self, client, log_printer):
+        try:
+            for event in self.generate_logs(client):
+                log_printer.print_log(event)
+        finally:
+            log_printer.close()
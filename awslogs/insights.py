@@ -0,0 +1,136 @@
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from botocore.compat import json, total_seconds
+
+from . import exceptions
+from .tail import PollInterval, MIN_POLL_INTERVAL
+
+
+# Logs Insights accepts at most this many log groups per query.
+MAX_QUERY_LOG_GROUPS = 50
+
+FAILED_STATUSES = ('Failed', 'Cancelled', 'Timeout', 'Unknown')
+
+# Result fields mapped onto event fields rather than rendered in the message.
+EVENT_RESULT_FIELDS = ('@timestamp', '@ingestionTime', '@logStream', '@log', '@ptr')
+
+
+def parse_result_time(text):
+    """Parses a result timestamp such as ``2017-01-01 10:00:00.123`` (UTC)
+    into epoch milliseconds."""
+    date = datetime.strptime(text, '%Y-%m-%d %H:%M:%S.%f')
+    return int(total_seconds(date - datetime(1970, 1, 1)) * 1000)
+
+
+def stream_filter(log_stream_prefix):
+    """Returns the Insights command keeping the streams with ``log_stream_prefix``."""
+    return 'filter @logStream like /^{0}/'.format(re.sub(r'([^A-Za-z0-9_-])', r'\\\1', log_stream_prefix))
+
+
+def result_event(row, default_log_group_name=None):
+    """Returns a result ``row`` of ``get_query_results`` as an event.
+
+    ``@timestamp``, ``@ingestionTime``, ``@logStream`` and ``@log`` fill the
+    matching event fields. A row holding just ``@message`` besides those is
+    printed as the raw message; any other row, e.g. of ``stats``, is printed
+    as a JSON object of its fields, so ``--query`` and ``--where`` apply.
+    """
+    fields = OrderedDict((column['field'], column.get('value')) for column in row)
+    data = OrderedDict((k, v) for k, v in fields.items() if k not in EVENT_RESULT_FIELDS)
+    event = {'logStreamName': fields.get('@logStream', ''),
+             'timestamp': None,
+             'ingestionTime': None}
+    for name, key in (('timestamp', '@timestamp'), ('ingestionTime', '@ingestionTime')):
+        if fields.get(key):
+            event[name] = parse_result_time(fields[key])
+    if fields.get('@log'):
+        # "<account id>:<log group name>"
+        event['logGroupName'] = fields['@log'].split(':', 1)[-1]
+    elif default_log_group_name is not None:
+        event['logGroupName'] = default_log_group_name
+    if list(data) == ['@message']:
+        event['message'] = data['@message'] or ''
+    else:
+        event['message'] = json.dumps(data)
+    return event
+
+
+class InsightsQuery(object):
+    """Runs a CloudWatch Logs Insights query over ``log_group_names``.
+
+    ``start_time`` and ``end_time`` are epoch milliseconds, ``end_time``
+    defaulting to now. ``get_query_results`` is polled, backing off like an
+    idle ``PollInterval``, until the query completes. ``call`` wraps every
+    request, e.g. ``RateLimiter.call``.
+    """
+
+    def __init__(self, client, log_group_names, query_string, start_time, end_time=None,
+                 limit=None, call=None, sleep=time.sleep, clock=time.time):
+        if len(log_group_names) > MAX_QUERY_LOG_GROUPS:
+            raise exceptions.AWSLogsException(
+                "Logs Insights queries at most {0} log groups; {1} match.".format(
+                    MAX_QUERY_LOG_GROUPS, len(log_group_names)))
+        self.client = client
+        self.log_group_names = log_group_names
+        self.query_string = query_string
+        self.start_time = start_time or 0
+        self.end_time = end_time
+        self.limit = limit
+        self.call = call or (lambda func, **kwargs: func(**kwargs))
+        self.sleep = sleep
+        self.clock = clock
+        self.query_id = None
+        self.statistics = {}
+
+    def start(self):
+        """Submits the query and returns its id."""
+        end_time = self.end_time if self.end_time is not None else int(self.clock() * 1000)
+        kwargs = {'logGroupNames': self.log_group_names,
+                  'queryString': self.query_string,
+                  # Insights takes seconds; round outwards to cover the window.
+                  'startTime': self.start_time // 1000,
+                  'endTime': -(-end_time // 1000)}
+        if self.limit:
+            kwargs['limit'] = self.limit
+        self.query_id = self.call(self.client.start_query, **kwargs)['queryId']
+        return self.query_id
+
+    def results(self):
+        """Returns the result rows once the query has completed."""
+        if self.query_id is None:
+            self.start()
+        interval = PollInterval(initial=MIN_POLL_INTERVAL)
+        try:
+            while True:
+                response = self.call(self.client.get_query_results, queryId=self.query_id)
+                self.statistics = response.get('statistics', {})
+                status = response['status']
+                if status == 'Complete':
+                    return response.get('results', [])
+                if status in FAILED_STATUSES:
+                    raise exceptions.AWSLogsException(
+                        "Logs Insights query {0} ended with status {1}.".format(self.query_id, status))
+                self.sleep(interval.next(0))
+        except KeyboardInterrupt:
+            self.stop()
+            raise
+
+    def events(self, default_log_group_name=None):
+        """Yields the result rows as events, see ``result_event``."""
+        for row in self.results():
+            yield result_event(row, default_log_group_name)
+
+    def stop(self):
+        try:
+            self.call(self.client.stop_query, queryId=self.query_id)
+        except Exception:
+            # The query may have just finished; nothing to stop.
+            pass
+
+    def summary(self):
+        return ("Logs Insights scanned {0:.0f} records ({1:.0f} bytes) and matched {2:.0f}.").format(
+            self.statistics.get('recordsScanned', 0), self.statistics.get('bytesScanned', 0),
+            self.statistics.get('recordsMatched', 0))
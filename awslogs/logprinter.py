@@ -1,18 +1,137 @@
+import os
 import sys
-import jmespath
+import time
+import errno
+import threading
 from termcolor import colored
 from datetime import datetime
-from botocore.compat import json, six
+
+from .query import QueryEngine
+from .writers import DEFAULT_FIELDS, ParquetWriter, csv_header, record_formatter
 
 def milis2iso(milis):
     res = datetime.utcfromtimestamp(milis/1000.0).isoformat()
     return (res + ".000")[:23] + 'Z'
 
-class LogPrinter(object):
+
+class TimestampFormatter(object):
+    """Formats epoch milliseconds exactly like ``milis2iso``.
+
+    The date, hour and minute prefix is cached, since consecutive events
+    nearly always share it; only seconds and milliseconds are formatted
+    for every call.
+    """
+
+    def __init__(self):
+        self._minute = None
+        self._prefix = None
+
+    def __call__(self, milis):
+        minute, rest = divmod(milis, 60000)
+        if minute != self._minute:
+            self._prefix = datetime.utcfromtimestamp(minute * 60).isoformat()[:17]
+            self._minute = minute
+        return '%s%02d.%03dZ' % (self._prefix, rest // 1000, rest % 1000)
+
+class OutputWriter(object):
+    """Buffers output lines and writes them to ``stream`` in batches.
+
+    The buffer is written once it holds ``buffer_size`` characters, and a
+    background thread flushes lines which have waited ``max_delay`` seconds,
+    e.g. while the next page is being fetched. With ``line_buffered`` every
+    line is written and flushed straight away.
+    """
+
+    def __init__(self, stream, line_buffered=False, buffer_size=64 * 1024, max_delay=0.2):
+        self.stream = stream
+        self.line_buffered = line_buffered
+        self.buffer_size = buffer_size
+        self.max_delay = max_delay
+        self._lines = []
+        self._size = 0
+        self._since = None
+        self._lock = threading.Lock()
+        self._closed = False
+        if not line_buffered:
+            flusher = threading.Thread(target=self._flush_periodically)
+            flusher.daemon = True
+            flusher.start()
+
+    def write_line(self, line):
+        self.write_lines([line])
+
+    def write_lines(self, lines):
+        if self.line_buffered:
+            with self._lock:
+                self._write(lines)
+            return
+        with self._lock:
+            if not self._lines:
+                self._since = time.time()
+            self._lines.extend(lines)
+            self._size += sum(len(line) + 1 for line in lines)
+            if self._size >= self.buffer_size:
+                self._write(self._take())
+
+    def flush(self):
+        with self._lock:
+            self._write(self._take())
+
+    @property
+    def buffered_size(self):
+        """Characters waiting to be written."""
+        return self._size
+
+    def close(self):
+        """Flushes the buffer and stops the background flushes."""
+        self.flush()
+        self._closed = True
+
+    def _take(self):
+        lines = self._lines
+        self._lines = []
+        self._size = 0
+        return lines
+
+    def _write(self, lines):
+        try:
+            if lines:
+                self.stream.write('\n'.join(lines) + '\n')
+            self.stream.flush()
+        except IOError as e:
+            if e.errno == errno.EPIPE:
+                # SIGPIPE received, so exit
+                os._exit(0)
+            else:
+                # We don't want to handle any other errors from this
+                raise
+
+    def _flush_periodically(self):
+        while not self._closed:
+            time.sleep(self.max_delay)
+            with self._lock:
+                if self._lines and time.time() - self._since >= self.max_delay:
+                    self._write(self._take())
+
+
+def _isatty(stream):
+    try:
+        return stream.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+
+class LogFormatter(object):
+    """Renders events as output records, applying ``--where`` and ``--query``.
+
+    Records are text lines, JSON or CSV lines, or rows of field values for
+    Parquet, depending on ``output_format``.
+    """
 
     def __init__(self, log_group_name, max_stream_length, **kwargs):
         self.log_group_name = log_group_name
         self.max_stream_length = max_stream_length
+        self.max_group_length = kwargs.get('max_group_length')
         self.color_enabled = kwargs.get('color_enabled')
         self.output_stream_enabled = kwargs.get('output_stream_enabled')
         self.output_group_enabled = kwargs.get('output_group_enabled')
@@ -20,63 +139,151 @@ class LogPrinter(object):
         self.output_ingestion_time_enabled = kwargs.get('output_ingestion_time_enabled')
         self.query = kwargs.get('query')
         if self.query:
-            self.query_expression = jmespath.compile(self.query)
+            self.query_engine = QueryEngine(self.query)
+        self.where = kwargs.get('where')
+        if self.where:
+            self.where_engine = QueryEngine(self.where)
+        self.output_format = kwargs.get('output_format') or 'text'
+        self.fields = kwargs.get('fields') or DEFAULT_FIELDS
+        self.format_prefix = self.__compile_prefix()
+        if self.output_format == 'text':
+            self.format_record = lambda event, message: self.format_prefix(event) + message.rstrip()
+        else:
+            self.format_record = record_formatter(self.output_format, self.fields, log_group_name)
+
+    def format_log(self, event):
+        """Returns the output record for ``event``, or ``None`` if it is filtered out."""
+        message = event['message']
+        if self.where and not self.where_engine.matches(message):
+            return None
+        if self.query is not None and message[0] == '{':
+            message = self.query_engine.format(message)
 
+        return self.format_record(event, message)
 
-    def print_log(self, event):
-        output = []
-        group_length = len(self.log_group_name)
-        if self.output_group_enabled:
-            output.append(
-                self.__color(
-                    self.log_group_name.ljust(group_length, ' '),
-                    'green'
-                )
-            )
+    def format_logs(self, events):
+        """Returns the output records for ``events``."""
+        lines = []
+        for event in events:
+            line = self.format_log(event)
+            if line is not None:
+                lines.append(line)
+        return lines
+
+    def __compile_prefix(self):
+        """Returns a function rendering the prefix fields of an event.
+
+        Only the enabled fields are rendered; the group name and the padded,
+        coloured name of every stream are built once and reused. With
+        ``max_group_length`` the events come from several groups, and each
+        event's ``logGroupName`` is rendered padded to that length.
+        """
+        group = ''
+        parts = []
+        if self.output_group_enabled and self.max_group_length is None:
+            group = self.__color(self.log_group_name, 'green') + ' '
+        elif self.output_group_enabled:
+            groups = {}
+            max_group_length = self.max_group_length
+
+            def group_part(event):
+                name = event['logGroupName']
+                try:
+                    return groups[name]
+                except KeyError:
+                    groups[name] = self.__color(name.ljust(max_group_length, ' '), 'green') + ' '
+                    return groups[name]
+            parts.append(group_part)
         if self.output_stream_enabled:
-            output.append(
-                self.__color(
-                    event['logStreamName'].ljust(self.max_stream_length,
-                                                 ' '),
-                    'cyan'
-                )
-            )
+            streams = {}
+            max_stream_length = self.max_stream_length
+
+            def stream_part(event):
+                name = event['logStreamName']
+                try:
+                    return streams[name]
+                except KeyError:
+                    streams[name] = self.__color(name.ljust(max_stream_length, ' '), 'cyan') + ' '
+                    return streams[name]
+            parts.append(stream_part)
         if self.output_timestamp_enabled:
-            output.append(
-                self.__color(
-                    milis2iso(event['timestamp']),
-                    'yellow'
-                )
-            )
+            yellow, yellow_end = self.__color_codes('yellow')
+            timestamp = TimestampFormatter()
+            parts.append(lambda event: yellow + timestamp(event['timestamp']) + yellow_end)
         if self.output_ingestion_time_enabled:
-            output.append(
-                self.__color(
-                    milis2iso(event['ingestionTime']),
-                    'blue'
-                )
-            )
+            blue, blue_end = self.__color_codes('blue')
+            ingestion_time = TimestampFormatter()
+            parts.append(lambda event: blue + ingestion_time(event['ingestionTime']) + blue_end)
 
-        message = event['message']
-        if self.query is not None and message[0] == '{':
-            parsed = json.loads(event['message'])
-            message = self.query_expression.search(parsed)
-            if not isinstance(message, six.string_types):
-                message = json.dumps(message)
-        output.append(message.rstrip())
-
-        print(' '.join(output))
-        try:
-            sys.stdout.flush()
-        except IOError as e:
-            if e.errno == errno.EPIPE:
-                # SIGPIPE received, so exit
-                os._exit(0)
-            else:
-                # We don't want to handle any other errors from this
-                raise
+        if not parts:
+            return lambda event: group
+        if len(parts) == 1:
+            part = parts[0]
+            return lambda event: group + part(event)
+        return lambda event: group + ''.join([part(event) for part in parts])
 
     def __color(self, text, color):
         """Returns coloured version of ``text`` if ``color_enabled``."""
         if self.color_enabled:
             return colored(text, color)
         return text
+
+    def __color_codes(self, color):
+        """Returns the strings ``__color`` puts before and after text, the
+        latter followed by a separating space."""
+        start, end = self.__color('\0', color).split('\0')
+        return start, end + ' '
+
+
+
+class LogPrinter(LogFormatter):
+    """Writes formatted events to ``stream``, or to the files of
+    ``output_files`` (an ``OutputFiles``) rotating them as events arrive."""
+
+    def __init__(self, log_group_name, max_stream_length, **kwargs):
+        super(LogPrinter, self).__init__(log_group_name, max_stream_length, **kwargs)
+        self.line_buffered = kwargs.get('watch')
+        self.output_files = kwargs.get('output_files')
+        self.writer = None
+        if self.output_files is None:
+            self.__open_writer(kwargs.get('stream') or sys.stdout)
+        elif not self.output_files.rotate_interval:
+            self.__open_writer(self.output_files.open())
+
+    def print_log(self, event):
+        line = self.format_log(event)
+        if line is not None:
+            if self.output_files is not None:
+                self.rotate(event['timestamp'])
+            self.writer.write_line(line)
+
+    def rotate(self, timestamp):
+        """Moves on to the next output file if an event at ``timestamp``
+        belongs in a new one."""
+        if self.output_files.should_rotate(timestamp, self.writer and self.writer.buffered_size):
+            if self.writer is not None:
+                self.writer.close()
+            self.__open_writer(self.output_files.open(timestamp))
+
+    def flush(self):
+        """Writes out any buffered output."""
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        """Writes out any buffered output and finishes the output."""
+        self.flush()
+        if self.output_files is not None and self.writer is None:
+            # Nothing was written; still leave an (empty) output file.
+            self.__open_writer(self.output_files.open())
+        self.writer.close()
+        if self.output_files is not None:
+            self.output_files.close()
+
+    def __open_writer(self, stream):
+        if self.output_format == 'parquet':
+            self.writer = ParquetWriter(stream, self.fields)
+        else:
+            self.writer = OutputWriter(stream, line_buffered=self.line_buffered or _isatty(stream))
+        if self.output_format == 'csv':
+            self.writer.write_line(csv_header(self.fields))
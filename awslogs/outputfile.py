@@ -0,0 +1,178 @@
+import os
+import sys
+import gzip
+import threading
+from datetime import datetime
+
+from botocore.compat import six
+
+from . import exceptions
+from .pipeline import POLL_INTERVAL
+
+
+COMPRESSIONS = ('none', 'gzip', 'zstd')
+
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+
+# Chunks handed to the compression thread before writers block.
+MAX_PENDING_CHUNKS = 64
+
+_DONE = object()
+
+
+class CompressedFile(object):
+    """Write-only file at ``path``, compressed with gzip or zstd on a
+    background thread.
+
+    ``write`` hands the data to the thread and only blocks while
+    ``MAX_PENDING_CHUNKS`` chunks are waiting; text is written as UTF-8.
+    ``size`` counts the bytes written before compression.
+    """
+
+    def __init__(self, path, compression=None):
+        self.path = path
+        self.size = 0
+        self.closed = False
+        self._raw = open(path, 'wb')
+        self._thread = None
+        if compression in (None, 'none'):
+            self._out = self._raw
+            return
+        if compression == 'gzip':
+            self._out = gzip.GzipFile(filename='', mode='wb', fileobj=self._raw)
+        elif compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                self._raw.close()
+                raise exceptions.AWSLogsException(
+                    "zstd compression requires zstandard: pip install zstandard")
+            self._out = zstandard.ZstdCompressor().stream_writer(self._raw)
+        else:
+            raise ValueError("unknown compression {0}".format(compression))
+        self._error = None
+        self._queue = six.moves.queue.Queue(maxsize=MAX_PENDING_CHUNKS)
+        self._thread = threading.Thread(target=self._compress)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, data):
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        self.size += len(data)
+        if self._thread is None:
+            self._out.write(data)
+            return
+        self._check()
+        self._queue.put(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        """Does not wait for the compression thread; ``close`` does."""
+        if self._thread is None:
+            self._out.flush()
+        else:
+            self._check()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._thread is not None:
+            self._queue.put(_DONE)
+            while self._thread.is_alive():
+                # A join without a timeout cannot be interrupted in Python 2.
+                self._thread.join(POLL_INTERVAL)
+            self._check()
+            self._out.close()
+        self._raw.close()
+
+    def _compress(self):
+        while True:
+            data = self._queue.get()
+            if data is _DONE:
+                return
+            if self._error is None:
+                try:
+                    self._out.write(data)
+                except Exception:
+                    self._error = sys.exc_info()
+
+    def _check(self):
+        if self._error is not None:
+            six.reraise(*self._error)
+
+
+class OutputFiles(object):
+    """Names, opens and rotates the files written by ``--output-file``.
+
+    Files are rotated once ``rotate_size`` bytes (before compression) have
+    been written, or when events cross into the next ``rotate_interval``
+    milliseconds of event time. Rotated files get the start of their
+    interval and/or a sequence number before the extensions of ``path``,
+    e.g. ``events-20170101T1000-0002.jsonl.gz``. The compression defaults
+    to the one named by the extension.
+
+    Files only rotate forward: a late event from an earlier interval is
+    written to the current file, so no file is ever reopened.
+    """
+
+    def __init__(self, path, compression=None, rotate_size=None, rotate_interval=None):
+        self.path = path
+        if compression is None:
+            compression = COMPRESSION_EXTENSIONS.get(os.path.splitext(path)[1], 'none')
+        self.compression = compression
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.current = None
+        self.paths = []
+        self._bucket = None
+        self._sequence = 0
+
+    def bucket(self, timestamp):
+        """Returns the start of the interval holding ``timestamp``, if rotating by time."""
+        if not self.rotate_interval:
+            return None
+        return timestamp - timestamp % self.rotate_interval
+
+    def should_rotate(self, timestamp, buffered_size=0):
+        """Returns whether an event at ``timestamp`` belongs in a new file,
+        given ``buffered_size`` bytes not yet written to the current one."""
+        if self.current is None:
+            return True
+        if self.rotate_size and self.current.size + (buffered_size or 0) >= self.rotate_size:
+            return True
+        return bool(self.rotate_interval) and self.bucket(timestamp) > self._bucket
+
+    def open(self, timestamp=None):
+        """Closes the current file and opens the next one, for ``timestamp``
+        unless it is older than the current interval."""
+        self.close()
+        bucket = self.bucket(timestamp) if timestamp is not None else None
+        if self._bucket is not None and (bucket is None or bucket < self._bucket):
+            bucket = self._bucket
+        if bucket != self._bucket:
+            self._sequence = 0
+        self._bucket = bucket
+        self._sequence += 1
+        self.current = CompressedFile(self._name(bucket, self._sequence), self.compression)
+        self.paths.append(self.current.path)
+        return self.current
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+
+    def _name(self, bucket, sequence):
+        parts = []
+        if bucket is not None:
+            parts.append(datetime.utcfromtimestamp(bucket / 1000.0).strftime('%Y%m%dT%H%M'))
+        if self.rotate_size:
+            parts.append('%04d' % sequence)
+        if not parts:
+            return self.path
+        directory, name = os.path.split(self.path)
+        stem, dot, extensions = name.partition('.')
+        return os.path.join(directory, '{0}-{1}{2}{3}'.format(stem, '-'.join(parts), dot, extensions))
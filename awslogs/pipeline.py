@@ -0,0 +1,259 @@
+import sys
+import heapq
+import threading
+
+from botocore.compat import six
+
+
+MAX_BUFFERED_ITEMS = 10000
+
+# How often a blocked consumer wakes up; Python 2 ignores Ctrl-C while
+# blocked on a queue without a timeout.
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+_STARTED = object()
+
+
+class BackgroundIterator(object):
+    """Drains ``iterable`` on a daemon thread into a bounded queue.
+
+    Iterating the instance yields the items in order; an exception raised
+    by ``iterable`` is re-raised in the consuming thread.
+    """
+
+    def __init__(self, iterable, maxsize=MAX_BUFFERED_ITEMS):
+        self._queue = six.moves.queue.Queue(maxsize=maxsize)
+        self._finished = False
+        self._thread = threading.Thread(target=self._run, args=(iterable,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, iterable):
+        try:
+            for item in iterable:
+                self._queue.put((item, None))
+        except Exception:
+            self._queue.put((_DONE, sys.exc_info()))
+        else:
+            self._queue.put((_DONE, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        while True:
+            try:
+                item, exc_info = self._queue.get(True, POLL_INTERVAL)
+                break
+            except six.moves.queue.Empty:
+                continue
+        if item is _DONE:
+            self._finished = True
+            if exc_info is not None:
+                six.reraise(*exc_info)
+            raise StopIteration
+        return item
+
+    next = __next__
+
+
+def merge_by_timestamp(iterables):
+    """Merges event iterables, each ordered by ``timestamp``, into one.
+
+    Events with the same timestamp are emitted in the order of the
+    iterables they came from.
+    """
+    iterators = [iter(iterable) for iterable in iterables]
+    heap = []
+    for index, iterator in enumerate(iterators):
+        for event in iterator:
+            heap.append((event['timestamp'], index, event))
+            break
+    heapq.heapify(heap)
+
+    while heap:
+        _, index, event = heap[0]
+        yield event
+        for event in iterators[index]:
+            heapq.heapreplace(heap, (event['timestamp'], index, event))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+def batches(iterable, size):
+    """Yields lists of up to ``size`` consecutive items of ``iterable``."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def merge_by_arrival(iterables, maxsize=MAX_BUFFERED_ITEMS, max_active=None):
+    """Yields the items of all ``iterables`` in the order they are produced.
+
+    Every iterable is drained on its own daemon thread into one bounded
+    queue, so an idle iterable does not hold back the others. An exception
+    raised by any of them is re-raised in the consuming thread.
+
+    ``iterables`` itself is consumed on a thread too, so it may be a
+    generator producing iterables while the first ones are being drained.
+    With ``max_active`` at most that many are drained at once.
+    """
+    queue = six.moves.queue.Queue(maxsize=maxsize)
+    active = threading.BoundedSemaphore(max_active) if max_active else None
+
+    def drain(iterable):
+        try:
+            for item in iterable:
+                queue.put((item, None))
+        except Exception:
+            queue.put((_DONE, sys.exc_info()))
+        else:
+            queue.put((_DONE, None))
+        finally:
+            if active is not None:
+                active.release()
+
+    def start():
+        count = 0
+        try:
+            for iterable in iterables:
+                if active is not None:
+                    active.acquire()
+                thread = threading.Thread(target=drain, args=(iterable,))
+                thread.daemon = True
+                thread.start()
+                count += 1
+        except Exception:
+            queue.put((_STARTED, sys.exc_info()))
+        else:
+            queue.put((_STARTED, count))
+
+    starter = threading.Thread(target=start)
+    starter.daemon = True
+    starter.start()
+
+    done = 0
+    started = None
+    while started is None or done < started:
+        try:
+            item, info = queue.get(True, POLL_INTERVAL)
+        except six.moves.queue.Empty:
+            continue
+        if item is _STARTED:
+            if isinstance(info, tuple):
+                six.reraise(*info)
+            started = info
+            continue
+        if item is _DONE:
+            if info is not None:
+                six.reraise(*info)
+            done += 1
+            continue
+        yield item
+
+
+class ReorderBuffer(object):
+    """Re-sorts a nearly ordered stream of events by ``timestamp``.
+
+    Events are held in a heap and released once they are ``window_ms``
+    older than the newest event seen, or once more than ``window_events``
+    are held. An event older than one already released is late: it is
+    passed through straight away and counted.
+    """
+
+    def __init__(self, window_ms=None, window_events=None):
+        self.window_ms = window_ms
+        self.window_events = window_events
+        self.count = 0
+        self.late = 0
+        self.max_lateness = 0
+        self._heap = []
+        self._sequence = 0
+        self._newest = None
+        self._released = None
+
+    def push(self, event):
+        """Adds ``event``; returns the events released by it, in order."""
+        timestamp = event['timestamp']
+        self.count += 1
+        if self._released is not None and timestamp < self._released:
+            self.late += 1
+            self.max_lateness = max(self.max_lateness, self._released - timestamp)
+            return [event]
+        heapq.heappush(self._heap, (timestamp, self._sequence, event))
+        self._sequence += 1
+        if self._newest is None or timestamp > self._newest:
+            self._newest = timestamp
+        released = []
+        if self.window_events is not None:
+            while len(self._heap) > self.window_events:
+                released.append(self._pop())
+        if self.window_ms is not None:
+            released.extend(self.release(self._newest - self.window_ms))
+        return released
+
+    def release(self, timestamp):
+        """Returns the held events up to ``timestamp``, in order."""
+        released = []
+        while self._heap and self._heap[0][0] <= timestamp:
+            released.append(self._pop())
+        return released
+
+    def tick(self, now):
+        """Returns the held events an idle source can no longer reorder: those
+        older than ``now`` minus the time window, or all of them when only an
+        event count window is set."""
+        if self.window_ms is None:
+            return self.drain()
+        return self.release(now - self.window_ms)
+
+    def drain(self):
+        """Returns every held event, in order."""
+        released = []
+        while self._heap:
+            released.append(self._pop())
+        return released
+
+    def reorder(self, events):
+        """Yields ``events`` re-sorted within the window."""
+        for event in events:
+            for released in self.push(event):
+                yield released
+        for released in self.drain():
+            yield released
+
+    def _pop(self):
+        timestamp, _, event = heapq.heappop(self._heap)
+        self._released = timestamp
+        return event
+
+
+class ReorderWindow(object):
+    """Settings for, and combined counters of, every ``ReorderBuffer`` of a run."""
+
+    def __init__(self, window_ms=None, window_events=None):
+        self.window_ms = window_ms
+        self.window_events = window_events
+        self.buffers = []
+
+    def new_buffer(self):
+        buffer = ReorderBuffer(self.window_ms, self.window_events)
+        self.buffers.append(buffer)
+        return buffer
+
+    def summary(self):
+        count = sum(buffer.count for buffer in self.buffers)
+        late = sum(buffer.late for buffer in self.buffers)
+        max_lateness = max([0] + [buffer.max_lateness for buffer in self.buffers])
+        return ("{0} of {1} events arrived later than the reorder window "
+                "(at most {2}ms behind).").format(late, count, max_lateness)
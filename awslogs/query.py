@@ -0,0 +1,222 @@
+import re
+import jmespath
+from botocore.compat import json, six
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Node types evaluated against the result of their first child.
+_CHAINED_NODES = ('subexpression', 'index_expression', 'projection',
+                  'value_projection', 'filter_projection', 'pipe', 'flatten')
+
+# Node types evaluated by combining children evaluated against the same value.
+_COMBINED_NODES = ('multi_select_list', 'multi_select_dict', 'key_val_pair',
+                   'or_expression', 'and_expression', 'not_expression',
+                   'comparator', 'function_expression')
+
+# Members scanned before giving up and decoding the whole document; the
+# C decoder is faster than a member-by-member scan once the keys are not near
+# the start of the document.
+SCAN_MEMBER_LIMIT = 8
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# Field names which can be written in a CloudWatch JSON selector as is.
+_SELECTOR_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Maximum length of a CloudWatch Logs filter pattern.
+MAX_FILTER_PATTERN_LENGTH = 1024
+
+_decoder = json.JSONDecoder()
+
+
+def root_fields(node):
+    """Returns the top-level keys a parsed JMESPath expression reads.
+
+    Returns ``None`` when the expression uses the whole document, e.g.
+    ``@`` or ``*`` at the top level.
+    """
+    node_type = node['type']
+    if node_type == 'field':
+        return set([node['value']])
+    if node_type in ('literal', 'expref'):
+        # Expression references are applied to elements of other arguments.
+        return set()
+    if node_type in _CHAINED_NODES:
+        return root_fields(node['children'][0])
+    if node_type in _COMBINED_NODES:
+        fields = set()
+        for child in node['children']:
+            child_fields = root_fields(child)
+            if child_fields is None:
+                return None
+            fields |= child_fields
+        return fields
+    return None
+
+
+def is_truthy(value):
+    """Returns whether ``value`` is true by JMESPath's rules."""
+    return not (value is None or value is False or value == '' or
+                value == [] or value == {})
+
+
+def pushdown_terms(node):
+    """Returns CloudWatch JSON filter terms implied by ``node`` being true.
+
+    Only ``path == literal`` conjuncts are translated; every term matches at
+    least the events for which its conjunct holds, so the expression must
+    still be evaluated locally.
+    """
+    node_type = node['type']
+    if node_type == 'and_expression':
+        return pushdown_terms(node['children'][0]) + pushdown_terms(node['children'][1])
+    if node_type == 'comparator' and node['value'] == 'eq':
+        left, right = node['children']
+        if left['type'] == 'literal':
+            left, right = right, left
+        selector = _selector(left)
+        if selector is not None and right['type'] == 'literal':
+            value = right['value']
+            if value is True or value is False:
+                return ['{0} IS {1}'.format(selector, str(value).upper())]
+            if isinstance(value, six.integer_types + (float,)):
+                return ['{0} = {1}'.format(selector, json.dumps(value))]
+            if isinstance(value, six.string_types) and not any(c in value for c in '*"\\'):
+                return [u'{0} = "{1}"'.format(selector, value)]
+    return []
+
+
+def _selector(node):
+    """Returns the CloudWatch selector for a plain ``a.b.c`` field path."""
+    if node['type'] == 'field':
+        if _SELECTOR_NAME.match(node['value']):
+            return '$.' + node['value']
+    elif node['type'] == 'subexpression':
+        left, right = [_selector(child) for child in node['children']]
+        if left is not None and right is not None:
+            return left + right[1:]
+    return None
+
+
+def pushdown_filter_pattern(where, filter_pattern):
+    """Returns ``filter_pattern`` narrowed by the conjuncts of the JMESPath
+    expression ``where`` which CloudWatch can evaluate.
+
+    ``filter_pattern`` is returned unchanged when nothing can be pushed down
+    or when it is not a JSON pattern, since term and JSON patterns cannot be
+    combined.
+    """
+    terms = pushdown_terms(jmespath.compile(where).parsed)
+    if not terms:
+        return filter_pattern
+    if filter_pattern and filter_pattern.strip():
+        user_pattern = filter_pattern.strip()
+        if not (user_pattern.startswith('{') and user_pattern.endswith('}')):
+            return filter_pattern
+        terms.insert(0, user_pattern[1:-1].strip())
+    if len(terms) > 1:
+        terms = [u'({0})'.format(term) for term in terms]
+    pattern = u'{{ {0} }}'.format(u' && '.join(terms))
+    if len(pattern) > MAX_FILTER_PATTERN_LENGTH:
+        return filter_pattern
+    return pattern
+
+
+def scan_fields(document, fields, limit=None):
+    """Decodes only ``fields`` of the JSON object ``document``.
+
+    Scanning stops as soon as every field has been found, so the rest of the
+    document is not decoded at all. Returns ``None`` if they were not all
+    found within the first ``limit`` members.
+    """
+    found = {}
+    remaining = len(fields)
+    end = _WHITESPACE.match(document, 1).end()
+    if document[end:end + 1] == '}':
+        return found
+    while remaining:
+        if limit is not None:
+            if not limit:
+                return None
+            limit -= 1
+        if document[end:end + 1] != '"':
+            raise ValueError("Expecting property name at {0}".format(end))
+        key, end = json.decoder.scanstring(document, end + 1)
+        end = _WHITESPACE.match(document, end).end()
+        if document[end:end + 1] != ':':
+            raise ValueError("Expecting ':' delimiter at {0}".format(end))
+        end = _WHITESPACE.match(document, end + 1).end()
+        try:
+            value, end = _decoder.scan_once(document, end)
+        except StopIteration:
+            raise ValueError("Expecting value at {0}".format(end))
+        if key in fields and key not in found:
+            found[key] = value
+            remaining -= 1
+        end = _WHITESPACE.match(document, end).end()
+        delimiter = document[end:end + 1]
+        if delimiter == '}':
+            break
+        if delimiter != ',':
+            raise ValueError("Expecting ',' delimiter at {0}".format(end))
+        end = _WHITESPACE.match(document, end + 1).end()
+    return found
+
+
+class QueryEngine(object):
+    """Evaluates a JMESPath query against JSON log messages.
+
+    The keys the query reads are worked out once. Messages which do not
+    mention any of them are not decoded at all. The others are decoded with
+    ``orjson`` when it is installed, or else scanned for just those keys,
+    falling back to a full decode when they are not near the start.
+    """
+
+    def __init__(self, query):
+        self.expression = jmespath.compile(query)
+        self.fields = root_fields(self.expression.parsed)
+        if self.fields is not None:
+            self.quoted_fields = [json.dumps(f, ensure_ascii=False) for f in self.fields]
+
+    def search(self, document):
+        """Returns the result of the query against the JSON object ``document``."""
+        return self.expression.search(self.decode(document))
+
+    def decode(self, document):
+        """Returns ``document`` decoded far enough to evaluate the query."""
+        if self.fields is None:
+            return self.__loads(document)
+        if '\\u' not in document and not any(f in document for f in self.quoted_fields):
+            # None of the keys can be present.
+            return {}
+        if orjson is None:
+            found = scan_fields(document, self.fields, SCAN_MEMBER_LIMIT)
+            if found is not None:
+                return found
+        return self.__loads(document)
+
+    def __loads(self, document):
+        if orjson is not None:
+            return orjson.loads(document)
+        return json.loads(document)
+
+    def matches(self, document):
+        """Returns whether the query is true for ``document``; messages which
+        are not JSON objects never match."""
+        if document[:1] != '{':
+            return False
+        try:
+            return is_truthy(self.search(document))
+        except ValueError:
+            return False
+
+    def format(self, document):
+        """Returns the query result for ``document`` rendered as text."""
+        result = self.search(document)
+        if not isinstance(result, six.string_types):
+            result = json.dumps(result)
+        return result
@@ -11,7 +11,12 @@ class QueryTemplate(object):
         processed_query = self.__populate_query_template(query_template_file, *template_args)
 
         self.log_group_name = self.__validate_arg(processed_query, 'log_group_name')
-        self.log_stream_prefix = self.__validate_arg(processed_query, 'log_stream_prefix')
+        self.insights_query = processed_query.get('insights_query')
+        if self.insights_query:
+            # Logs Insights queries the whole group unless a prefix is given.
+            self.log_stream_prefix = processed_query.get('log_stream_prefix')
+        else:
+            self.log_stream_prefix = self.__validate_arg(processed_query, 'log_stream_prefix')
         self.filter_pattern = processed_query.get('filter_pattern')
         self.output_format = processed_query.get('query')
 
@@ -0,0 +1,151 @@
+import time
+import random
+import threading
+
+from botocore.exceptions import ClientError
+
+try:
+    from botocore.paginate import TokenEncoder
+except ImportError:
+    # Older botocore takes the service's token as the starting token.
+    TokenEncoder = None
+
+
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'Throttling',
+                          'TooManyRequestsException', 'RequestLimitExceeded')
+
+# CloudWatch Logs allows a handful of requests per second per account and
+# region for most read APIs; the rate adapts from there.
+DEFAULT_RATE = 5.0
+DEFAULT_BURST = 10
+MIN_RATE = 0.5
+MAX_RATE = 100.0
+
+# Requests per second added after every successful call, and the factor
+# applied to the rate on every throttle.
+ADDITIVE_INCREASE = 0.1
+MULTIPLICATIVE_DECREASE = 0.5
+
+MAX_RETRIES = 8
+BASE_RETRY_DELAY = 0.25
+MAX_RETRY_DELAY = 20.0
+
+
+def is_throttling(exc):
+    return (isinstance(exc, ClientError) and
+            exc.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES)
+
+
+class RateLimiter(object):
+    """Token bucket shared by every API call, with AIMD rate adaptation.
+
+    The rate grows by ``ADDITIVE_INCREASE`` requests per second with every
+    successful call and is cut by ``MULTIPLICATIVE_DECREASE`` on every
+    throttle. Throttled calls are retried after a jittered exponential
+    delay.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, min_rate=MIN_RATE,
+                 max_rate=MAX_RATE, max_retries=MAX_RETRIES,
+                 clock=time.time, sleep=time.sleep, random=random.random):
+        self.rate = float(rate)
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, self.rate)
+        self.max_retries = max_retries
+        self.clock = clock
+        self.sleep = sleep
+        self.random = random
+        self.calls = 0
+        self.throttles = 0
+        self.retry_delay = 0.0
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Waits for a token. Tokens are reserved in order, so concurrent
+        callers are spaced out instead of all waking up at once."""
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+            self.calls += 1
+        if wait:
+            self.sleep(wait)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + ADDITIVE_INCREASE)
+
+    def throttled(self, attempt):
+        """Slows down after a throttle and waits before retry ``attempt``."""
+        delay = self.random() * min(MAX_RETRY_DELAY, BASE_RETRY_DELAY * 2 ** attempt)
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * MULTIPLICATIVE_DECREASE)
+            self._tokens = min(self._tokens, 0)
+            self.throttles += 1
+            self.retry_delay += delay
+        self.sleep(delay)
+
+    def call(self, func, **kwargs):
+        """Returns ``func(**kwargs)``, retrying it while it is throttled."""
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = func(**kwargs)
+            except ClientError as exc:
+                if not is_throttling(exc) or attempt >= self.max_retries:
+                    raise
+                self.throttled(attempt)
+                attempt += 1
+                continue
+            self.succeeded()
+            return result
+
+    def paginate(self, paginator, kwargs, token_key='nextToken'):
+        """Yields the pages of a boto3 ``paginator``.
+
+        A throttled page is retried by resuming the paginator with a
+        ``StartingToken`` built from the last page's ``token_key``. A page
+        without ``token_key`` is the last one, so no token is taken for the
+        exhausted paginator after it.
+        """
+        token = None
+        attempt = 0
+        while True:
+            if token is None:
+                pages = iter(paginator.paginate(**kwargs))
+            else:
+                starting_token = token
+                if TokenEncoder is not None:
+                    starting_token = TokenEncoder().encode({token_key: token})
+                pages = iter(paginator.paginate(PaginationConfig={'StartingToken': starting_token},
+                                                **kwargs))
+            first = True
+            while True:
+                if first or token is not None:
+                    self.acquire()
+                first = False
+                try:
+                    page = next(pages)
+                except StopIteration:
+                    return
+                except ClientError as exc:
+                    if not is_throttling(exc) or attempt >= self.max_retries:
+                        raise
+                    self.throttled(attempt)
+                    attempt += 1
+                    break
+                self.succeeded()
+                attempt = 0
+                token = page.get(token_key)
+                yield page
+
+    def summary(self):
+        return ("{0} requests, {1} throttled, {2:.1f}s spent waiting to retry; "
+                "final rate {3:.1f} requests/s.").format(
+                    self.calls, self.throttles, self.retry_delay, self.rate)
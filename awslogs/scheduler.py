@@ -0,0 +1,110 @@
+import sys
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from botocore.compat import six
+
+from .pipeline import POLL_INTERVAL, MAX_BUFFERED_ITEMS
+
+
+DEFAULT_MAX_IN_FLIGHT = 10
+
+
+def _has_next_token(response):
+    return 'nextToken' in response
+
+
+def _item_count(response):
+    """Returns the number of events, streams etc. listed in ``response``."""
+    return max(sum(len(value) for value in response.values() if isinstance(value, list)), 1)
+
+
+class CursorScheduler(object):
+    """Runs the page requests of many pagination cursors on one fixed pool
+    of ``max_in_flight`` threads.
+
+    Every cursor requests its next page as soon as the previous one arrives,
+    buffering up to as many items as a ``BackgroundIterator``, so all cursors
+    are fetching concurrently while their events are consumed on the calling
+    thread, without a thread per cursor.
+    """
+
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self._pool = ThreadPool(max_in_flight)
+
+    def paginate(self, request, kwargs, more=_has_next_token):
+        """Returns a ``Cursor`` over the responses of ``request(**kwargs)``."""
+        return Cursor(self._pool, request, kwargs, more)
+
+
+class Cursor(object):
+    """Iterator over the pages of one paginated request.
+
+    The first page is requested straight away. Once a page arrives the next
+    one is requested with its ``nextToken``, for as long as ``more(page)``,
+    until the pages waiting to be consumed hold ``max_buffered`` items; it
+    resumes when the consumer takes one.
+    """
+
+    def __init__(self, pool, request, kwargs, more, max_buffered=MAX_BUFFERED_ITEMS):
+        self._pool = pool
+        self._request = request
+        self._kwargs = dict(kwargs)
+        self._more = more
+        self.max_buffered = max_buffered
+        self._pages = deque()
+        self._buffered = 0
+        self._fetching = False
+        self._finished = False
+        self._error = None
+        self._condition = threading.Condition()
+        with self._condition:
+            self._submit()
+
+    def _submit(self):
+        self._fetching = True
+        self._pool.apply_async(self._fetch, (dict(self._kwargs),))
+
+    def _fetch(self, kwargs):
+        """Requests one page on the pool and, room permitting, the next."""
+        try:
+            response = self._request(**kwargs)
+        except Exception:
+            with self._condition:
+                self._error = sys.exc_info()
+                self._fetching = False
+                self._condition.notify()
+            return
+        with self._condition:
+            self._pages.append(response)
+            self._buffered += _item_count(response)
+            self._fetching = False
+            if self._more(response):
+                self._kwargs['nextToken'] = response['nextToken']
+                if self._buffered < self.max_buffered:
+                    self._submit()
+            else:
+                self._finished = True
+            self._condition.notify()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._condition:
+            while not self._pages:
+                if self._error is not None:
+                    six.reraise(*self._error)
+                if self._finished:
+                    raise StopIteration
+                # A wait without a timeout cannot be interrupted in Python 2.
+                self._condition.wait(POLL_INTERVAL)
+            response = self._pages.popleft()
+            self._buffered -= _item_count(response)
+            if not (self._finished or self._fetching or self._error) and self._buffered < self.max_buffered:
+                self._submit()
+            return response
+
+    next = __next__
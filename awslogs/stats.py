@@ -0,0 +1,259 @@
+import sys
+import math
+from collections import Counter, defaultdict
+
+from botocore.compat import json, six
+
+from .logprinter import milis2iso
+from .query import QueryEngine
+
+
+DEFAULT_PERCENTILES = (50, 90, 99)
+
+# Maximum relative error of the percentiles.
+RELATIVE_ERROR = 0.01
+
+# Events handed to ``Aggregator.add_events`` at a time.
+BATCH_SIZE = 1000
+
+# Groups beyond this many are counted together, to bound the memory used.
+MAX_GROUPS = 10000
+
+OTHER_GROUP = '(other)'
+
+
+class LogHistogram(object):
+    """Streaming histogram with logarithmic buckets, for percentiles.
+
+    A value ``v > 0`` falls in bucket ``ceil(log(v, gamma))`` and is
+    estimated by the bucket's midpoint, within ``relative_error`` of it;
+    negative values mirror this and zeros are counted apart. Memory grows
+    with the dynamic range of the values, not their number: about 2400
+    buckets span 1e-9 to 1e12 at 1%.
+    """
+
+    def __init__(self, relative_error=RELATIVE_ERROR):
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = Counter()
+        self.negative = Counter()
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.add_many([value])
+
+    def add_many(self, values):
+        """Adds a batch of numbers."""
+        if not values:
+            return
+        log, ceil, log_gamma = math.log, math.ceil, self.log_gamma
+        self.positive.update([int(ceil(log(v) / log_gamma)) for v in values if v > 0])
+        self.negative.update([int(ceil(log(-v) / log_gamma)) for v in values if v < 0])
+        self.zeros += sum(1 for v in values if v == 0)
+        self.count += len(values)
+        self.total += sum(values)
+        low, high = min(values), max(values)
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def percentile(self, percentile):
+        """Returns an estimate of the value below which ``percentile``% of the values fall."""
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(self.count * percentile / 100.0)), 1)
+        if rank == 1:
+            return self.min
+        if rank >= self.count:
+            return self.max
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen >= rank:
+                return self.__clamp(-self.__midpoint(index))
+        seen += self.zeros
+        if seen >= rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen >= rank:
+                return self.__clamp(self.__midpoint(index))
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def __midpoint(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def __clamp(self, value):
+        return min(max(value, self.min), self.max)
+
+
+def number(value):
+    """Returns ``value`` as a float if it is a finite number or numeric string."""
+    if isinstance(value, bool) or not isinstance(value, six.integer_types + (float,) + six.string_types):
+        return None
+    try:
+        result = float(value)
+    except (ValueError, OverflowError):
+        return None
+    if math.isinf(result) or math.isnan(result):
+        return None
+    return result
+
+
+def group_name(value):
+    if value is None:
+        return '-'
+    if isinstance(value, six.string_types):
+        return value
+    return json.dumps(value)
+
+
+class Aggregator(object):
+    """Counts events, and summarises a numeric value, per group.
+
+    ``by`` and ``value`` are JMESPath expressions evaluated against JSON
+    messages; both are decoded in one pass. Without ``by`` all events form a
+    single group, and without ``value`` they are only counted. With
+    ``bucket_ms`` the events of every group are also counted per time bucket.
+    ``where`` keeps only the JSON events for which it is true.
+    """
+
+    def __init__(self, by=None, value=None, bucket_ms=None, where=None,
+                 relative_error=RELATIVE_ERROR, max_groups=MAX_GROUPS):
+        self.by = by
+        self.value = value
+        self.bucket_ms = bucket_ms
+        self.relative_error = relative_error
+        self.max_groups = max_groups
+        expressions = [e for e in (by, value) if e]
+        self.engine = QueryEngine('[{0}]'.format(', '.join(expressions))) if expressions else None
+        self.where_engine = QueryEngine(where) if where else None
+        self.counts = Counter()
+        self.histograms = {}
+        self.buckets = defaultdict(Counter)
+        self.first = None
+        self.last = None
+
+    def add_events(self, events):
+        """Adds a batch of events."""
+        if self.where_engine is not None:
+            events = [e for e in events if self.where_engine.matches(e['message'])]
+        if not events:
+            return
+        keys = []
+        values = defaultdict(list)
+        for event in events:
+            key, value = self.__extract(event['message'])
+            keys.append(key)
+            if value is not None:
+                values[key].append(value)
+        self.counts.update(keys)
+        for key, batch in values.items():
+            if key not in self.histograms:
+                self.histograms[key] = LogHistogram(self.relative_error)
+            self.histograms[key].add_many(batch)
+        if self.bucket_ms:
+            for key, event in zip(keys, events):
+                timestamp = event['timestamp']
+                self.buckets[timestamp - timestamp % self.bucket_ms][key] += 1
+        timestamps = [e['timestamp'] for e in events]
+        self.first = min([self.first] + timestamps) if self.first is not None else min(timestamps)
+        self.last = max([self.last] + timestamps) if self.last is not None else max(timestamps)
+
+    def __extract(self, message):
+        """Returns the group and numeric value of one message."""
+        if self.engine is None:
+            return '', None
+        result = [None, None]
+        if message[:1] == '{':
+            try:
+                result = self.engine.search(message)
+            except ValueError:
+                pass
+        if self.by:
+            key, value = group_name(result[0]), (number(result[1]) if self.value else None)
+        else:
+            key, value = '', number(result[0])
+        if key not in self.counts and len(self.counts) >= self.max_groups:
+            key = OTHER_GROUP
+        return key, value
+
+    def rows(self, percentiles=DEFAULT_PERCENTILES):
+        """Returns the summary table: a header and one row per group, busiest first."""
+        seconds = max((self.last - self.first) / 1000.0, 1.0) if self.first is not None else 1.0
+        header = ['group'] if self.by else []
+        header += ['count', 'rate/s']
+        if self.value:
+            header += ['min', 'mean'] + ['p{0:g}'.format(p) for p in percentiles] + ['max']
+        rows = [header]
+        for key, count in _busiest_first(self.counts):
+            row = [key] if self.by else []
+            row += [str(count), _format(count / seconds)]
+            if self.value:
+                histogram = self.histograms.get(key) or LogHistogram(self.relative_error)
+                row += [_format(histogram.min), _format(histogram.mean())]
+                row += [_format(histogram.percentile(p)) for p in percentiles]
+                row += [_format(histogram.max)]
+            rows.append(row)
+        return rows
+
+    def bucket_rows(self):
+        """Returns the per time bucket counts and rates as a table."""
+        header = ['bucket'] + (['group'] if self.by else []) + ['count', 'rate/s']
+        rows = [header]
+        for bucket in sorted(self.buckets):
+            for key, count in _busiest_first(self.buckets[bucket]):
+                row = [milis2iso(bucket)] + ([key] if self.by else [])
+                rows.append(row + [str(count), _format(count * 1000.0 / self.bucket_ms)])
+        return rows
+
+
+def _busiest_first(counts):
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+def _format(value):
+    if value is None:
+        return '-'
+    return '{0:.4g}'.format(value)
+
+
+def format_table(rows):
+    """Renders ``rows`` as left aligned columns."""
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+                     for row in rows)
+
+
+class StatsPrinter(object):
+    """Has the interface of ``LogPrinter`` but feeds the events to an
+    ``Aggregator`` in batches of ``BATCH_SIZE``, and writes its summary to
+    ``stream`` once closed."""
+
+    def __init__(self, aggregator, percentiles=DEFAULT_PERCENTILES, stream=None):
+        self.aggregator = aggregator
+        self.percentiles = percentiles
+        self.stream = stream or sys.stdout
+        self._batch = []
+
+    def print_log(self, event):
+        self._batch.append(event)
+        if len(self._batch) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.aggregator.add_events(self._batch)
+        self._batch = []
+
+    def close(self):
+        self.flush()
+        self.stream.write(format_table(self.aggregator.rows(self.percentiles)) + '\n')
+        if self.aggregator.bucket_ms:
+            self.stream.write('\n' + format_table(self.aggregator.bucket_rows()) + '\n')
+        self.stream.flush()
@@ -0,0 +1,123 @@
+import time
+
+
+# Streams whose newest event is older than this (in ms) relative to the
+# newest event overall are no longer polled for late events.
+LATE_EVENT_HORIZON = 60000
+
+# Streams whose newest event is older than this (in ms) relative to the
+# newest event overall are polled for late events on their own, so they do
+# not make the busy streams re-read their recent past.
+RECENT_MARK_LAG = 5000
+
+# Seconds of polling between listings of the tailed streams, to pick up
+# streams created since.
+STREAM_REFRESH_INTERVAL = 30
+
+MIN_POLL_INTERVAL = 0.5
+MAX_POLL_INTERVAL = 10.0
+
+
+class HighWaterMarks(object):
+    """Newest timestamp, and the event ids seen at it, for every stream.
+
+    ``streams`` without a mark yet are polled like lagging ones, so their
+    first events are not skipped because other streams have moved ahead.
+    """
+
+    def __init__(self, start_time=None, streams=(), horizon=LATE_EVENT_HORIZON,
+                 recent_lag=RECENT_MARK_LAG):
+        self.initial_start_time = start_time
+        self.horizon = horizon
+        self.recent_lag = recent_lag
+        self._marks = {}
+        self._unmarked = set(streams or ())
+
+    def add_streams(self, streams):
+        """Starts tracking newly discovered ``streams``."""
+        self._unmarked.update(stream for stream in streams if stream not in self._marks)
+
+    def add(self, event):
+        """Records ``event``. Returns ``False`` if it is behind its stream's mark
+        or was already seen at it."""
+        stream = event['logStreamName']
+        timestamp = event['timestamp']
+        mark = self._marks.get(stream)
+        if mark is None or timestamp > mark[0]:
+            self._marks[stream] = (timestamp, set([event['eventId']]))
+            self._unmarked.discard(stream)
+            return True
+        if timestamp == mark[0] and event['eventId'] not in mark[1]:
+            mark[1].add(event['eventId'])
+            return True
+        return False
+
+    def start_time(self):
+        """Returns the ``startTime`` for the next poll of all streams: the
+        oldest mark within ``recent_lag`` of the newest one."""
+        if not self._marks:
+            return self.initial_start_time
+        timestamps = [timestamp for timestamp, _ in self._marks.values()]
+        newest = max(timestamps)
+        return min(t for t in timestamps if t >= newest - self.recent_lag)
+
+    def lagging(self):
+        """Returns the streams whose marks fall behind the start of the next
+        poll but within ``horizon``, and the oldest of those marks, or
+        ``None``. They are polled for late events up to that start.
+
+        Streams without a mark are included from ``horizon`` before the
+        newest mark, but not before the initial start time.
+        """
+        if not self._marks:
+            return None
+        newest = max(timestamp for timestamp, _ in self._marks.values())
+        lagging = dict((stream, timestamp) for stream, (timestamp, _) in self._marks.items()
+                       if newest - self.horizon <= timestamp < newest - self.recent_lag)
+        floor = max(newest - self.horizon, self.initial_start_time or 0)
+        if floor < self.start_time():
+            lagging.update((stream, floor) for stream in self._unmarked)
+        if not lagging:
+            return None
+        return sorted(lagging), min(lagging.values())
+
+
+class PollInterval(object):
+    """Delay between polls; shrinks while events flow and backs off when idle."""
+
+    def __init__(self, initial=1.0, minimum=MIN_POLL_INTERVAL, maximum=MAX_POLL_INTERVAL):
+        self.current = initial
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def next(self, event_count):
+        if event_count:
+            self.current = max(self.minimum, self.current / 2)
+        else:
+            self.current = min(self.maximum, self.current * 1.5)
+        return self.current
+
+
+class LagTracker(object):
+    """Tracks the delay between ``ingestionTime`` and display time."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+        self.last = None
+
+    def record(self, event):
+        lag = max(int(self.clock() * 1000) - event['ingestionTime'], 0)
+        self.count += 1
+        self.total += lag
+        self.maximum = max(self.maximum, lag)
+        self.last = lag
+
+    def summary(self):
+        if not self.count:
+            return "No events displayed."
+        return ("Ingestion to display lag over {0} events: "
+                "last {1}ms, average {2}ms, max {3}ms.").format(
+                    self.count, self.last, self.total // self.count, self.maximum)
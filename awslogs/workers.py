@@ -0,0 +1,92 @@
+import signal
+import multiprocessing
+from collections import deque
+
+from .logprinter import LogFormatter, LogPrinter
+from .pipeline import POLL_INTERVAL
+
+
+CHUNK_SIZE = 1000
+
+# Chunks queued or being formatted per worker process.
+CHUNKS_IN_FLIGHT_PER_WORKER = 2
+
+_formatter = None
+
+
+def _init_worker(log_group_name, max_stream_length, options):
+    global _formatter
+    # Ctrl-C is handled by the parent process.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _formatter = LogFormatter(log_group_name, max_stream_length, **options)
+
+
+def _format_chunk(events):
+    return _formatter.format_logs(events)
+
+
+class ParallelLogPrinter(LogPrinter):
+    """``LogPrinter`` which decodes, queries and formats events in a pool of
+    ``workers`` processes.
+
+    Events are sent to the pool in chunks of ``chunk_size`` and the formatted
+    lines are written in the order the events arrived. At most a couple of
+    chunks per worker are outstanding, so a slow writer holds back the fetch.
+    Output files are rotated between chunks; a chunk never spans two
+    ``rotate_interval`` buckets.
+    """
+
+    def __init__(self, log_group_name, max_stream_length, workers, chunk_size=CHUNK_SIZE, **kwargs):
+        super(ParallelLogPrinter, self).__init__(log_group_name, max_stream_length, **kwargs)
+        options = dict((k, v) for k, v in kwargs.items()
+                       if k not in ('stream', 'output_files'))
+        self.pool = multiprocessing.Pool(workers, _init_worker,
+                                         (log_group_name, max_stream_length, options))
+        self.chunk_size = chunk_size
+        self.max_in_flight = workers * CHUNKS_IN_FLIGHT_PER_WORKER
+        self._chunk = []
+        self._in_flight = deque()
+
+    def print_log(self, event):
+        if self.output_files is not None and self._chunk:
+            bucket = self.output_files.bucket
+            if bucket(event['timestamp']) != bucket(self._chunk[0]['timestamp']):
+                self._submit()
+        self._chunk.append(event)
+        if len(self._chunk) >= self.chunk_size:
+            self._submit()
+
+    def flush(self):
+        """Formats and writes out every event received so far."""
+        self._submit()
+        while self._in_flight:
+            self._write_next()
+        super(ParallelLogPrinter, self).flush()
+
+    def close(self):
+        try:
+            super(ParallelLogPrinter, self).close()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+    def _submit(self):
+        if not self._chunk:
+            return
+        if len(self._in_flight) >= self.max_in_flight:
+            self._write_next()
+        self._in_flight.append((self._chunk[0]['timestamp'],
+                                self.pool.apply_async(_format_chunk, (self._chunk,))))
+        self._chunk = []
+
+    def _write_next(self):
+        timestamp, result = self._in_flight.popleft()
+        while not result.ready():
+            # A wait without a timeout cannot be interrupted in Python 2.
+            result.wait(POLL_INTERVAL)
+        lines = result.get()
+        if not lines:
+            return
+        if self.output_files is not None:
+            self.rotate(timestamp)
+        self.writer.write_lines(lines)
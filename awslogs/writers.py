@@ -0,0 +1,127 @@
+import csv
+from collections import OrderedDict
+
+from botocore.compat import json, six
+
+from . import exceptions
+
+
+OUTPUT_FORMATS = ('text', 'jsonl', 'csv', 'parquet')
+
+EVENT_FIELDS = ('logGroupName', 'logStreamName', 'timestamp', 'ingestionTime', 'eventId', 'message')
+
+DEFAULT_FIELDS = ('logGroupName', 'logStreamName', 'timestamp', 'ingestionTime', 'message')
+
+PARQUET_ROW_GROUP_SIZE = 100000
+
+
+def parse_fields(text):
+    """Parses a comma separated list of event fields."""
+    fields = tuple(field.strip() for field in text.split(',') if field.strip())
+    unknown = [field for field in fields if field not in EVENT_FIELDS]
+    if unknown or not fields:
+        raise ValueError("unknown fields {0}; expected some of {1}".format(
+            ', '.join(unknown), ', '.join(EVENT_FIELDS)))
+    return fields
+
+
+def record_formatter(output_format, fields, log_group_name):
+    """Returns a function rendering ``(event, message)`` as an output record
+    of ``output_format``: a line of JSON or CSV, or a tuple of values."""
+    def values(event, message):
+        return [message if field == 'message' else
+                event.get(field, log_group_name) if field == 'logGroupName' else
+                event.get(field)
+                for field in fields]
+
+    if output_format == 'jsonl':
+        return lambda event, message: json.dumps(OrderedDict(zip(fields, values(event, message))))
+    if output_format == 'csv':
+        row = _CsvRow()
+        return lambda event, message: row.format(values(event, message))
+    if output_format == 'parquet':
+        return lambda event, message: tuple(values(event, message))
+    raise ValueError("unknown output format {0}".format(output_format))
+
+
+def csv_header(fields):
+    return _CsvRow().format(fields)
+
+
+class _CsvRow(object):
+    """Renders a list of values as one CSV record without its line end."""
+
+    def __init__(self):
+        self._writer = csv.writer(self, lineterminator='\n')
+        self._row = None
+
+    def write(self, row):
+        self._row = row
+
+    def format(self, values):
+        if six.PY2:
+            values = [value.encode('utf-8') if isinstance(value, six.text_type) else value
+                      for value in values]
+            self._writer.writerow(values)
+            return self._row[:-1].decode('utf-8')
+        self._writer.writerow(values)
+        return self._row[:-1]
+
+
+def binary_stream(stream):
+    """Returns the byte stream underneath a text ``stream`` such as stdout."""
+    return getattr(stream, 'buffer', None) or getattr(stream, 'stream', None) or stream
+
+
+class ParquetWriter(object):
+    """Writes event rows to ``stream`` as Parquet, ``row_group_size`` at a time.
+
+    Has the interface of ``OutputWriter``, taking rows of ``fields`` values
+    instead of lines. Requires ``pyarrow``.
+    """
+
+    def __init__(self, stream, fields, row_group_size=PARQUET_ROW_GROUP_SIZE):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise exceptions.AWSLogsException(
+                "--output-format=parquet requires pyarrow: pip install pyarrow")
+        self._pa = pyarrow
+        types = {'timestamp': pyarrow.timestamp('ms', tz='UTC'),
+                 'ingestionTime': pyarrow.timestamp('ms', tz='UTC')}
+        self.schema = pyarrow.schema([(field, types.get(field, pyarrow.string())) for field in fields])
+        self.row_group_size = row_group_size
+        self._writer = pyarrow.parquet.ParquetWriter(binary_stream(stream), self.schema)
+        self._rows = []
+        self._closed = False
+
+    def write_line(self, row):
+        self.write_lines([row])
+
+    def write_lines(self, rows):
+        self._rows.extend(rows)
+        while len(self._rows) >= self.row_group_size:
+            self._write(self._rows[:self.row_group_size])
+            self._rows = self._rows[self.row_group_size:]
+
+    @property
+    def buffered_size(self):
+        """Rows are only counted towards the size of the output once written."""
+        return 0
+
+    def flush(self):
+        if self._rows:
+            self._write(self._rows)
+            self._rows = []
+
+    def close(self):
+        if not self._closed:
+            self.flush()
+            self._writer.close()
+            self._closed = True
+
+    def _write(self, rows):
+        columns = [self._pa.array(list(column), type=field.type)
+                   for column, field in zip(zip(*rows), self.schema)]
+        self._writer.write_table(self._pa.Table.from_arrays(columns, schema=self.schema))
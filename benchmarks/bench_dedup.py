@@ -0,0 +1,60 @@
+"""Micro-benchmark for event id de-duplication in ``AWSLogGenerator``.
+
+Compares the previous ``deque`` scan against ``EventIdWindow``::
+
+    $ python benchmarks/bench_dedup.py
+"""
+import sys
+import time
+from collections import deque
+
+from awslogs.awsloggenerator import EventIdWindow, MAX_EVENTS_PER_CALL
+
+
+def event_ids(count):
+    # CloudWatch event ids are 56 digit strings; every tenth id repeats the
+    # previous one to mimic events interleaved across pages.
+    for i in range(count):
+        n = i - 1 if i % 10 == 9 else i
+        yield str(n).zfill(56)
+
+
+def deque_scan(ids):
+    seen = deque(maxlen=MAX_EVENTS_PER_CALL)
+    emitted = 0
+    for event_id in ids:
+        if event_id not in seen:
+            seen.append(event_id)
+            emitted += 1
+    return emitted
+
+
+def id_window(ids):
+    seen = EventIdWindow(maxlen=MAX_EVENTS_PER_CALL)
+    emitted = 0
+    for event_id in ids:
+        if seen.add(event_id):
+            emitted += 1
+    return emitted
+
+
+def run(func, count):
+    ids = list(event_ids(count))
+    started = time.time()
+    emitted = func(ids)
+    elapsed = time.time() - started
+    return emitted, count / elapsed
+
+
+def main(argv=None):
+    counts = [int(c) for c in (argv or sys.argv)[1:]] or [10000, 100000, 1000000]
+    print("{0:>10} {1:>16} {2:>16} {3:>8}".format("events", "deque ev/s", "window ev/s", "speedup"))
+    for count in counts:
+        before_emitted, before = run(deque_scan, count)
+        after_emitted, after = run(id_window, count)
+        assert before_emitted == after_emitted
+        print("{0:>10} {1:>16,.0f} {2:>16,.0f} {3:>7.1f}x".format(count, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
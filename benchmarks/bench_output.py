@@ -0,0 +1,56 @@
+"""Benchmark of output throughput to a pipe.
+
+Compares the previous print-and-flush per line against ``OutputWriter``::
+
+    $ python benchmarks/bench_output.py
+"""
+import os
+import sys
+import time
+import subprocess
+
+from awslogs.logprinter import OutputWriter
+
+
+LINE = "/aws/lambda/my-function 2017/01/01/[$LATEST]0123456789abcdef START RequestId: 1234 Version: $LATEST"
+
+
+def cat():
+    devnull = open(os.devnull, 'w')
+    return subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=devnull)
+
+
+def print_and_flush(stream, count):
+    for _ in range(count):
+        stream.write(LINE + '\n')
+        stream.flush()
+
+
+def output_writer(stream, count):
+    writer = OutputWriter(stream)
+    for _ in range(count):
+        writer.write_line(LINE)
+    writer.flush()
+
+
+def run(func, count):
+    proc = cat()
+    started = time.time()
+    func(proc.stdin, count)
+    elapsed = time.time() - started
+    proc.stdin.close()
+    proc.wait()
+    return count / elapsed
+
+
+def main(argv=None):
+    counts = [int(c) for c in (argv or sys.argv)[1:]] or [100000, 1000000]
+    print("{0:>10} {1:>18} {2:>18} {3:>8}".format("lines", "print+flush l/s", "writer l/s", "speedup"))
+    for count in counts:
+        before = run(print_and_flush, count)
+        after = run(output_writer, count)
+        print("{0:>10} {1:>18,.0f} {2:>18,.0f} {3:>7.1f}x".format(count, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
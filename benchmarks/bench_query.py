@@ -0,0 +1,60 @@
+"""Benchmark of ``--query`` evaluation on large JSON log messages.
+
+Compares a full ``json.loads`` per message against ``QueryEngine``::
+
+    $ python benchmarks/bench_query.py
+"""
+import sys
+import time
+import random
+
+import jmespath
+from botocore.compat import json
+
+from awslogs.query import QueryEngine
+
+
+def documents(count, size):
+    """Structured log lines: a few leading keys, padding, and a trailing key."""
+    rnd = random.Random(0)
+    padding = ', '.join('"field%d": "%s"' % (i, 'x' * 40) for i in range(size // 50))
+    docs = []
+    for i in range(count):
+        doc = '{"level": "%s", "request": {"id": %d}, %s' % (
+            rnd.choice(['INFO', 'WARN', 'ERROR']), i, padding)
+        if i % 2:
+            doc += ', "status": %d' % rnd.choice([200, 404, 500])
+        docs.append(doc + '}')
+    return docs
+
+
+def full_decode(query, docs):
+    expression = jmespath.compile(query)
+    for doc in docs:
+        expression.search(json.loads(doc))
+
+
+def query_engine(query, docs):
+    engine = QueryEngine(query)
+    for doc in docs:
+        engine.search(doc)
+
+
+def run(func, query, docs):
+    started = time.time()
+    func(query, docs)
+    return len(docs) / (time.time() - started)
+
+
+def main(argv=None):
+    size = int(((argv or sys.argv)[1:] or [10000])[0])
+    docs = documents(5000, size)
+    print("{0:>20} {1:>16} {2:>16} {3:>8}".format("query", "json.loads m/s", "engine m/s", "speedup"))
+    for query in ['level', 'request.id', '[level, request.id]', 'status', 'error']:
+        before = run(full_decode, query, docs)
+        after = run(query_engine, query, docs)
+        print("{0:>20} {1:>16,.0f} {2:>16,.0f} {3:>7.1f}x".format(query, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Benchmark of ``--query`` formatting across worker processes.
+
+Formats the same events with ``LogPrinter`` and ``ParallelLogPrinter``::
+
+    $ python benchmarks/bench_workers.py [workers ...]
+"""
+import os
+import sys
+import time
+
+from awslogs.logprinter import LogPrinter
+from awslogs.workers import ParallelLogPrinter
+
+
+def events(count, size):
+    padding = ', '.join('"field%d": "%s"' % (i, 'x' * 40) for i in range(size // 50))
+    for i in range(count):
+        yield {'logStreamName': 'stream-%d' % (i % 16), 'timestamp': 1500000000000 + i,
+               'ingestionTime': 1500000000000 + i,
+               'message': '{%s, "request": {"id": %d}}' % (padding, i)}
+
+
+def run(printer, count, size):
+    started = time.time()
+    for event in events(count, size):
+        printer.print_log(event)
+    printer.flush()
+    return count / (time.time() - started)
+
+
+def main(argv=None):
+    workers = [int(w) for w in (argv or sys.argv)[1:]] or [2, 4]
+    count, size = 50000, 5000
+    options = dict(stream=open(os.devnull, 'w'), output_stream_enabled=True,
+                   output_timestamp_enabled=True, query='request.id')
+    baseline = run(LogPrinter('group', 10, **options), count, size)
+    print("{0:>8} {1:>12} {2:>8}".format("workers", "events/s", "speedup"))
+    print("{0:>8} {1:>12,.0f} {2:>7.1f}x".format(1, baseline, 1.0))
+    for n in workers:
+        rate = run(ParallelLogPrinter('group', 10, n, **options), count, size)
+        print("{0:>8} {1:>12,.0f} {2:>7.1f}x".format(n, rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,11 @@
+import os
 import sys
+import gzip
+import random
+import shutil
+import tempfile
+import time
+import threading
 import unittest
 from datetime import datetime
 try:
@@ -6,17 +13,40 @@ try:
 except ImportError:
     from io import StringIO
 
-from botocore.compat import total_seconds
+import jmespath
+from botocore.compat import json, six, total_seconds
+from botocore.exceptions import ClientError
 from termcolor import colored
 
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 try:
     from mock import patch, Mock
 except ImportError:
     from unittest.mock import patch, Mock
 
 from awslogs import AWSLogs
+from awslogs.awsloggenerator import (AWSLogGenerator, EventIdWindow, PipelinedLogGenerator,
+                                    partition_time_range)
+from awslogs.tail import HighWaterMarks, PollInterval
+from awslogs.cache import EventCache, MetadataCache, BUCKET_SIZE
+from awslogs.query import QueryEngine, scan_fields, pushdown_filter_pattern
+from awslogs.logprinter import OutputWriter, LogPrinter, TimestampFormatter, milis2iso
+from awslogs.workers import ParallelLogPrinter
+from awslogs.insights import InsightsQuery, result_event, stream_filter
+from awslogs.querytemplate import QueryTemplate
+from awslogs.stats import Aggregator, LogHistogram
+from awslogs.index import EventIndex, compile_filter
+from awslogs.outputfile import OutputFiles
+from awslogs.scheduler import CursorScheduler
+from awslogs.ratelimit import RateLimiter
+from awslogs.pipeline import ReorderBuffer, ReorderWindow
 from awslogs.exceptions import UnknownDateError
-from awslogs.bin import main
+from awslogs.writers import DEFAULT_FIELDS
+from awslogs.bin import main, reorder_window, size, interval
 
 
 def mapkeys(keys, rec_lst):
@@ -29,6 +59,119 @@ def mapkeys(keys, rec_lst):
     return [dict(zip(keys, vals)) for vals in rec_lst]
 
 
+class FakeLogsClient(object):
+    """In-memory stand-in for the ``filter_log_events`` API.
+
+    ``events`` maps stream names to ``(timestamp, message)`` pairs; every
+    call returns at most ``page_size`` events ordered by timestamp.
+    """
+
+    def __init__(self, events, page_size=2):
+        self.page_size = page_size
+        self.calls = []
+        self.events = []
+        for stream, records in sorted(events.items()):
+            for timestamp, message in records:
+                self.add(stream, timestamp, message)
+
+    def add(self, stream, timestamp, message):
+        self.events.append({'eventId': '{0}-{1}'.format(stream, message),
+                            'timestamp': timestamp,
+                            'ingestionTime': timestamp,
+                            'message': message,
+                            'logStreamName': stream})
+        self.events.sort(key=lambda e: (e['timestamp'], e['eventId']))
+
+    def filter_log_events(self, **kwargs):
+        self.calls.append(kwargs)
+        streams = kwargs.get('logStreamNames')
+        start = kwargs.get('startTime') or 0
+        end = kwargs.get('endTime', sys.maxsize)
+        matching = [e for e in self.events
+                    if (not streams or e['logStreamName'] in streams) and
+                    start <= e['timestamp'] <= end]
+        offset = int(kwargs.get('nextToken', 0))
+        response = {'events': matching[offset:offset + self.page_size]}
+        if offset + self.page_size < len(matching):
+            response['nextToken'] = str(offset + self.page_size)
+        return response
+
+
+class FakeInsightsClient(object):
+    """Stand-in for the Logs Insights calls of a CloudWatch Logs client.
+
+    Queries report ``Running`` for ``running_polls`` polls and then
+    complete with ``results``, given as lists of ``(field, value)``.
+    """
+
+    def __init__(self, results, running_polls=0):
+        self.results = [[{'field': f, 'value': v} for f, v in row] for row in results]
+        self.running_polls = running_polls
+        self.calls = []
+
+    def start_query(self, **kwargs):
+        self.calls.append(('start_query', kwargs))
+        return {'queryId': 'q1'}
+
+    def get_query_results(self, **kwargs):
+        self.calls.append(('get_query_results', kwargs))
+        if self.running_polls:
+            self.running_polls -= 1
+            return {'status': 'Running', 'results': []}
+        return {'status': 'Complete', 'results': self.results,
+                'statistics': {'recordsMatched': 3.0, 'recordsScanned': 10.0, 'bytesScanned': 900.0}}
+
+
+class LocalLogsEndpoint(object):
+    """HTTP stub of the CloudWatch Logs JSON API.
+
+    ``groups`` maps group names to the ``FakeLogsClient`` serving them; a
+    single client serves every group.
+    """
+
+    def __init__(self, groups):
+        if not isinstance(groups, dict):
+            groups = {None: groups}
+
+        class Handler(six.moves.BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                operation = self.headers['X-Amz-Target'].split('.')[-1]
+                kwargs = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                kwargs = dict((str(k), v) for k, v in kwargs.items())
+                fake = groups.get(kwargs.get('logGroupName'), groups.get(None))
+                if operation == 'DescribeLogGroups':
+                    prefix = kwargs.get('logGroupNamePrefix', '')
+                    response = {'logGroups': [{'logGroupName': name} for name in sorted(groups)
+                                              if name and name.startswith(prefix)]}
+                elif operation == 'DescribeLogStreams':
+                    names = sorted(set(e['logStreamName'] for e in fake.events
+                                       if e['logStreamName'].startswith(kwargs['logStreamNamePrefix'])))
+                    response = {'logStreams': [{'logStreamName': n} for n in names]}
+                else:
+                    # e.g. FilterLogEvents -> filter_log_events
+                    method = ''.join('_' + c.lower() if c.isupper() else c for c in operation)[1:]
+                    response = getattr(fake, method)(**kwargs)
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-amz-json-1.1')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = six.moves.BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
 class TestAWSLogsDatetimeParse(unittest.TestCase):
     @patch('boto3.client')
     @patch('awslogs.core.datetime')
@@ -234,15 +377,19 @@ class TestAWSLogs(unittest.TestCase):
         client = Mock()
         botoclient.return_value = client
         client.get_paginator.return_value.paginate.return_value = [
-            {'logStreams': [self._stream('A', 0, 1),
+            {'logStreams': [self._stream('D', sys.maxsize - 1, sys.maxsize),
                             self._stream('B', 0, 6),
                             self._stream('C'),
-                            self._stream('D', sys.maxsize - 1, sys.maxsize)],
-             }
+                            self._stream('A', 0, 1)],
+             'nextToken': 1},
+            # Never listed: the streams are ordered by last event time.
+            {'logStreams': [self._stream('E', 0, 6)]},
         ]
         parse_datetime.side_effect = [5, 7]
         awslogs = AWSLogs(start='5', end='7')
         self.assertEqual([g for g in awslogs.get_streams('log_group_name')], ['B', 'C'])
+        client.get_paginator.return_value.paginate.assert_called_with(
+            logGroupName='log_group_name', orderBy='LastEventTime', descending=True)
 
     @patch('boto3.client')
     @patch('sys.stdout', new_callable=StringIO)
@@ -572,3 +719,1033 @@ class TestAWSLogs(unittest.TestCase):
     @patch('sys.stderr', new_callable=StringIO)
     def test_version(self, mock_stderr):
         self.assertRaises(SystemExit, main, "awslogs --version".split())
+
+
+class TestEventIdWindow(unittest.TestCase):
+
+    def test_add_deduplicates(self):
+        window = EventIdWindow(maxlen=10)
+        self.assertTrue(window.add('a'))
+        self.assertFalse(window.add('a'))
+        self.assertTrue('a' in window)
+        self.assertEqual(len(window), 1)
+
+    def test_evicts_oldest(self):
+        window = EventIdWindow(maxlen=2)
+        for event_id in ('a', 'b', 'c'):
+            window.add(event_id)
+        self.assertFalse('a' in window)
+        self.assertTrue('b' in window)
+        self.assertTrue('c' in window)
+        self.assertTrue(window.add('a'))
+
+
+class TestAWSLogGenerator(unittest.TestCase):
+
+    def test_sharded_fetch_is_merged_by_timestamp(self):
+        client = FakeLogsClient({'A': [(1, 'a1'), (4, 'a4'), (7, 'a7')],
+                                 'B': [(2, 'b2'), (5, 'b5')],
+                                 'C': [(3, 'c3'), (6, 'c6'), (8, 'c8')]})
+        generator = AWSLogGenerator(log_group_name='group',
+                                    log_streams=['A', 'B', 'C'],
+                                    start_time=0,
+                                    concurrency=3)
+
+        events = list(generator.generate_logs(client))
+
+        self.assertEqual([e['message'] for e in events],
+                         ['a1', 'b2', 'c3', 'a4', 'b5', 'c6', 'a7', 'c8'])
+        self.assertEqual(sorted(tuple(c['logStreamNames']) for c in client.calls
+                                if 'nextToken' not in c),
+                         [('A',), ('B',), ('C',)])
+
+    def test_shards_are_capped_by_concurrency(self):
+        generator = AWSLogGenerator(log_streams=['A', 'B', 'C', 'D', 'E'],
+                                    concurrency=2)
+        self.assertEqual(generator._shards(), [['A', 'C', 'E'], ['B', 'D']])
+
+    def test_streams_are_batched_under_the_api_limit(self):
+        streams = ['s%03d' % i for i in range(250)]
+        client = FakeLogsClient(dict((s, [(i, s)]) for i, s in enumerate(streams)),
+                                page_size=1000)
+        generator = AWSLogGenerator(log_group_name='group',
+                                    log_streams=streams,
+                                    start_time=0)
+
+        events = list(generator.generate_logs(client))
+
+        self.assertEqual([e['message'] for e in events], streams)
+        self.assertEqual(len(client.calls), 3)
+        self.assertTrue(all(len(c['logStreamNames']) <= 100 for c in client.calls))
+
+    def test_too_many_batches_filter_the_whole_group(self):
+        streams = ['s%04d' % i for i in range(2500)]
+        records = dict((s, [(i, s)]) for i, s in enumerate(streams))
+        records['other'] = [(1, 'other')]
+        client = FakeLogsClient(records, page_size=10000)
+        generator = AWSLogGenerator(log_group_name='group',
+                                    log_streams=streams,
+                                    start_time=0)
+
+        events = list(generator.generate_logs(client))
+
+        self.assertEqual([e['message'] for e in events], streams)
+        self.assertEqual(len(client.calls), 1)
+        self.assertFalse('logStreamNames' in client.calls[0])
+
+    def test_end_time_bounds_the_fetch(self):
+        client = FakeLogsClient({'A': [(t, 'a%d' % t) for t in range(10)]}, page_size=2)
+        generator = AWSLogGenerator(log_group_name='group',
+                                    log_streams=['A'],
+                                    start_time=0,
+                                    end_time=4)
+
+        events = list(generator.generate_logs(client))
+
+        self.assertEqual([e['timestamp'] for e in events], [0, 1, 2, 3, 4])
+        self.assertTrue(all(c['endTime'] == 4 for c in client.calls))
+
+    def test_pagination_stops_past_end_time(self):
+        # A client which ignores endTime must not be paginated to the end.
+        client = FakeLogsClient({'A': [(t, 'a%d' % t) for t in range(10)]}, page_size=2)
+        filter_log_events = client.filter_log_events
+        client.filter_log_events = lambda **kwargs: filter_log_events(
+            **dict((k, v) for k, v in kwargs.items() if k != 'endTime'))
+        generator = AWSLogGenerator(log_group_name='group',
+                                    log_streams=['A'],
+                                    start_time=0,
+                                    end_time=4)
+
+        events = list(generator.generate_logs(client))
+
+        self.assertEqual([e['timestamp'] for e in events], [0, 1, 2, 3, 4])
+        self.assertEqual(len(client.calls), 4)
+
+    def test_time_partitions_are_fetched_and_emitted_in_order(self):
+        client = FakeLogsClient({'A': [(t, 'a%d' % t) for t in range(0, 100, 10)],
+                                 'B': [(t, 'b%d' % t) for t in range(5, 100, 10)]})
+        generator = AWSLogGenerator(log_group_name='group',
+                                    log_streams=['A', 'B'],
+                                    start_time=0,
+                                    end_time=99,
+                                    time_partitions=4)
+
+        events = list(generator.generate_logs(client))
+
+        self.assertEqual([e['timestamp'] for e in events], list(range(0, 100, 5)))
+        windows = sorted((c['startTime'], c['endTime']) for c in client.calls
+                         if 'nextToken' not in c)
+        self.assertEqual(windows, [(0, 24), (25, 49), (50, 74), (75, 99)])
+
+    def test_partition_time_range_without_activity(self):
+        self.assertEqual(partition_time_range(0, 100, 4),
+                         [(0, 25), (25, 50), (50, 75), (75, 100)])
+        self.assertEqual(partition_time_range(0, 100, 1), [(0, 100)])
+
+    def test_partition_time_range_follows_stream_activity(self):
+        # One stream is active in [0, 100) and three more in [80, 100), so
+        # half of the activity falls in the last fifth of the range.
+        ranges = [(0, 100), (80, 100), (80, 100), (80, 100)]
+        self.assertEqual(partition_time_range(0, 100, 4, ranges),
+                         [(0, 40), (40, 80), (80, 90), (90, 100)])
+
+    def test_tail_polls_from_high_water_marks(self):
+        client = FakeLogsClient({'A': [(10, 'a10'), (20, 'a20')],
+                                 'B': [(20, 'b20')]}, page_size=10)
+        arrivals = [[('A', 20, 'a20-late'), ('B', 30, 'b30')], [], [('A', 40, 'a40')]]
+        delays = []
+
+        def sleep(delay):
+            delays.append(delay)
+            for stream, timestamp, message in arrivals.pop(0) if arrivals else []:
+                client.add(stream, timestamp, message)
+
+        generator = AWSLogGenerator(watch=True,
+                                    log_group_name='group',
+                                    log_streams=['A', 'B'],
+                                    start_time=0)
+        events = generator.tail_logs(client, sleep=sleep)
+        messages = [next(events)['message'] for _ in range(6)]
+
+        self.assertEqual(messages, ['a10', 'a20', 'b20', 'a20-late', 'b30', 'a40'])
+        self.assertEqual([c['startTime'] for c in client.calls], [0, 20, 20, 20])
+        self.assertEqual(delays, [0.5, 0.5, 0.75])
+        self.assertEqual(generator.lag.count, 5)
+
+
+class TestTail(unittest.TestCase):
+
+    def _event(self, stream, timestamp, event_id):
+        return {'logStreamName': stream, 'timestamp': timestamp, 'eventId': event_id}
+
+    def test_high_water_marks(self):
+        marks = HighWaterMarks(start_time=5, horizon=100, recent_lag=50)
+        self.assertEqual(marks.start_time(), 5)
+        self.assertEqual(marks.lagging(), None)
+        self.assertTrue(marks.add(self._event('A', 10, '1')))
+        self.assertTrue(marks.add(self._event('A', 10, '2')))
+        self.assertFalse(marks.add(self._event('A', 10, '1')))
+        self.assertFalse(marks.add(self._event('A', 9, '3')))
+        self.assertTrue(marks.add(self._event('B', 50, '4')))
+        self.assertEqual(marks.start_time(), 10)
+        self.assertEqual(marks.lagging(), None)
+        # A lags behind and is polled on its own until it passes the horizon.
+        marks.add(self._event('B', 90, '5'))
+        self.assertEqual(marks.start_time(), 90)
+        self.assertEqual(marks.lagging(), (['A'], 10))
+        marks.add(self._event('B', 500, '6'))
+        self.assertEqual(marks.start_time(), 500)
+        self.assertEqual(marks.lagging(), None)
+
+    def test_first_events_of_a_stream_behind_the_others_are_polled(self):
+        client = FakeLogsClient({'A': [(1000, 'a1')]}, page_size=10)
+        arrivals = [[('A', 10000, 'a2')], [('C', 6000, 'c1')], [], []]
+
+        def sleep(delay):
+            # Fail rather than poll forever if c1 is skipped.
+            for stream, timestamp, message in arrivals.pop(0):
+                client.add(stream, timestamp, message)
+
+        generator = AWSLogGenerator(watch=True, log_group_name='group',
+                                    log_streams=['A', 'C'], start_time=0)
+        events = generator.tail_logs(client, sleep=sleep)
+        self.assertEqual([next(events)['message'] for _ in range(3)], ['a1', 'a2', 'c1'])
+        self.assertEqual(client.calls[-1], {'logGroupName': 'group', 'logStreamNames': ['C'],
+                                            'startTime': 0, 'endTime': 9999})
+
+    def test_new_streams_are_picked_up(self):
+        client = FakeLogsClient({'A': [(1000, 'a1')]}, page_size=10)
+        streams = ['A']
+        arrivals = [[], [('NEW', 500, 'new1'), ('A', 2000, 'a2')], [], [], []]
+
+        def sleep(delay):
+            for stream, timestamp, message in arrivals.pop(0):
+                client.add(stream, timestamp, message)
+                if stream not in streams:
+                    streams.append(stream)
+
+        generator = AWSLogGenerator(watch=True, log_group_name='group', log_streams=['A'],
+                                    start_time=0, list_streams=lambda: list(streams))
+        with patch('awslogs.awsloggenerator.STREAM_REFRESH_INTERVAL', 0):
+            events = generator.tail_logs(client, sleep=sleep)
+            self.assertEqual(sorted(next(events)['message'] for _ in range(3)), ['a1', 'a2', 'new1'])
+        self.assertEqual(generator.log_streams, ['A', 'NEW'])
+
+    def test_idle_streams_do_not_amplify_polls(self):
+        client = FakeLogsClient({'busy': [(0, 'busy-0')], 'idle': [(0, 'idle-0')]}, page_size=10000)
+        filter_log_events = client.filter_log_events
+        fetched = []
+
+        def counting_filter_log_events(**kwargs):
+            response = filter_log_events(**kwargs)
+            fetched[-1] += len(response['events'])
+            return response
+        client.filter_log_events = counting_filter_log_events
+        now = [0]
+
+        def sleep(delay):
+            # Five busy events per second, polled every second.
+            for _ in range(5):
+                now[0] += 200
+                client.add('busy', now[0], 'busy-%d' % now[0])
+            fetched.append(0)
+        fetched.append(0)
+
+        generator = AWSLogGenerator(watch=True, log_group_name='group',
+                                    log_streams=['busy', 'idle'], start_time=0)
+        events = generator.tail_logs(client, sleep=sleep)
+        messages = [next(events)['message'] for _ in range(2 + 5 * 30)]
+
+        self.assertEqual(messages[-1], 'busy-30000')
+        # Once the idle stream lags by RECENT_MARK_LAG, a poll re-reads only
+        # its event and the busy one at its mark besides the five new ones.
+        self.assertEqual(set(fetched[7:-1]), set([5 + 2]))
+
+    def test_poll_interval_adapts(self):
+        interval = PollInterval(initial=1.0, minimum=0.25, maximum=3.0)
+        self.assertEqual([interval.next(n) for n in (5, 5, 5, 0, 0, 0, 0)],
+                         [0.5, 0.25, 0.25, 0.375, 0.5625, 0.84375, 1.265625])
+
+
+class TestEventCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = EventCache(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _generator(self, streams):
+        return AWSLogGenerator(log_group_name='group',
+                               log_streams=streams,
+                               start_time=0,
+                               end_time=2 * BUCKET_SIZE - 1,
+                               event_cache=self.cache)
+
+    def test_settled_buckets_are_served_from_disk(self):
+        records = {'A': [(1, 'a1'), (BUCKET_SIZE + 1, 'a2')],
+                   'B': [(2, 'b1')]}
+        client = FakeLogsClient(records, page_size=10)
+
+        first = list(self._generator(['A', 'B']).generate_logs(client))
+        calls = len(client.calls)
+        second = list(self._generator(['A', 'B']).generate_logs(client))
+
+        self.assertEqual([e['message'] for e in first], ['a1', 'b1', 'a2'])
+        self.assertEqual(second, first)
+        self.assertEqual(len(client.calls), calls)
+
+    def test_only_missing_streams_are_fetched(self):
+        client = FakeLogsClient({'A': [(1, 'a1')], 'B': [(2, 'b1')]}, page_size=10)
+        list(self._generator(['A']).generate_logs(client))
+        del client.calls[:]
+
+        events = list(self._generator(['A', 'B']).generate_logs(client))
+
+        self.assertEqual([e['message'] for e in events], ['a1', 'b1'])
+        self.assertEqual(set(tuple(c['logStreamNames']) for c in client.calls), set([('B',)]))
+
+    def test_adjacent_uncached_buckets_share_a_cursor(self):
+        records = dict((stream, [(t, '%s%d' % (stream, t)) for t in range(0, 6 * BUCKET_SIZE, BUCKET_SIZE // 4)])
+                       for stream in ['A', 'B', 'C'])
+        client = FakeLogsClient(records, page_size=1000)
+
+        def generator(streams):
+            return AWSLogGenerator(log_group_name='group', log_streams=streams, start_time=5,
+                                   end_time=6 * BUCKET_SIZE - 1, event_cache=self.cache)
+
+        first = list(generator(['A', 'B']).generate_logs(client))
+        self.assertEqual(len(client.calls), 1)
+        self.assertEqual([e['timestamp'] for e in first], sorted(e['timestamp'] for e in first))
+        self.assertEqual(len(first), 2 * 24 - 2)
+
+        del client.calls[:]
+        events = list(generator(['A', 'B', 'C']).generate_logs(client))
+        self.assertEqual([(c['startTime'], c.get('logStreamNames')) for c in client.calls],
+                         [(5, ['A', 'B', 'C']), (BUCKET_SIZE, ['C'])])
+        self.assertEqual(len(events), 3 * 24 - 3)
+        self.assertEqual([e['message'] for e in events if e['logStreamName'] != 'C'],
+                         [e['message'] for e in first])
+
+    def test_many_streams_are_bound_in_batches(self):
+        streams = ['s%d' % i for i in range(7)]
+        events = [{'eventId': str(i), 'timestamp': i, 'ingestionTime': i,
+                   'message': 'm%d' % i, 'logStreamName': streams[i % 7]} for i in range(50)]
+        with patch('awslogs.cache.MAX_SQL_VARIABLES', 3):
+            list(self.cache.store('group', streams, None, 0, events))
+            self.assertEqual(self.cache.cached_streams('group', streams, None, 0), streams)
+            self.assertEqual(list(self.cache.read('group', streams, None, 0)), events)
+
+    def test_buckets_split_partial_and_recent_ranges(self):
+        self.assertEqual(self.cache.buckets(5, 2 * BUCKET_SIZE + 5),
+                         [(5, BUCKET_SIZE - 1, None),
+                          (BUCKET_SIZE, 2 * BUCKET_SIZE - 1, BUCKET_SIZE),
+                          (2 * BUCKET_SIZE, 2 * BUCKET_SIZE + 5, None)])
+        self.cache.clock = lambda: 0
+        self.assertEqual(self.cache.buckets(5, None), [(5, None, None)])
+
+    def test_least_recently_used_segments_are_evicted(self):
+        self.cache.max_size = 150
+        event = {'eventId': '1', 'timestamp': 1, 'ingestionTime': 1,
+                 'message': 'x' * 10, 'logStreamName': 'A'}
+        list(self.cache.store('group', ['A'], None, 0, [event]))
+        self.assertEqual(self.cache.cached_streams('group', ['A'], None, 0), ['A'])
+
+        list(self.cache.store('group', ['A'], None, BUCKET_SIZE, [event]))
+
+        self.assertEqual(self.cache.cached_streams('group', ['A'], None, 0), [])
+        self.assertEqual(self.cache.cached_streams('group', ['A'], None, BUCKET_SIZE), ['A'])
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.now = 1000.0
+        self.cache = MetadataCache(self.cache_dir, ttl=60, clock=lambda: self.now)
+        self.calls = []
+        self.remote = [{'logStreamName': 'app-1', 'firstEventTimestamp': 1, 'lastEventTimestamp': 900000},
+                       {'logStreamName': 'app-2', 'firstEventTimestamp': 2, 'lastEventTimestamp': 10},
+                       {'logStreamName': 'web-1'}]
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def describe(self, **kwargs):
+        self.calls.append(kwargs)
+        prefix = kwargs.get('logStreamNamePrefix', '')
+        streams = [s for s in self.remote if s['logStreamName'].startswith(prefix)]
+        if kwargs.get('orderBy') == 'LastEventTime':
+            streams.sort(key=lambda s: s.get('lastEventTimestamp', 0), reverse=True)
+        return iter(streams)
+
+    def names(self, prefix=None):
+        return [s['logStreamName'] for s in self.cache.streams('group', prefix, self.describe)]
+
+    def test_listings_are_served_until_the_ttl(self):
+        self.assertEqual(self.names(), ['app-1', 'app-2', 'web-1'])
+        self.assertEqual(self.names('app'), ['app-1', 'app-2'])
+        self.now += 30
+        self.assertEqual(self.names(), ['app-1', 'app-2', 'web-1'])
+        self.assertEqual(self.calls, [{'logGroupName': 'group'}])
+
+    def test_stale_listings_are_refreshed_incrementally(self):
+        self.names()
+        self.remote.append({'logStreamName': 'app-3', 'firstEventTimestamp': 5,
+                            'lastEventTimestamp': 4000000})
+        self.now += 3600
+
+        self.assertEqual(self.names(), ['app-1', 'app-2', 'app-3', 'web-1'])
+        self.assertEqual(self.calls[-1], {'logGroupName': 'group',
+                                          'orderBy': 'LastEventTime',
+                                          'descending': True})
+
+    def test_groups_are_cached(self):
+        describe = Mock(return_value=iter(['AAA', 'BBB']))
+        self.assertEqual(self.cache.groups(None, describe), ['AAA', 'BBB'])
+        self.assertEqual(self.cache.groups(None, describe), ['AAA', 'BBB'])
+        describe.assert_called_once_with()
+
+
+class TestOutputWriter(unittest.TestCase):
+
+    def test_lines_are_batched(self):
+        stream = Mock()
+        writer = OutputWriter(stream, buffer_size=12, max_delay=60)
+        writer.write_line('hello')
+        self.assertFalse(stream.write.called)
+        writer.write_line('world')
+        stream.write.assert_called_once_with('hello\nworld\n')
+        writer.write_line('again')
+        writer.flush()
+        self.assertEqual(stream.write.call_args[0], ('again\n',))
+
+    def test_line_buffered(self):
+        stream = Mock()
+        writer = OutputWriter(stream, line_buffered=True)
+        writer.write_line('hello')
+        stream.write.assert_called_once_with('hello\n')
+        self.assertTrue(stream.flush.called)
+
+
+class TestLogPrinter(unittest.TestCase):
+
+    event = {'logStreamName': 'DDD', 'timestamp': 0, 'ingestionTime': 5006,
+             'message': 'Hello 1\n'}
+
+    def _print(self, **options):
+        stream = StringIO()
+        printer = LogPrinter('AAA', 5, stream=stream, **options)
+        printer.print_log(self.event)
+        printer.print_log(self.event)
+        printer.flush()
+        return stream.getvalue().splitlines()[-1]
+
+    def test_all_fields_with_color(self):
+        line = self._print(color_enabled=True,
+                           output_group_enabled=True,
+                           output_stream_enabled=True,
+                           output_timestamp_enabled=True,
+                           output_ingestion_time_enabled=True)
+        self.assertEqual(line, ' '.join([colored('AAA', 'green'),
+                                         colored('DDD  ', 'cyan'),
+                                         colored('1970-01-01T00:00:00.000Z', 'yellow'),
+                                         colored('1970-01-01T00:00:05.006Z', 'blue'),
+                                         'Hello 1']))
+
+    def test_only_enabled_fields(self):
+        self.assertEqual(self._print(output_stream_enabled=True), 'DDD   Hello 1')
+        self.assertEqual(self._print(output_ingestion_time_enabled=True),
+                         '1970-01-01T00:00:05.006Z Hello 1')
+        self.assertEqual(self._print(), 'Hello 1')
+
+
+class TestTimestampFormatter(unittest.TestCase):
+
+    def test_matches_milis2iso(self):
+        formatter = TimestampFormatter()
+        rnd = random.Random(42)
+        values = [0, 1, 999, 1000, 59999, 60000, -1, -60001, 1472610205000, 1472610205999]
+        values += [rnd.randint(-10 ** 11, 4 * 10 ** 12) for _ in range(2000)]
+        start = 1500000000000
+        values += [start + rnd.randint(0, 10 ** 6) for _ in range(2000)]
+        for milis in values:
+            self.assertEqual(formatter(milis), milis2iso(milis))
+
+
+class TestQueryEngine(unittest.TestCase):
+
+    documents = [
+        '{"a": 1, "b": {"c": [1, 2, {"d": "x"}]}, "e": "f"}',
+        '{ "b" : { "c" : [] } , "a" : null }',
+        '{"e": "\\u00e9", "nested": {"a": 2}}',
+        '{"\\u0061": 3, "b": true}',
+        '{"a": [{"x": 1}, {"x": 2}], "msg": "a \\"b\\" c"}',
+        '{}',
+    ]
+
+    queries = ['a', 'b.c', 'b.c[2].d', 'a[*].x', 'e', '[a, e]', '{x: a, y: e}',
+               'a || e', 'length(@)', '*', '@', 'a[?x > `1`].x', 'nested.a']
+
+    def test_root_fields(self):
+        self.assertEqual(QueryEngine('a.b[0].c').fields, set(['a']))
+        self.assertEqual(QueryEngine('{x: a, y: b.c}').fields, set(['a', 'b']))
+        self.assertEqual(QueryEngine('max_by(items, &size)').fields, set(['items']))
+        self.assertEqual(QueryEngine('a[?b == `1`]').fields, set(['a']))
+        self.assertIsNone(QueryEngine('@').fields)
+        self.assertIsNone(QueryEngine('*.a').fields)
+        self.assertIsNone(QueryEngine('keys(@)').fields)
+
+    def test_scan_fields_stops_early(self):
+        document = '{"a": 1, "b": [2], "c": not json'
+        self.assertEqual(scan_fields(document, set(['a', 'b'])), {'a': 1, 'b': [2]})
+
+    def test_matches_full_decode(self):
+        for query in self.queries:
+            engine = QueryEngine(query)
+            expression = jmespath.compile(query)
+            for document in self.documents:
+                self.assertEqual(engine.search(document),
+                                 expression.search(json.loads(document)),
+                                 (query, document))
+
+
+class TestPushdown(unittest.TestCase):
+
+    def test_equality_conjuncts(self):
+        self.assertEqual(pushdown_filter_pattern("level == 'ERROR'", None),
+                         '{ $.level = "ERROR" }')
+        self.assertEqual(pushdown_filter_pattern("`500` == http.status && ok == `false`", ''),
+                         '{ ($.http.status = 500) && ($.ok IS FALSE) }')
+        self.assertEqual(pushdown_filter_pattern("level == 'ERROR' && (a || b)", None),
+                         '{ $.level = "ERROR" }')
+
+    def test_combined_with_user_pattern(self):
+        self.assertEqual(pushdown_filter_pattern("level == 'ERROR'", '{ $.a = 1 }'),
+                         '{ ($.a = 1) && ($.level = "ERROR") }')
+        self.assertEqual(pushdown_filter_pattern("level == 'ERROR'", 'ERROR -DEBUG'),
+                         'ERROR -DEBUG')
+
+    def test_not_pushed_down(self):
+        for where in ["level", "level != 'ERROR'", "level == 'ERR*'", "a == `null`",
+                      "a || b == 'x'", "!(a == 'x')", "a[0] == 'x'", "\"a-b\" == 'x'"]:
+            self.assertEqual(pushdown_filter_pattern(where, '{ $.a = 1 }'), '{ $.a = 1 }', where)
+
+    def test_printer_evaluates_locally(self):
+        stream = StringIO()
+        printer = LogPrinter('AAA', 5, stream=stream, where="level == 'ERROR' && code")
+        for message in ['{"level": "ERROR", "code": 0}', '{"level": "ERROR", "code": ""}',
+                        '{"level": "INFO"}', 'level ERROR', '{"level": "ERROR", "code": 5']:
+            printer.print_log({'logStreamName': 'DDD', 'timestamp': 0,
+                               'ingestionTime': 0, 'message': message})
+        printer.flush()
+        self.assertEqual(stream.getvalue(), '{"level": "ERROR", "code": 0}\n')
+
+
+class TestParallelLogPrinter(unittest.TestCase):
+
+    def test_same_output_as_log_printer(self):
+        events = [{'logStreamName': 'DDD' if i % 3 else 'EEE', 'timestamp': i * 7,
+                   'ingestionTime': i * 11, 'message': '{"n": %d, "odd": %s}' % (i, ['false', 'true'][i % 2])}
+                  for i in range(2500)]
+        events[5]['message'] = 'not json'
+        options = dict(output_stream_enabled=True, output_timestamp_enabled=True,
+                       query='n', where='odd')
+        outputs = []
+        for printer_class, args in [(LogPrinter, ()), (ParallelLogPrinter, (3, 100))]:
+            stream = StringIO()
+            printer = printer_class('AAA', 5, *args, stream=stream, **options)
+            for event in events:
+                printer.print_log(event)
+            printer.flush()
+            outputs.append(stream.getvalue())
+        self.assertEqual(len(outputs[0].splitlines()), 1249)
+        self.assertEqual(outputs[1], outputs[0])
+
+
+class TestCursorScheduler(unittest.TestCase):
+
+    def test_same_events_as_threaded_fetch(self):
+        client = FakeLogsClient(dict(('s%02d' % i, [(t, 's%02d-%d' % (i, t)) for t in range(i, 300, 7)])
+                                     for i in range(30)), page_size=3)
+        results = []
+        for scheduler in [None, CursorScheduler(4)]:
+            threads = threading.active_count()
+            generator = AWSLogGenerator(log_group_name='group',
+                                        log_streams=['s%02d' % i for i in range(30)],
+                                        start_time=0, end_time=250,
+                                        concurrency=10, time_partitions=3,
+                                        scheduler=scheduler)
+            events = []
+            for event in generator.generate_logs(client):
+                events.append(event['message'])
+                if scheduler is not None:
+                    self.assertEqual(threading.active_count(), threads)
+            results.append(events)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(len(results[0]), len([e for e in client.events if e['timestamp'] <= 250]))
+
+    def test_windows_are_fetched_concurrently(self):
+        client = FakeLogsClient({'s': [(t, str(t)) for t in range(800)]}, page_size=10)
+        filter_log_events = client.filter_log_events
+
+        def slow_filter_log_events(**kwargs):
+            time.sleep(0.05)
+            return filter_log_events(**kwargs)
+        client.filter_log_events = slow_filter_log_events
+        elapsed = []
+        for scheduler in [None, CursorScheduler(10)]:
+            generator = AWSLogGenerator(log_group_name='group', log_streams=['s'],
+                                        start_time=0, end_time=799, time_partitions=8,
+                                        scheduler=scheduler)
+            started = time.time()
+            self.assertEqual(len(list(generator.generate_logs(client))), 800)
+            elapsed.append(time.time() - started)
+        # 8 windows of 10 pages; one after the other they would take 4s.
+        self.assertLess(elapsed[1], max(elapsed[0] * 2, 1.5))
+
+    def test_local_endpoint(self):
+        endpoint = LocalLogsEndpoint(FakeLogsClient({'DDD1': [(1, 'Hello 1'), (3, 'Hello 3')],
+                                                     'DDD2': [(2, 'Hello 2')],
+                                                     'EEE': [(2, 'Other')]}))
+        self.addCleanup(endpoint.close)
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            main(['awslogs', 'get', 'AAA', 'DDD', '--start=1/1/1970', '--no-color',
+                  '--max-in-flight=2', '--endpoint-url', endpoint.url,
+                  '--aws-access-key-id=key', '--aws-secret-access-key=secret'])
+        self.assertEqual(stdout.getvalue().splitlines()[-3:],
+                         ['AAA DDD1 Hello 1', 'AAA DDD2 Hello 2', 'AAA DDD1 Hello 3'])
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0.0]
+        self.sleeps = []
+
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now[0] += seconds
+        self.limiter = RateLimiter(rate=2, burst=2, clock=lambda: self.now[0],
+                                   sleep=sleep, random=lambda: 0.5)
+
+    def throttle(self):
+        return ClientError({'Error': {'Code': 'ThrottlingException'}}, 'FilterLogEvents')
+
+    def test_token_bucket(self):
+        for _ in range(4):
+            self.limiter.acquire()
+        self.assertEqual(self.sleeps, [0.5, 0.5])
+
+    def test_throttled_calls_are_retried_and_slow_down(self):
+        responses = [self.throttle(), self.throttle(), {'events': []}]
+
+        def request(**kwargs):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        self.assertEqual(self.limiter.call(request, logGroupName='AAA'), {'events': []})
+        self.assertEqual(self.limiter.throttles, 2)
+        self.assertEqual(self.limiter.retry_delay, 0.125 + 0.25)
+        self.assertTrue(self.limiter.rate < 1)
+
+        error = ClientError({'Error': {'Code': 'ResourceNotFoundException'}}, 'FilterLogEvents')
+        self.assertRaises(ClientError, self.limiter.call, Mock(side_effect=error))
+        self.assertEqual(self.limiter.throttles, 2)
+
+    def test_paginate_resumes_after_throttling(self):
+        def pages(**kwargs):
+            if 'PaginationConfig' not in kwargs:
+                yield {'logStreams': ['a'], 'nextToken': '1'}
+                raise self.throttle()
+            yield {'logStreams': ['b']}
+
+        paginator = Mock()
+        paginator.paginate.side_effect = pages
+        pages = list(self.limiter.paginate(paginator, {'logGroupName': 'AAA'}))
+        self.assertEqual([p['logStreams'] for p in pages], [['a'], ['b']])
+        self.assertEqual(self.limiter.throttles, 1)
+        # Page a, the throttled request and its retry; nothing after page b.
+        self.assertEqual(self.limiter.calls, 3)
+        kwargs = paginator.paginate.call_args[1]
+        self.assertEqual(kwargs['logGroupName'], 'AAA')
+        self.assertTrue(kwargs['PaginationConfig']['StartingToken'])
+
+
+class TestMultipleGroups(unittest.TestCase):
+
+    def test_groups_are_merged_by_timestamp(self):
+        endpoint = LocalLogsEndpoint({
+            'svc-a': FakeLogsClient({'DDD1': [(1, 'a1'), (4, 'a4')]}),
+            'svc-b': FakeLogsClient({'DDD2': [(2, 'b2'), (3, 'b3')], 'EEE': [(0, 'other')]}),
+            'svc-cc': FakeLogsClient({'DDD3': [(5, 'c5')]}),
+            'other': FakeLogsClient({'DDD1': [(1, 'other')]}),
+        })
+        self.addCleanup(endpoint.close)
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            main(['awslogs', 'get', 'svc-*,svc-a', 'DDD', '--start=1/1/1970', '--no-color',
+                  '--endpoint-url', endpoint.url,
+                  '--aws-access-key-id=key', '--aws-secret-access-key=secret'])
+        self.assertEqual(stdout.getvalue().splitlines()[-5:],
+                         ['svc-a  DDD1 a1', 'svc-b  DDD2 b2', 'svc-b  DDD2 b3',
+                          'svc-a  DDD1 a4', 'svc-cc DDD3 c5'])
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_first_batch_is_fetched_while_discovering(self):
+        client = FakeLogsClient({'A': [(1, 'a1'), (3, 'a3')], 'B': [(2, 'b2')]})
+        printed = threading.Event()
+
+        def generators():
+            yield AWSLogGenerator(log_group_name='group', log_streams=['A'], start_time=0)
+            # The next batch is only discovered once an event has been printed.
+            assert printed.wait(5)
+            yield AWSLogGenerator(log_group_name='group', log_streams=['B'], start_time=0)
+
+        events = PipelinedLogGenerator(generators(), 2).generate_logs(client)
+        self.assertEqual(next(events)['message'], 'a1')
+        printed.set()
+        self.assertEqual(sorted(event['message'] for event in events), ['a3', 'b2'])
+
+    def test_get_fetches_every_batch(self):
+        endpoint = LocalLogsEndpoint(FakeLogsClient(
+            dict(('DDD%03d' % i, [(i, 'm%03d' % i)]) for i in range(120)), page_size=100))
+        self.addCleanup(endpoint.close)
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            main(['awslogs', 'get', 'AAA', 'DDD', '--start=1/1/1970', '--no-color', '-G', '-S',
+                  '--pipeline=2', '--reorder-window=200',
+                  '--endpoint-url', endpoint.url,
+                  '--aws-access-key-id=key', '--aws-secret-access-key=secret'])
+        self.assertEqual(stdout.getvalue().splitlines()[1:], ['m%03d' % i for i in range(120)])
+
+    def test_later_groups_report_progress_to_stderr(self):
+        endpoint = LocalLogsEndpoint(FakeLogsClient({'DDD': [(1, 'm1'), (2, 'm2')]}, page_size=100))
+        self.addCleanup(endpoint.close)
+        with patch('sys.stdout', new_callable=StringIO) as stdout, \
+                patch('sys.stderr', new_callable=StringIO) as stderr:
+            main(['awslogs', 'get', 'AAA,BBB', 'DDD', '--start=1/1/1970', '--no-color', '-S',
+                  '--pipeline=2', '--endpoint-url', endpoint.url,
+                  '--aws-access-key-id=key', '--aws-secret-access-key=secret'])
+        lines = stdout.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('Searching for log streams belonging to group AAA'))
+        self.assertEqual(sorted(lines[1:]), ['AAA m1', 'AAA m2', 'BBB m1', 'BBB m2'])
+        self.assertIn('Searching for log streams belonging to group BBB', stderr.getvalue())
+
+
+class TestInsights(unittest.TestCase):
+
+    def test_polls_with_backoff_until_complete(self):
+        client = FakeInsightsClient([[('status', '200'), ('count(*)', '12')]], running_polls=3)
+        sleeps = []
+        query = InsightsQuery(client, ['AAA'], 'stats count(*) by status', 1500, 4001,
+                              sleep=sleeps.append)
+
+        self.assertEqual([e['message'] for e in query.events()], ['{"status": "200", "count(*)": "12"}'])
+        self.assertEqual(client.calls[0], ('start_query', {
+            'logGroupNames': ['AAA'], 'queryString': 'stats count(*) by status',
+            'startTime': 1, 'endTime': 5}))
+        self.assertEqual(len(client.calls), 5)
+        self.assertEqual(sleeps, sorted(sleeps))
+        self.assertTrue(sleeps[0] < sleeps[-1])
+        self.assertTrue(query.summary().startswith('Logs Insights scanned 10 records'))
+
+    def test_result_event(self):
+        event = result_event([{'field': '@timestamp', 'value': '1970-01-01 00:00:01.500'},
+                              {'field': '@log', 'value': '123456789012:AAA'},
+                              {'field': '@logStream', 'value': 'DDD'},
+                              {'field': '@message', 'value': 'Hello'},
+                              {'field': '@ptr', 'value': 'xyz'}])
+        self.assertEqual(event, {'logGroupName': 'AAA', 'logStreamName': 'DDD', 'timestamp': 1500,
+                                 'ingestionTime': None, 'message': 'Hello'})
+        self.assertEqual(stream_filter('web-1.'), r'filter @logStream like /^web-1\./')
+
+    def test_template(self):
+        template = QueryTemplate(StringIO(u'log_group_name: AAA\n'
+                                          u'insights_query: "stats count(*) by {{field}}"\n'),
+                                 ['field=status'])
+        self.assertEqual(template.insights_query, 'stats count(*) by status')
+        self.assertEqual(template.log_stream_prefix, None)
+
+    def test_main_insights(self):
+        endpoint = LocalLogsEndpoint(FakeInsightsClient([[('status', '200'), ('count(*)', '12')],
+                                                         [('status', '500'), ('count(*)', '3')]]))
+        self.addCleanup(endpoint.close)
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            with patch('sys.stderr', new_callable=StringIO) as stderr:
+                code = main(['awslogs', 'insights', 'AAA', 'stats count(*) by status', '-G',
+                             '--timestamp', '--query=status', '--endpoint-url', endpoint.url,
+                             '--aws-access-key-id=key', '--aws-secret-access-key=secret'])
+        self.assertEqual(code, 0)
+        self.assertEqual(stdout.getvalue().splitlines()[1:], ['200', '500'])
+        self.assertIn('matched 3', stderr.getvalue())
+
+
+class TestStats(unittest.TestCase):
+
+    def test_histogram_percentiles_within_relative_error(self):
+        rng = random.Random(7)
+        values = [rng.lognormvariate(3, 1.5) for _ in range(20000)] + [0.0, -5.0]
+        histogram = LogHistogram(relative_error=0.01)
+        for start in range(0, len(values), 1000):
+            histogram.add_many(values[start:start + 1000])
+        values.sort()
+        for p in (1, 50, 90, 99, 99.9):
+            exact = values[int(len(values) * p / 100.0 + 0.5) - 1]
+            self.assertTrue(abs(histogram.percentile(p) - exact) <= 0.01 * abs(exact) + 1e-9, p)
+        self.assertEqual((histogram.percentile(0.001), histogram.percentile(100)), (-5.0, values[-1]))
+        self.assertTrue(len(histogram.positive) < 1000)
+
+    def test_groups_values_and_buckets(self):
+        messages = ['{"status": 200, "latency": 10}', '{"status": 500, "latency": "30"}',
+                    '{"status": 200, "latency": 20}', '{"status": 200}', 'not json']
+        events = [{'timestamp': i * 1000, 'message': m} for i, m in enumerate(messages)]
+        aggregator = Aggregator(by='status', value='latency', bucket_ms=2000)
+        aggregator.add_events(events)
+
+        rows = aggregator.rows(percentiles=(50,))
+        self.assertEqual(rows[0], ['group', 'count', 'rate/s', 'min', 'mean', 'p50', 'max'])
+        self.assertEqual(rows[1], ['200', '3', '0.75', '10', '15', '10', '20'])
+        self.assertEqual(rows[2:], [['-', '1', '0.25', '-', '-', '-', '-'],
+                                    ['500', '1', '0.25', '30', '30', '30', '30']])
+        self.assertEqual(aggregator.bucket_rows()[1:3], [['1970-01-01T00:00:00.000Z', '200', '1', '0.5'],
+                                                         ['1970-01-01T00:00:00.000Z', '500', '1', '0.5']])
+
+        aggregator = Aggregator(where='status == `200`')
+        aggregator.add_events(events)
+        self.assertEqual(aggregator.rows(), [['count', 'rate/s'], ['3', '1']])
+
+    def test_non_finite_values_are_skipped(self):
+        messages = ['{"latency": 10}', '{"latency": Infinity}', '{"latency": NaN}',
+                    '{"latency": "inf"}', '{"latency": "-Infinity"}', '{"latency": 1%s}' % ('0' * 400)]
+        aggregator = Aggregator(value='latency')
+        aggregator.add_events([{'timestamp': 0, 'message': m} for m in messages])
+        self.assertEqual(aggregator.rows(percentiles=(50,))[1], ['6', '6', '10', '10', '10', '10'])
+
+    def test_main_stats(self):
+        endpoint = LocalLogsEndpoint(FakeLogsClient({
+            'DDD': [(i, '{"status": %d, "latency": %d}' % (200 if i % 4 else 500, i)) for i in range(100)]
+        }, page_size=1000))
+        self.addCleanup(endpoint.close)
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            main(['awslogs', 'stats', 'AAA', 'DDD', '--start=1/1/1970', '--by=status',
+                  '--value=latency', '--percentiles=50,99',
+                  '--endpoint-url', endpoint.url,
+                  '--aws-access-key-id=key', '--aws-secret-access-key=secret'])
+        lines = stdout.getvalue().splitlines()[1:]
+        self.assertEqual(lines[0].split(), ['group', 'count', 'rate/s', 'min', 'mean', 'p50', 'p99', 'max'])
+        self.assertEqual(lines[1].split()[:2], ['200', '75'])
+        self.assertEqual(lines[2].split()[:2], ['500', '25'])
+
+
+class TestEventIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def _messages(self, filter_pattern, start=0, end=10):
+        index = EventIndex(self.cache_dir)
+        return [e['message'] for e in index.search('AAA', 'DDD', start, end, compile_filter(filter_pattern))]
+
+    def test_filter_patterns(self):
+        events = [{'logStreamName': 'DDD', 'timestamp': i, 'eventId': str(i), 'message': m}
+                  for i, m in enumerate(['ERROR Task timed out', 'error: retrying', 'ERRORS retrying',
+                                         '{"level": "ERROR", "code": 5, "ok": false}', 'WARN x'])]
+        events.append({'logStreamName': 'EEE', 'timestamp': 1, 'eventId': 'e', 'message': 'ERROR'})
+        EventIndex(self.cache_dir).add('AAA', '', 0, 10, events)
+
+        self.assertEqual(self._messages(None, 1, 2), ['error: retrying', 'ERRORS retrying'])
+        self.assertEqual(self._messages('ERROR'), ['ERROR Task timed out', 'ERRORS retrying',
+                                                   '{"level": "ERROR", "code": 5, "ok": false}'])
+        self.assertEqual(self._messages('ERROR -"timed out" retrying'), ['ERRORS retrying'])
+        self.assertEqual(self._messages('?WARN ?error'), ['error: retrying', 'WARN x'])
+        self.assertEqual(self._messages('{ ($.level = "ERROR") && ($.code = 5) && $.ok IS FALSE }'),
+                         ['{"level": "ERROR", "code": 5, "ok": false}'])
+        self.assertEqual(self._messages('{ $.code = 6 }'), [])
+        self.assertEqual(compile_filter('[ip, user, ...]'), None)
+        self.assertEqual(compile_filter('{ $.latency > 5 }'), None)
+        self.assertEqual(compile_filter('ERR*'), None)
+
+    def test_get_uses_the_index_when_it_covers_the_window(self):
+        client = FakeLogsClient({'DDD1': [(1000, 'ERROR one'), (2000, 'INFO two')],
+                                 'DDD2': [(3000, 'ERROR three')]}, page_size=100)
+        endpoint = LocalLogsEndpoint(client)
+        self.addCleanup(endpoint.close)
+        arguments = ['--cache-dir', self.cache_dir, '--no-color', '--endpoint-url', endpoint.url,
+                     '--aws-access-key-id=key', '--aws-secret-access-key=secret']
+        with patch('sys.stdout', new_callable=StringIO):
+            main(['awslogs', 'index', 'AAA', 'DDD', '--start=1/1/1970', '--end=1/1/1970 00:01'] + arguments)
+        self.assertEqual(len(client.calls), 1)
+
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            main(['awslogs', 'get', 'AAA', 'DDD', '--index', '-f', 'ERROR',
+                  '--start=1/1/1970', '--end=1/1/1970 00:00:30'] + arguments)
+        self.assertEqual(stdout.getvalue().splitlines()[1:], ['AAA DDD1 ERROR one', 'AAA DDD2 ERROR three'])
+        self.assertEqual(len(client.calls), 1)
+
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            main(['awslogs', 'get', 'AAA', 'DDD', '--index', '--pipeline', '-f', 'ERROR',
+                  '--start=1/1/1970', '--end=1/1/1970 00:00:30'] + arguments)
+        self.assertEqual(stdout.getvalue().splitlines()[1:], ['AAA DDD1 ERROR one', 'AAA DDD2 ERROR three'])
+        self.assertEqual(len(client.calls), 1)
+
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            main(['awslogs', 'get', 'AAA', 'DDD', '--index', '--start=1/1/1970'] + arguments)
+        self.assertEqual(len(stdout.getvalue().splitlines()), 4)
+        self.assertEqual(len(client.calls), 2)
+
+
+class TestReorderBuffer(unittest.TestCase):
+
+    def events(self, *timestamps):
+        return [{'timestamp': t, 'message': str(t)} for t in timestamps]
+
+    def timestamps(self, events):
+        return [e['timestamp'] for e in events]
+
+    def test_time_window(self):
+        buffer = ReorderBuffer(window_ms=10)
+        released = []
+        for event in self.events(5, 3, 12, 9, 30, 1, 25):
+            released.append(self.timestamps(buffer.push(event)))
+        self.assertEqual(released, [[], [], [], [], [3, 5, 9, 12], [1], []])
+        self.assertEqual(self.timestamps(buffer.tick(36)), [25])
+        self.assertEqual(self.timestamps(buffer.drain()), [30])
+        self.assertEqual((buffer.count, buffer.late, buffer.max_lateness), (7, 1, 11))
+
+    def test_event_window(self):
+        buffer = ReorderBuffer(window_events=2)
+        events = list(buffer.reorder(self.events(3, 1, 2, 6, 4, 5, 0)))
+        self.assertEqual(self.timestamps(events), [1, 2, 3, 4, 0, 5, 6])
+        self.assertEqual(buffer.late, 1)
+
+    def test_generator_reorders_within_the_window(self):
+        client = FakeLogsClient({'A': [(t, 'a%d' % t) for t in range(10)]}, page_size=3)
+        for event, timestamp in zip(client.events, [2, 0, 1, 5, 3, 4, 8, 6, 7, 9]):
+            event['timestamp'] = timestamp
+        window = ReorderWindow(window_ms=3)
+        generator = AWSLogGenerator(log_group_name='group', log_streams=['A'],
+                                    start_time=0, reorder_window=window)
+
+        events = list(generator.generate_logs(client))
+
+        self.assertEqual(self.timestamps(events), list(range(10)))
+        self.assertTrue(window.summary().startswith('0 of 10 events'))
+
+    def test_parse_option(self):
+        self.assertEqual(reorder_window('500ms'), (500, None))
+        self.assertEqual(reorder_window('5s'), (5000, None))
+        self.assertEqual(reorder_window('1000'), (None, 1000))
+        self.assertRaises(Exception, reorder_window, '5 hours')
+
+
+class TestOutputFormats(unittest.TestCase):
+
+    events = [{'logStreamName': 'DDD', 'timestamp': 1, 'ingestionTime': 2, 'eventId': '1',
+               'message': u'{"a": "x, \\"y\\"", "b": "caf\\u00e9"}\n'},
+              {'logStreamName': 'EEE', 'timestamp': 3, 'ingestionTime': 4, 'eventId': '2',
+               'message': u'line one\nline two', 'logGroupName': 'BBB'}]
+
+    def _print(self, **options):
+        stream = StringIO()
+        printer = LogPrinter('AAA', 5, stream=stream, **options)
+        for event in self.events:
+            printer.print_log(event)
+        printer.close()
+        return stream.getvalue()
+
+    def test_jsonl(self):
+        lines = self._print(output_format='jsonl').splitlines()
+        self.assertEqual([json.loads(line) for line in lines],
+                         [{'logGroupName': 'AAA', 'logStreamName': 'DDD', 'timestamp': 1,
+                           'ingestionTime': 2, 'message': self.events[0]['message']},
+                          {'logGroupName': 'BBB', 'logStreamName': 'EEE', 'timestamp': 3,
+                           'ingestionTime': 4, 'message': 'line one\nline two'}])
+        self.assertTrue(lines[0].startswith('{"logGroupName": "AAA", "logStreamName": "DDD"'))
+
+    def test_csv_with_fields_and_query(self):
+        output = self._print(output_format='csv', fields=('eventId', 'message'), query='b')
+        self.assertEqual(output, u'eventId,message\n1,caf\u00e9\n2,"line one\nline two"\n')
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_parquet(self):
+        path = tempfile.mktemp(suffix='.parquet')
+        self.addCleanup(lambda: os.path.exists(path) and os.remove(path))
+        with open(path, 'wb') as stream:
+            printer = LogPrinter('AAA', 5, stream=stream, output_format='parquet')
+            for event in self.events:
+                printer.print_log(event)
+            printer.close()
+        table = pyarrow.parquet.read_table(path)
+        self.assertEqual(table.column_names, list(DEFAULT_FIELDS))
+        self.assertEqual(table.num_rows, 2)
+
+
+class TestOutputFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _print(self, name, events, **options):
+        output_files = OutputFiles(os.path.join(self.directory, name), **options)
+        printer = LogPrinter('AAA', 3, output_files=output_files, output_format='jsonl')
+        for event in events:
+            printer.print_log(event)
+        printer.close()
+        return [os.path.basename(path) for path in output_files.paths]
+
+    def _read(self, name):
+        with gzip.open(os.path.join(self.directory, name)) as stream:
+            return [json.loads(line) for line in stream.read().decode('utf-8').splitlines()]
+
+    def test_gzip_inferred_from_extension(self):
+        events = [{'logStreamName': 'DDD', 'timestamp': i, 'message': u'caf\u00e9 %d' % i}
+                  for i in range(1000)]
+        self.assertEqual(self._print('events.jsonl.gz', events), ['events.jsonl.gz'])
+        self.assertEqual([record['message'] for record in self._read('events.jsonl.gz')],
+                         [event['message'] for event in events])
+
+    def test_rotate_by_event_time_and_size(self):
+        hour = 3600 * 1000
+        events = [{'logStreamName': 'DDD', 'timestamp': 1483228800000 + i * hour // 2,
+                   'message': 'x' * 100} for i in range(4)]
+        paths = self._print('events.jsonl.gz', events, rotate_interval=hour, rotate_size=1)
+        self.assertEqual(paths, ['events-20170101T0000-0001.jsonl.gz',
+                                 'events-20170101T0000-0002.jsonl.gz',
+                                 'events-20170101T0100-0001.jsonl.gz',
+                                 'events-20170101T0100-0002.jsonl.gz'])
+        self.assertEqual([len(self._read(path)) for path in paths], [1, 1, 1, 1])
+
+    def test_late_events_go_to_the_current_file(self):
+        hour = 3600 * 1000
+        events = [{'logStreamName': 'DDD', 'timestamp': 1483228800000 + t, 'message': str(t)}
+                  for t in (0, hour + 1, 10, hour + 2)]
+        paths = self._print('events.jsonl.gz', events, rotate_interval=hour)
+        self.assertEqual(paths, ['events-20170101T0000.jsonl.gz', 'events-20170101T0100.jsonl.gz'])
+        self.assertEqual([[record['message'] for record in self._read(path)] for path in paths],
+                         [['0'], [str(hour + 1), '10', str(hour + 2)]])
+
+    def test_parallel_printer_with_filtered_out_chunks(self):
+        output_files = OutputFiles(os.path.join(self.directory, 'events.jsonl.gz'), rotate_interval=1000)
+        printer = ParallelLogPrinter('AAA', 3, 2, 10, output_files=output_files,
+                                     output_format='jsonl', where='keep')
+        for i in range(50):
+            printer.print_log({'logStreamName': 'DDD', 'timestamp': i * 100,
+                               'message': '{"keep": %s}' % ('true' if i >= 30 else 'false')})
+        printer.close()
+        paths = [os.path.basename(path) for path in output_files.paths]
+        self.assertEqual(len(paths), 2)
+        self.assertEqual([len(self._read(path)) for path in paths], [10, 10])
+
+    def test_no_events_leave_an_empty_file(self):
+        self.assertEqual(self._print('events.jsonl', [], rotate_interval=1000), ['events.jsonl'])
+
+    def test_parse_size_and_interval(self):
+        self.assertEqual(size('100MB'), 100 * 1024 * 1024)
+        self.assertEqual(size('512'), 512)
+        self.assertEqual(interval('30m'), 30 * 60 * 1000)